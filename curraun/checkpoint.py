@@ -0,0 +1,238 @@
+"""
+    Checkpoints of a running simulation.
+
+    Usage:
+
+        s.save_checkpoint("run.ckpt", forces={'kappa': kappa_tforce, 'qhat': qhat_tforce})
+
+        # later, after setting up the same simulation and transported forces
+        s.load_checkpoint("run.ckpt", forces={'kappa': kappa_tforce, 'qhat': qhat_tforce})
+
+        # periodic checkpoints, spending at most 5% of the run time on writing
+        core.evolve_leapfrog_n(s, steps, callback=checkpoint.AutoCheckpoint("run.ckpt", max_overhead=0.05),
+                               every=100)
+
+    File format (little endian):
+
+        magic (8 bytes) | header size (uint64) | header (JSON) | sections
+
+    The header contains the parameters of the simulation (n, dt, g, batch, t, gauge group,
+    precision, algebra storage, compact links) and the list of sections (name, dtype, shape,
+    offset, crc32). Every section is aligned to SECTION_ALIGNMENT bytes:
+
+        fields            the field buffer of the simulation (see core.Simulation)
+        rng/keys          state of the numpy random generator of curraun.mv
+        <force>/<array>   arrays of the transported forces (f, fi, v, p_perp_x, ...)
+
+    Sections are written and read in chunks of CHUNK_SIZE bytes directly from and into the
+    arrays, so a large state is transferred at disk speed without temporary copies. The file is
+    written under a temporary name and renamed at the end: a crash never leaves a broken
+    checkpoint behind.
+"""
+import os
+import json
+import time
+import zlib
+
+import numpy as np
+
+import curraun.su as su
+import curraun.mv as mv
+
+MAGIC = b'CURRAUN1'
+SECTION_ALIGNMENT = 4096
+CHUNK_SIZE = 64 * 1024 ** 2
+
+# arrays of kappa.TransportedForce and qhat.TransportedForce
+FORCE_ARRAYS = ['v', 'f', 'fi', 'p_perp_x', 'p_perp_y', 'p_perp_z', 'p_perp_mean']
+
+
+def save(s, path, forces=None):
+    """Write fields, time, parameters, RNG state and transported forces of 's' to 'path'."""
+    forces = forces or {}
+    if s.backend.use_cuda:
+        s.copy_to_host()
+
+    sections = [('fields', s.buffer)]
+
+    rng_name, keys, pos, has_gauss, cached_gaussian = mv.random_np.get_state()
+    sections.append(('rng/keys', keys))
+
+    force_counters = {}
+    for name, force in forces.items():
+        if s.backend.use_cuda:
+            force.copy_to_host()
+        force_counters[name] = force.t
+        for array_name in FORCE_ARRAYS:
+            if hasattr(force, array_name):
+                sections.append((name + '/' + array_name, np.asarray(getattr(force, array_name))))
+
+    header = {
+        'n': s.n,
+        'dt': s.dt,
+        'g': s.g,
+        'batch': s.batch,
+        't': s.t,
+        'group': su.su_group,
+        'precision': su.su_precision,
+        'algebra_storage': su.ALGEBRA_STORAGE,
+        'compact_links': s.compact_links,
+        'rng': {'name': rng_name, 'pos': int(pos), 'has_gauss': int(has_gauss),
+                'cached_gaussian': float(cached_gaussian), 'cupy_seed': mv.random_cupy_seed},
+        'forces': force_counters,
+        'sections': [],
+    }
+
+    # section offsets depend on the header size: reserve enough space for the header first
+    offset = _align(len(MAGIC) + 8 + 1024 + 256 * len(sections))
+    for name, array in sections:
+        header['sections'].append({'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape),
+                                   'offset': offset, 'crc32': 0})
+        offset = _align(offset + array.nbytes)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        for entry, (name, array) in zip(header['sections'], sections):
+            file.seek(entry['offset'])
+            entry['crc32'] = _write_chunked(file, array)
+        file.truncate(offset)
+
+        encoded = json.dumps(header).encode('utf-8')
+        if len(MAGIC) + 8 + len(encoded) > header['sections'][0]['offset']:
+            raise RuntimeError("Checkpoint header does not fit into the reserved space")
+        file.seek(0)
+        file.write(MAGIC)
+        file.write(np.uint64(len(encoded)).tobytes())
+        file.write(encoded)
+
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_header(path):
+    """Parameters and sections stored in a checkpoint file."""
+    with open(path, 'rb') as file:
+        return _read_header(file)
+
+
+def load(s, path, forces=None, verify=True):
+    """
+    Restore 's' (and the given transported forces) from a checkpoint.
+
+    The simulation has to be set up with the same parameters as the saved one. The numpy
+    random generator of curraun.mv continues from the saved state. The cupy generator is
+    seeded again with the saved seed, its position is not restored.
+    """
+    forces = forces or {}
+    with open(path, 'rb') as file:
+        header = _read_header(file)
+
+        expected = {'n': s.n, 'dt': s.dt, 'g': s.g, 'batch': s.batch,
+                    'group': su.su_group, 'precision': su.su_precision, 'algebra_storage': su.ALGEBRA_STORAGE,
+                    'compact_links': s.compact_links}
+        for key, value in expected.items():
+            if header[key] != value:
+                raise ValueError("Checkpoint {} has {} = {}, but the simulation has {}".format(
+                    path, key, header[key], value))
+
+        sections = {entry['name']: entry for entry in header['sections']}
+        _read_chunked(file, sections['fields'], s.buffer, verify)
+
+        keys = np.empty(sections['rng/keys']['shape'], dtype=sections['rng/keys']['dtype'])
+        _read_chunked(file, sections['rng/keys'], keys, verify)
+        rng = header['rng']
+        mv.random_np.set_state((rng['name'], keys, rng['pos'], rng['has_gauss'], rng['cached_gaussian']))
+        if rng['cupy_seed'] != mv.random_cupy_seed:
+            mv.random_cupy = None
+            mv.random_cupy_seed = rng['cupy_seed']
+
+        for name, force in forces.items():
+            if name not in header['forces']:
+                raise ValueError("Checkpoint {} does not contain the transported force '{}'".format(path, name))
+            force.t = header['forces'][name]
+            for array_name in FORCE_ARRAYS:
+                if hasattr(force, array_name):
+                    _read_chunked(file, sections[name + '/' + array_name], getattr(force, array_name), verify)
+
+    s._bind()
+    if s.backend.use_cuda:
+        s.copy_to_device()
+        for force in forces.values():
+            force.copy_to_device()
+
+
+class AutoCheckpoint:
+    """
+    Periodic checkpoints, e.g. as callback of core.evolve_leapfrog_n() or after every
+    core.evolve_leapfrog() call.
+
+    :param path: checkpoint file (overwritten every time)
+    :param forces: transported forces to save, {name: TransportedForce}
+    :param every: number of calls between checkpoints
+    :param max_overhead: skip checkpoints if writing would take more than this fraction
+                         of the run time since the last checkpoint (None: never skip)
+    """
+    def __init__(self, path, forces=None, every=1, max_overhead=None):
+        self.path = path
+        self.forces = forces
+        self.every = every
+        self.max_overhead = max_overhead
+
+        self.calls = 0
+        self.count = 0
+        self.write_time = 0.0
+        self.last = time.perf_counter()
+
+    def __call__(self, s):
+        self.calls += 1
+        if self.calls % self.every != 0:
+            return False
+
+        now = time.perf_counter()
+        if self.max_overhead is not None and self.write_time > self.max_overhead * (now - self.last):
+            return False
+
+        save(s, self.path, self.forces)
+        self.last = time.perf_counter()
+        self.write_time = self.last - now
+        self.count += 1
+        return True
+
+
+def _align(offset):
+    return -(-offset // SECTION_ALIGNMENT) * SECTION_ALIGNMENT
+
+
+def _read_header(file):
+    if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a curraun checkpoint: {}".format(file.name))
+    size = int(np.frombuffer(file.read(8), dtype=np.uint64)[0])
+    return json.loads(file.read(size).decode('utf-8'))
+
+
+def _write_chunked(file, array):
+    data = memoryview(np.ascontiguousarray(array)).cast('B')
+    crc = 0
+    for start in range(0, len(data), CHUNK_SIZE):
+        chunk = data[start:start + CHUNK_SIZE]
+        file.write(chunk)
+        crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def _read_chunked(file, entry, array, verify):
+    if list(array.shape) != entry['shape'] or array.dtype.str != entry['dtype']:
+        raise ValueError("Checkpoint section '{}' has shape {} and type {}, expected {} and {}".format(
+            entry['name'], entry['shape'], entry['dtype'], list(array.shape), array.dtype.str))
+    data = memoryview(array).cast('B')
+    file.seek(entry['offset'])
+    crc = 0
+    for start in range(0, len(data), CHUNK_SIZE):
+        chunk = data[start:start + CHUNK_SIZE]
+        if file.readinto(chunk) != len(chunk):
+            raise ValueError("Checkpoint section '{}' is truncated".format(entry['name']))
+        if verify:
+            crc = zlib.crc32(chunk, crc)
+    if verify and crc != entry['crc32']:
+        raise ValueError("Checkpoint section '{}' is corrupted (crc32 mismatch)".format(entry['name']))
@@ -1,76 +1,273 @@
 import numpy as np
-from curraun.numba_target import use_cuda
-if use_cuda:
-    import numba.cuda as cuda
+from curraun.numba_target import get_backend, cuda, my_parallel_fill, my_parallel_zeros
+import curraun.profiling as profiling
 import curraun.leapfrog as leapfrog
 import curraun.leapfrog_cuda as leapfrog_cuda
+import curraun.lattice as lattice
 import curraun.su as su
 
+# Fields of a simulation. Every field has two time slices which are rotated by Simulation.swap().
+FIELDS = ['u', 'pt', 'aeta', 'peta']
+
+# Alignment of the field buffer and of every field inside it [bytes]
+ALIGNMENT = 64
+
+# Alignment and size of transparent huge pages (storage='hugepages') [bytes]
+HUGEPAGE_SIZE = 2 * 1024 ** 2
+
+
 class Simulation:
-    def __init__(self, n, dt, g):
+    """
+    Lattice and fields of one event.
+
+    All fields are views into a single contiguous buffer (Simulation.buffer, bytes):
+
+        header (ALIGNMENT bytes): t, parity, step as float64
+        u[0], u[1], pt[0], pt[1], aeta[0], aeta[1], peta[0], peta[1]
+
+    u0, pt1, aeta0 and peta1 are the time slices with index 'parity', u1, pt0, aeta1 and peta0
+    the other ones. swap() only flips the parity. The buffer can be stored in memory ('numpy'),
+    in memory backed by transparent huge pages ('hugepages', Linux), in a file ('memmap', name
+    is the file name) or in shared memory ('shared_memory', name of the block). Other processes
+    can open an existing buffer with create=False.
+
+    The fields are initialized by the threads that evolve the corresponding sites (see
+    numba_target.my_parallel_fill()), which places the memory on their NUMA nodes.
+
+    With compact_links=True (only SU(3)) the links only store the first two rows of every
+    matrix, the third row is reconstructed on load (see su3.load_link()).
+
+    With normalize_every=k the fields are projected back onto the group and algebra after
+    every k-th time step (see leapfrog.normalize_all()), which removes the round-off errors
+    accumulated in long runs, in particular in single precision.
+
+    The time steps are computed with a second order leapfrog scheme by default. integrator
+    selects a higher order composition of the same momentum and coordinate updates instead
+    ('omelyan', 'forest_ruth', see leapfrog.INTEGRATORS), with the same fields after every step.
+
+    With plaquette_buffer=True every time step also stores the anti-hermitian parts of the
+    plaquettes of u0 (see plaquettes()). The observables of the same step (energy.Energy,
+    tmunu.EnergyMomentumTensor, correlators.Correlators, qhat.TransportedForce) read them
+    instead of multiplying the links again. The buffer is invalidated by swap().
+
+    With transport_buffer=True the time steps also store the forward transported neighbours
+    U_{x, i} A_eta(x + i) U_{x, i}^t of aeta0, which the same observables read (see transports()).
+    """
+    # number of events evolved together (None for a single event, see BatchedSimulation)
+    batch = None
+
+    def __init__(self, n, dt, g, backend=None, neighbour_table=None, tile=None, storage=None, name=None,
+                 create=True, compact_links=False, normalize_every=None, integrator='leapfrog',
+                 plaquette_buffer=False, transport_buffer=False):
         # basic parameters
         self.n = n
         self.dt = dt
         self.g = g
-        nn = self.n ** 2
 
-        # fields (times after evolve())
-        self.u0 = np.zeros((nn, 2, su.GROUP_ELEMENTS), dtype=su.GROUP_TYPE) # U_{x,i}(tau_n)
-        self.u1 = np.zeros((nn, 2, su.GROUP_ELEMENTS), dtype=su.GROUP_TYPE) # U_{x,i}(tau_(n+1))
-        self.pt1 = np.zeros((nn, 2, su.GROUP_ELEMENTS), dtype=su.GROUP_TYPE) # P^i(tau_(n+1/2))
-        self.pt0 = np.zeros((nn, 2, su.GROUP_ELEMENTS), dtype=su.GROUP_TYPE) # P^i(tau_(n-1/2))
+        if compact_links and su.N_C != 3:
+            raise ValueError("Compact links are only available for SU(3)")
+        self.compact_links = compact_links
 
-        self.aeta0 = np.zeros((nn, su.GROUP_ELEMENTS), dtype=su.GROUP_TYPE) # A_eta(tau_n)
-        self.aeta1 = np.zeros((nn, su.GROUP_ELEMENTS), dtype=su.GROUP_TYPE) # A_eta(tau_(n+1))
-        self.peta1 = np.zeros((nn, su.GROUP_ELEMENTS), dtype=su.GROUP_TYPE) # P^{eta}(tau_(n+1/2))
-        self.peta0 = np.zeros((nn, su.GROUP_ELEMENTS), dtype=su.GROUP_TYPE) # P^{eta}(tau_(n-1/2))
+        # backend for all kernels acting on this simulation ('python', 'numba' or 'cuda'),
+        # None selects the default given by MY_NUMBA_TARGET
+        self.backend = get_backend(backend)
 
-        self.data = [self.u0, self.u1, self.pt1, self.pt0, self.aeta0, self.aeta1, self.peta1, self.peta0]
+        # fields (times after evolve()):
+        #   u0: U_{x,i}(tau_n), u1: U_{x,i}(tau_(n+1))
+        #   pt1: P^i(tau_(n+1/2)), pt0: P^i(tau_(n-1/2))
+        #   aeta0: A_eta(tau_n), aeta1: A_eta(tau_(n+1))
+        #   peta1: P^{eta}(tau_(n+1/2)), peta0: P^{eta}(tau_(n-1/2))
+        self.offsets, self.shapes, nbytes = field_layout(self.sites_shape, compact_links)
+        self.storage = storage or 'numpy'
+        self.buffer, self.shm = allocate(nbytes, self.storage, name, create)
+        self._header = self.buffer[:ALIGNMENT].view(np.float64)
+        self._fields = self.field_views(self.buffer)
 
-        self.t = 0.0
+        self.data = list(self._fields.values())
 
         # Memory on the device:
         # - on CPU: contains pointer to Numpy array
         # - for CUDA: contains pointer to device (GPU) memory
-        self.d_u0 = self.u0
-        self.d_u1 = self.u1
-        self.d_pt1 = self.pt1
-        self.d_pt0 = self.pt0
-        self.d_aeta0 = self.aeta0
-        self.d_aeta1 = self.aeta1
-        self.d_peta1 = self.peta1
-        self.d_peta0 = self.peta0
+        self.d_buffer = self.buffer
+        self._d_fields = self._fields
+        self._bind()
+
+        # precomputed nearest neighbours for the stencil kernels (see lattice.neighbour_table()).
+        # Without the table the neighbours are computed from the index (bit masks for powers of two).
+        # By default the table is only used on the CPU, where it saves the integer divisions.
+        if neighbour_table is None:
+            neighbour_table = self.backend.use_numba
+        self.nn = lattice.neighbour_table(n) if neighbour_table else None
+        self.d_nn = self.nn
 
-        self.reset()
+        # tile size of the cache-blocked evolution on the numba backend (see leapfrog.evolve_tiles()),
+        # None walks over the sites linearly
+        self.tile = tile
+
+        # number of time steps between calls of leapfrog.normalize_all() (None: never)
+        self.normalize_every = normalize_every
+
+        # time integration scheme (see leapfrog.INTEGRATORS), the scratch fields of the
+        # composed schemes are allocated on their first step
+        if integrator not in leapfrog.INTEGRATORS:
+            raise ValueError("Unknown integrator: {}".format(integrator))
+        self.integrator = integrator
+        self.scratch = None
+
+        # ah(U_{x, 0, 1}) of u0, written by leapfrog.evolve() (not part of the state, see _bind())
+        self.plaq = None
+        if plaquette_buffer:
+            self.plaq = my_parallel_zeros(self.sites_shape + (su.ALGEBRA_STORAGE_ELEMENTS,), field_type('aeta'),
+                                          int(np.prod(self.sites_shape)), backend=self.backend)
+        self.d_plaq = self.plaq
+
+        # U_{x, i} aeta0(x + i) U_{x, i}^t, written together with plaq
+        self.aeta_fwd = None
+        if transport_buffer:
+            self.aeta_fwd = my_parallel_zeros(self.sites_shape + (2, su.ALGEBRA_STORAGE_ELEMENTS), field_type('aeta'),
+                                              int(np.prod(self.sites_shape)), backend=self.backend)
+        self.d_aeta_fwd = self.aeta_fwd
+
+        if create:
+            self.reset()
+
+    # time variable (stored in the buffer header)
+    @property
+    def t(self):
+        return float(self._header[0])
+
+    @t.setter
+    def t(self, value):
+        self._header[0] = value
+
+    # number of time steps since reset()
+    @property
+    def step(self):
+        return int(self._header[2])
+
+    @step.setter
+    def step(self, value):
+        self._header[2] = value
 
     def reset(self):
-        # time variable
-        self.t = 0.0
+        # the padding between the fields is never written (zero after allocate())
+        self._header[...] = 0
+        self._bind()
+
+        sites = int(np.prod(self.sites_shape))
+        unit = np.array(su.unit())[:self.shapes['u'][-1]]
+        for (name, slot), field in self._fields.items():
+            my_parallel_fill(field, unit if name == 'u' else 0, sites, backend=self.backend)
+
+    @property
+    def sites_shape(self):
+        # leading dimensions of all field arrays
+        return (self.n ** 2,)
+
+    def field_views(self, buffer):
+        """Views of all fields (name, slot) into a host or device buffer with this layout."""
+        views = {}
+        for (name, slot), offset in self.offsets.items():
+            shape = self.shapes[name]
+            dtype = field_type(name)
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            views[name, slot] = buffer[offset:offset + nbytes].view(dtype).reshape(shape)
+        return views
+
+    def _bind(self):
+        p = int(self._header[1])
+        q = 1 - p
+        f = self._fields
+        self.u0, self.u1 = f['u', p], f['u', q]
+        self.pt1, self.pt0 = f['pt', p], f['pt', q]
+        self.aeta0, self.aeta1 = f['aeta', p], f['aeta', q]
+        self.peta1, self.peta0 = f['peta', p], f['peta', q]
+
+        d = self._d_fields
+        self.d_u0, self.d_u1 = d['u', p], d['u', q]
+        self.d_pt1, self.d_pt0 = d['pt', p], d['pt', q]
+        self.d_aeta0, self.d_aeta1 = d['aeta', p], d['aeta', q]
+        self.d_peta1, self.d_peta0 = d['peta', p], d['peta', q]
 
-        self.u0[:,:,:] = 0.0
-        self.u1[:,:,:] = 0.0
-        self.pt1[:, :, :] = 0.0
-        self.pt0[:, :, :] = 0.0
+        # the stored plaquettes and transports belong to the previous u0, aeta0
+        self.cache_valid = False
 
-        self.aeta0[:, :] = 0.0
-        self.aeta1[:, :] = 0.0
-        self.peta1[:, :] = 0.0
-        self.peta0[:, :] = 0.0
+    def plaquettes(self):
+        """
+        Arguments (plaq, cached) of the kernels which can read the stored plaquettes
+        plaq[x] = ah(U_{x, 0, 1}) of u0 (see lattice.clover()). Without valid plaquettes
+        plaq is a placeholder of the same type and cached is False.
+        """
+        if self.plaq is not None and self.cache_valid:
+            return self.d_plaq, True
+        return self.d_aeta0, False
 
-        self.u0[:,:,0] = 1.0
-        self.u1[:,:,0] = 1.0
+    def transports(self):
+        """
+        Arguments (aeta_fwd, cached) of the kernels which can read the stored transports
+        aeta_fwd[x, i] = U_{x, i} aeta0(x + i) U_{x, i}^t (see lattice.transport()). Without
+        valid transports aeta_fwd is a placeholder of the same type and cached is False.
+        """
+        if self.aeta_fwd is not None and self.cache_valid:
+            return self.d_aeta_fwd, True
+        return self.d_pt0, False
 
     def swap(self):
-        self.peta1, self.peta0 = self.peta0, self.peta1
-        self.pt1, self.pt0 = self.pt0, self.pt1
-        self.u1, self.u0 = self.u0, self.u1
-        self.aeta1, self.aeta0 = self.aeta0, self.aeta1
+        # rotate the time slices of all fields (host and device)
+        self._header[1] = 1 - self._header[1]
+        self._bind()
 
-        # Also swap pointers to CUDA device memory
-        self.d_peta1, self.d_peta0 = self.d_peta0, self.d_peta1
-        self.d_pt1, self.d_pt0 = self.d_pt0, self.d_pt1
-        self.d_u1, self.d_u0 = self.d_u0, self.d_u1
-        self.d_aeta1, self.d_aeta0 = self.d_aeta0, self.d_aeta1
+    def set_dt(self, dt):
+        """
+        Change the time step between two steps.
+
+        The momenta pt1, peta1 are staggered with the current time step (see leapfrog.kick()),
+        the time is shifted such that the next step continues from the current u1, aeta1 at
+        t + dt. Observables of the fields u0, pt0, ... are only valid again after the next step.
+        """
+        leapfrog.kick(self, (self.dt - dt) / 2)
+        self.t += self.dt - dt
+        self.dt = dt
+
+    def snapshot(self):
+        """Copy of the whole state (fields, time and buffer rotation), see restore()."""
+        if self.backend.use_cuda:
+            self.copy_to_host()
+        return self.buffer.copy()
+
+    def restore(self, snapshot):
+        self.buffer[...] = snapshot
+        if self.backend.use_cuda:
+            self.copy_to_device()
+        self._bind()
+
+    def save_checkpoint(self, path, forces=None):
+        """Write the state (and optionally transported forces {name: force}) to disk, see curraun.checkpoint."""
+        import curraun.checkpoint as checkpoint
+        checkpoint.save(self, path, forces)
+
+    def load_checkpoint(self, path, forces=None):
+        """Continue from a checkpoint written by save_checkpoint() with the same parameters."""
+        import curraun.checkpoint as checkpoint
+        checkpoint.load(self, path, forces)
+
+    def close(self, unlink=False):
+        """Release the shared memory block (unlink=True removes it, usually by the creating process)."""
+        if self.shm is None:
+            return
+
+        # all views into the shared memory have to be released before closing it
+        self._header = self._header.copy()
+        for name in ['buffer', 'd_buffer', '_fields', '_d_fields', 'data']:
+            setattr(self, name, None)
+        for name in ['u0', 'u1', 'pt1', 'pt0', 'aeta0', 'aeta1', 'peta1', 'peta0']:
+            setattr(self, name, None)
+            setattr(self, 'd_' + name, None)
+
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+        self.shm = None
 
     def get_ngb(self):
         nbytes = 0
@@ -82,28 +279,170 @@ class Simulation:
     #     return self.data.nbytes / 1024.0 ** 3
 
     def copy_to_device(self):
-        self.d_u0 = cuda.to_device(self.u0)
-        self.d_u1 = cuda.to_device(self.u1)
-        self.d_pt1 = cuda.to_device(self.pt1)
-        self.d_pt0 = cuda.to_device(self.pt0)
-        self.d_aeta0 = cuda.to_device(self.aeta0)
-        self.d_aeta1 = cuda.to_device(self.aeta1)
-        self.d_peta1 = cuda.to_device(self.peta1)
-        self.d_peta0 = cuda.to_device(self.peta0)
+        # the whole buffer in a single transfer
+        self.d_buffer = cuda.to_device(self.buffer)
+        self._d_fields = self.field_views(self.d_buffer)
+        self._bind()
+        if self.nn is not None:
+            self.d_nn = cuda.to_device(self.nn)
+        if self.plaq is not None:
+            self.d_plaq = cuda.to_device(self.plaq)
+        if self.aeta_fwd is not None:
+            self.d_aeta_fwd = cuda.to_device(self.aeta_fwd)
 
     def copy_to_host(self):
-        self.d_u0.copy_to_host(self.u0)
-        self.d_u1.copy_to_host(self.u1)
-        self.d_pt1.copy_to_host(self.pt1)
-        self.d_pt0.copy_to_host(self.pt0)
-        self.d_aeta0.copy_to_host(self.aeta0)
-        self.d_aeta1.copy_to_host(self.aeta1)
-        self.d_peta1.copy_to_host(self.peta1)
-        self.d_peta0.copy_to_host(self.peta0)
-
-
-def evolve_leapfrog(s, stream=None):
-    s.swap()
-    s.t += s.dt
-    leapfrog.evolve(s, stream)
-    # leapfrog.normalize_all(s)
+        # time and parity in the header are only kept on the host
+        self.d_buffer[ALIGNMENT:].copy_to_host(self.buffer[ALIGNMENT:])
+
+
+def field_layout(sites, compact_links=False):
+    """Byte offsets of all fields (name, slot) in the buffer, their shapes and the buffer size."""
+    shapes = {
+        'u': sites + (2, su.LINK_COMPACT_ELEMENTS if compact_links else su.GROUP_ELEMENTS),
+        'pt': sites + (2, su.ALGEBRA_STORAGE_ELEMENTS),
+        'aeta': sites + (su.ALGEBRA_STORAGE_ELEMENTS,),
+        'peta': sites + (su.ALGEBRA_STORAGE_ELEMENTS,),
+    }
+    offsets = {}
+    offset = ALIGNMENT  # header
+    for name in FIELDS:
+        nbytes = int(np.prod(shapes[name])) * np.dtype(field_type(name)).itemsize
+        for slot in range(2):
+            offsets[name, slot] = offset
+            offset += -(-nbytes // ALIGNMENT) * ALIGNMENT
+    return offsets, shapes, offset
+
+
+def field_type(name):
+    # links are group elements, all other fields are algebra-valued (see su.ALGEBRA_STORAGE)
+    return su.GROUP_STORAGE_TYPE if name == 'u' else su.ALGEBRA_STORAGE_TYPE
+
+
+def allocate(nbytes, storage='numpy', name=None, create=True):
+    """Aligned byte buffer (filled with zeros) and the shared memory block (or None) holding it."""
+    if storage == 'numpy':
+        raw = np.zeros(nbytes + ALIGNMENT, dtype=np.uint8)
+        start = -raw.ctypes.data % ALIGNMENT
+        return raw[start:start + nbytes], None
+    if storage == 'hugepages':
+        import mmap
+        # private anonymous mapping: the pages are only allocated on first touch
+        size = -(-nbytes // HUGEPAGE_SIZE) * HUGEPAGE_SIZE
+        mapping = mmap.mmap(-1, size + HUGEPAGE_SIZE, flags=mmap.MAP_PRIVATE)
+        raw = np.frombuffer(mapping, dtype=np.uint8)
+        start = -raw.ctypes.data % HUGEPAGE_SIZE
+        if hasattr(mmap, 'MADV_HUGEPAGE'):
+            mapping.madvise(mmap.MADV_HUGEPAGE, start, size)
+        return raw[start:start + nbytes], None
+    if storage == 'memmap':
+        return np.memmap(name, dtype=np.uint8, mode='w+' if create else 'r+', shape=(nbytes,)), None
+    if storage == 'shared_memory':
+        from multiprocessing import shared_memory, resource_tracker
+        shm = shared_memory.SharedMemory(name=name, create=create, size=nbytes if create else 0)
+        if not create:
+            # only the creating process may remove the block (the tracker would unlink it at exit)
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return np.ndarray((nbytes,), dtype=np.uint8, buffer=shm.buf), shm
+    raise ValueError("Unsupported storage: {}".format(storage))
+
+
+class BatchedSimulation(Simulation):
+    """
+    Several independent events on lattices of the same size, evolved together.
+
+    The fields are stored with shape (batch, n ** 2, ...) and every kernel launch runs over
+    all batch * n ** 2 sites. This keeps all cores (or the GPU) busy for small lattices.
+
+    Observables and transported forces accept a BatchedSimulation and return one
+    result per event. Single events can be accessed with event(i).
+    """
+    def __init__(self, batch, n, dt, g, backend=None, neighbour_table=None, storage=None, name=None, create=True,
+                 compact_links=False, normalize_every=None, plaquette_buffer=False, transport_buffer=False):
+        self.batch = batch
+        super().__init__(n, dt, g, backend, neighbour_table, storage=storage, name=name, create=create,
+                         compact_links=compact_links, normalize_every=normalize_every,
+                         plaquette_buffer=plaquette_buffer, transport_buffer=transport_buffer)
+
+    @property
+    def sites_shape(self):
+        return (self.batch, self.n ** 2)
+
+    def event(self, i):
+        """
+        Simulation object for event i whose fields are views into the batch.
+
+        The views are only valid until the next time step (which swaps the buffers)
+        or the next copy_to_device().
+        """
+        s = Simulation.__new__(Simulation)
+        s.n = self.n
+        s.dt = self.dt
+        s.g = self.g
+        s.backend = self.backend
+        s._header = self._header
+        s.nn = self.nn
+        s.d_nn = self.d_nn
+        s.tile = self.tile
+        s.compact_links = self.compact_links
+        s.normalize_every = self.normalize_every
+        s.integrator = self.integrator
+        s.scratch = None
+        s.plaq = None if self.plaq is None else self.plaq[i]
+        s.d_plaq = None if self.d_plaq is None else self.d_plaq[i]
+        s.aeta_fwd = None if self.aeta_fwd is None else self.aeta_fwd[i]
+        s.d_aeta_fwd = None if self.d_aeta_fwd is None else self.d_aeta_fwd[i]
+        s.cache_valid = self.cache_valid
+        for name in ['u0', 'u1', 'pt1', 'pt0', 'aeta0', 'aeta1', 'peta1', 'peta0']:
+            setattr(s, name, getattr(self, name)[i])
+            setattr(s, 'd_' + name, getattr(self, 'd_' + name)[i])
+        s.data = [s.u0, s.u1, s.pt1, s.pt0, s.aeta0, s.aeta1, s.peta1, s.peta0]
+        return s
+
+
+def evolve_leapfrog(s, stream=None, diagnostics=None):
+    """
+    One time step. With diagnostics (see diagnostics.Diagnostics) the step also computes the
+    energy density components at the new time s.t (and optionally the Gauss violation) in the
+    same sweep over the lattice, which replaces a separate energy.Energy(s).compute().
+    """
+    with profiling.region('evolve_leapfrog'):
+        s.swap()
+        s.t += s.dt
+        leapfrog.evolve(s, stream, diagnostics)
+        s.step += 1
+        if s.normalize_every and s.step % s.normalize_every == 0:
+            leapfrog.normalize_all(s, stream)
+
+
+def evolve_leapfrog_n(s, steps, callback=None, every=None, stream=None):
+    """
+    Perform 'steps' leapfrog steps, equivalent to calling evolve_leapfrog() 'steps' times.
+
+    On the numba backend the steps run in a single compiled function, which avoids the
+    python overhead of every step on small lattices.
+
+    :param s: Simulation object
+    :param steps: number of time steps
+    :param callback: optional function callback(s), called after every 'every' steps
+    :param every: number of steps between calls of the callback (default: once at the end)
+
+    The steps are split at the normalizations requested by s.normalize_every.
+    """
+    if callback is None or every is None:
+        every = steps
+    done = 0
+    next_callback = every
+    while done < steps:
+        chunk = min(next_callback, steps) - done
+        if s.normalize_every:
+            chunk = min(chunk, s.normalize_every - s.step % s.normalize_every)
+        with profiling.region('evolve_leapfrog_n'):
+            leapfrog.evolve_n(s, chunk, stream)
+            s.step += chunk
+            if s.normalize_every and s.step % s.normalize_every == 0:
+                leapfrog.normalize_all(s, stream)
+        done += chunk
+        if done == next_callback or done == steps:
+            next_callback += every
+            if callback is not None:
+                callback(s)
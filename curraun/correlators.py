@@ -1,32 +1,34 @@
-from curraun.numba_target import myjit, my_parallel_loop, use_cuda
+from curraun.numba_target import myjit, my_parallel_loop, site_kernel, get_backend, cuda
 import numpy as np
 import curraun.lattice as l
 import curraun.su as su
-if use_cuda:
-    import numba.cuda as cuda
 
 """
     A module for computing E_z and B_z correlation functions
 """
 
 @myjit
-def compute_Bz(xi, n, u0, u1, aeta0, aeta1, pt0, pt1, peta0, peta1):
+def compute_Bz(xi, n, nn, u0, u1, aeta0, aeta1, pt0, pt1, peta0, peta1, plaq, cached):
+    if cached:
+        # from the stored plaquettes (see core.Simulation.plaquettes())
+        return su.mul_s(l.clover(plaq, u0, xi, n, nn), -0.25)
+
     bz = su.zero()
 
     # quadratically accurate +Bz
-    b1 = l.plaq(u0, xi, 0, 1, 1, 1, n)
+    b1 = l.plaq(u0, xi, 0, 1, 1, 1, n, nn)
     b2 = su.ah(b1)
     bz = l.add_mul(bz, b2, -0.25)
 
-    b1 = l.plaq(u0, xi, 0, 1, 1, -1, n)
+    b1 = l.plaq(u0, xi, 0, 1, 1, -1, n, nn)
     b2 = su.ah(b1)
     bz = l.add_mul(bz, b2, +0.25)
 
-    b1 = l.plaq(u0, xi, 1, 0, 1, -1, n)
+    b1 = l.plaq(u0, xi, 1, 0, 1, -1, n, nn)
     b2 = su.ah(b1)
     bz = l.add_mul(bz, b2, -0.25)
 
-    b1 = l.plaq(u0, xi, 1, 0, -1, -1, n)
+    b1 = l.plaq(u0, xi, 1, 0, -1, -1, n, nn)
     b2 = su.ah(b1)
     bz = l.add_mul(bz, b2, +0.25)
 
@@ -34,12 +36,12 @@ def compute_Bz(xi, n, u0, u1, aeta0, aeta1, pt0, pt1, peta0, peta1):
 
 
 @myjit
-def compute_Ez(xi, n, u0, u1, aeta0, aeta1, pt0, pt1, peta0, peta1):
+def compute_Ez(xi, n, nn, u0, u1, aeta0, aeta1, pt0, pt1, peta0, peta1, plaq, cached):
     ez = su.zero()
 
     # quadratically accurate +E_z
-    ez = l.add_mul(ez, peta1[xi], 0.5)
-    ez = l.add_mul(ez, peta0[xi], 0.5)
+    ez = l.add_mul(ez, su.load_algebra(peta1[xi]), 0.5)
+    ez = l.add_mul(ez, su.load_algebra(peta0[xi]), 0.5)
 
     return ez
 
@@ -51,7 +53,7 @@ class Correlators:
         self.corr = np.zeros(s.n // 2,  dtype=su.GROUP_TYPE_REAL)
         self.d_corr = self.corr
 
-        if use_cuda:
+        if s.backend.use_cuda:
             self.copy_to_device()
 
     def copy_to_device(self):
@@ -64,17 +66,20 @@ class Correlators:
         s = self.s
 
         self.corr[:] = 0.0
-        if use_cuda:
+        if s.backend.use_cuda:
             self.copy_to_device()
 
+        # plaquettes of u0 stored by the last time step (see core.Simulation.plaquettes())
+        plaq, cached = s.plaquettes()
+
         if mode == 'Ez':
-            my_parallel_loop(compute_Ez_correlation_kernel, s.n * s.n, s.n, s.d_u0, s.d_u1, s.d_aeta0, s.d_aeta1, s.d_pt0, s.d_pt1, s.d_peta0, s.d_peta1, self.d_corr)
+            my_parallel_loop(compute_Ez_correlation_kernel, s.n * s.n, s.n, s.d_nn, s.d_u0, s.d_u1, s.d_aeta0, s.d_aeta1, s.d_pt0, s.d_pt1, s.d_peta0, s.d_peta1, plaq, cached, self.d_corr, backend=s.backend)
         elif mode == 'Bz':
-            my_parallel_loop(compute_Bz_correlation_kernel, s.n * s.n, s.n, s.d_u0, s.d_u1, s.d_aeta0, s.d_aeta1, s.d_pt0, s.d_pt1, s.d_peta0, s.d_peta1, self.d_corr)
+            my_parallel_loop(compute_Bz_correlation_kernel, s.n * s.n, s.n, s.d_nn, s.d_u0, s.d_u1, s.d_aeta0, s.d_aeta1, s.d_pt0, s.d_pt1, s.d_peta0, s.d_peta1, plaq, cached, self.d_corr, backend=s.backend)
         else:
             print("Correlators: mode '{}' is not implemented.".format(mode))
 
-        if use_cuda:
+        if s.backend.use_cuda:
             self.copy_to_host()
 
         # normalize, 2 * n ** 2 contributions per distance r
@@ -83,18 +88,19 @@ class Correlators:
         return self.corr
 
 
+@site_kernel
 @myjit
-def compute_Ez_correlation_kernel(xi, n, u0, u1, aeta0, aeta1, pt1, pt0, peta1, peta0, corr):
+def compute_Ez_correlation_kernel(xi, n, nn, u0, u1, aeta0, aeta1, pt1, pt0, peta1, peta0, plaq, cached, corr):
     Ux = su.unit()
     Uy = su.unit()
 
-    F = compute_Ez(xi, n, u0, u1, aeta0, aeta1, pt1, pt0, peta1, peta0)
+    F = compute_Ez(xi, n, nn, u0, u1, aeta0, aeta1, pt1, pt0, peta1, peta0, plaq, cached)
 
     for r in range(n // 2):
         # x shifts
         xs_x = l.shift(xi, 0, r, n)
 
-        Fs_x = compute_Ez(xs_x, n, u0, u1, aeta0, aeta1, pt1, pt0, peta1, peta0)
+        Fs_x = compute_Ez(xs_x, n, nn, u0, u1, aeta0, aeta1, pt1, pt0, peta1, peta0, plaq, cached)
         Fs_x = l.act(Ux, Fs_x)
         correlation = su.tr(su.mul(F, su.dagger(Fs_x))).real
 
@@ -103,7 +109,7 @@ def compute_Ez_correlation_kernel(xi, n, u0, u1, aeta0, aeta1, pt1, pt0, peta1,
         # y shifts
         xs_y = l.shift(xi, 1, r, n)
 
-        Fs_y = compute_Ez(xs_y, n, u0, u1, aeta0, aeta1, pt1, pt0, peta1, peta0)
+        Fs_y = compute_Ez(xs_y, n, nn, u0, u1, aeta0, aeta1, pt1, pt0, peta1, peta0, plaq, cached)
 
         Fs_y = l.act(Uy, Fs_y)
         correlation = su.tr(su.mul(F, su.dagger(Fs_y))).real
@@ -111,22 +117,23 @@ def compute_Ez_correlation_kernel(xi, n, u0, u1, aeta0, aeta1, pt1, pt0, peta1,
         cuda.atomic.add(corr, r, correlation)
 
         # update Ux, Uy
-        Ux = su.mul(Ux, u0[xs_x, 0])
-        Uy = su.mul(Uy, u0[xs_y, 1])
+        Ux = su.mul(Ux, su.load_link(u0[xs_x, 0]))
+        Uy = su.mul(Uy, su.load_link(u0[xs_y, 1]))
 
 
+@site_kernel
 @myjit
-def compute_Bz_correlation_kernel(xi, n, u0, u1, aeta0, aeta1, pt1, pt0, peta1, peta0, corr):
+def compute_Bz_correlation_kernel(xi, n, nn, u0, u1, aeta0, aeta1, pt1, pt0, peta1, peta0, plaq, cached, corr):
     Ux = su.unit()
     Uy = su.unit()
 
-    F = compute_Bz(xi, n, u0, u1, aeta0, aeta1, pt1, pt0, peta1, peta0)
+    F = compute_Bz(xi, n, nn, u0, u1, aeta0, aeta1, pt1, pt0, peta1, peta0, plaq, cached)
 
     for r in range(n // 2):
         # x shifts
         xs_x = l.shift(xi, 0, r, n)
 
-        Fs_x = compute_Bz(xs_x, n, u0, u1, aeta0, aeta1, pt1, pt0, peta1, peta0)
+        Fs_x = compute_Bz(xs_x, n, nn, u0, u1, aeta0, aeta1, pt1, pt0, peta1, peta0, plaq, cached)
         Fs_x = l.act(Ux, Fs_x)
         correlation = su.tr(su.mul(F, su.dagger(Fs_x))).real
 
@@ -135,7 +142,7 @@ def compute_Bz_correlation_kernel(xi, n, u0, u1, aeta0, aeta1, pt1, pt0, peta1,
         # y shifts
         xs_y = l.shift(xi, 1, r, n)
 
-        Fs_y = compute_Bz(xs_y, n, u0, u1, aeta0, aeta1, pt1, pt0, peta1, peta0)
+        Fs_y = compute_Bz(xs_y, n, nn, u0, u1, aeta0, aeta1, pt1, pt0, peta1, peta0, plaq, cached)
 
         Fs_y = l.act(Uy, Fs_y)
         correlation = su.tr(su.mul(F, su.dagger(Fs_y))).real
@@ -143,8 +150,8 @@ def compute_Bz_correlation_kernel(xi, n, u0, u1, aeta0, aeta1, pt1, pt0, peta1,
         cuda.atomic.add(corr, r, correlation)
 
         # update Ux, Uy
-        Ux = su.mul(Ux, u0[xs_x, 0])
-        Uy = su.mul(Uy, u0[xs_y, 1])
+        Ux = su.mul(Ux, su.load_link(u0[xs_x, 0]))
+        Uy = su.mul(Uy, su.load_link(u0[xs_y, 1]))
 
 
 """
@@ -152,27 +159,29 @@ def compute_Bz_correlation_kernel(xi, n, u0, u1, aeta0, aeta1, pt1, pt0, peta1,
 """
 
 
-def wilson_correlator(v, n):
+def wilson_correlator(v, n, backend=None):
+    backend = get_backend(backend)
     v_corr = np.zeros(n ** 2, dtype=su.GROUP_TYPE_REAL)
 
     d_v_corr = v_corr
     d_v = v
-    if use_cuda:
+    if backend.use_cuda:
         d_v_corr = cuda.to_device(v_corr)
         d_v = cuda.to_device(v)
 
-    if use_cuda:
-        my_parallel_loop(wilson_correlator_cuda_kernel, n ** 2, n, d_v, d_v_corr)
+    if backend.use_cuda:
+        my_parallel_loop(wilson_correlator_cuda_kernel, n ** 2, n, d_v, d_v_corr, backend=backend)
     else:
-        my_parallel_loop(wilson_correlator_kernel, n ** 2, n, d_v, d_v_corr)
+        my_parallel_loop(wilson_correlator_kernel, n ** 2, n, d_v, d_v_corr, backend=backend)
 
-    if use_cuda:
+    if backend.use_cuda:
         d_v_corr.copy_to_host(v_corr)
 
     d_A = su.N_C ** 2 - 1
     v_corr /= n ** 2 * d_A
     return v_corr.reshape(n, n)
 
+@site_kernel
 @myjit
 def wilson_correlator_cuda_kernel(xi, n, v, v_corr):
     vx = v[xi]
@@ -187,6 +196,7 @@ def wilson_correlator_cuda_kernel(xi, n, v, v_corr):
         correlation_adj = correlation_fund.real ** 2 + correlation_fund.imag ** 2 - 1.0
         cuda.atomic.add(v_corr, ri, correlation_adj)
 
+@site_kernel
 @myjit
 def wilson_correlator_kernel(xi, n, v, v_corr):
     vx = v[xi]
@@ -0,0 +1,280 @@
+"""
+    Domain decomposition of a simulation across several processes on one node.
+
+    Usage:
+
+        ds = decomposition.DecomposedSimulation(n, dt, g, workers=4)
+        initial.init(ds.s, va, vb)          # in the main process, on the shared fields
+
+        en = energy.Energy(ds.s)
+        t_munu = tmunu.EnergyMomentumTensor(ds.s)
+        for t in range(steps):
+            ds.evolve()
+            ds.compute_energy(en)           # same results as en.compute()
+        ds.compute_tmunu(t_munu)            # same results as t_munu.compute()
+        ds.close()
+
+    The workers are started with the 'spawn' method: scripts have to protect their main code
+    with 'if __name__ == "__main__":'. Gauge group and precision are taken from the environment
+    as usual.
+
+    The lattice is split into strips of rows (x = const), one per worker process. Every worker
+    owns the sites n * x0 ... n * x1 - 1 of its strip and runs the site kernels of the numba
+    backend (with its own threads) only on these sites. All fields stay in one
+    multiprocessing.shared_memory block (see core.Simulation, storage='shared_memory'): the
+    halo rows x0 - 1 and x1 of the neighbouring strips are read directly from their owners,
+    so the halo exchange reduces to a barrier between the time steps.
+
+    The workers initialize the fields of their strips themselves (first touch), so that
+    with a pinned worker per NUMA node (affinity) every strip is local to its worker.
+    Observables are computed as partial reductions per strip and summed up by the main process.
+"""
+import os
+import traceback
+import multiprocessing
+
+import numpy as np
+
+from curraun.numba_target import mynonparjit, site_kernel, my_parallel_loop, my_parallel_reduce, my_parallel_fill, \
+    get_backend
+import curraun.core as core
+import curraun.su as su
+import curraun.leapfrog as leapfrog
+import curraun.energy as energy
+import curraun.tmunu as tmunu
+
+
+class DecomposedSimulation:
+    """
+    Simulation whose time steps and observables are computed by several worker processes.
+
+    :param n: lattice size
+    :param dt: time step
+    :param g: coupling constant
+    :param workers: number of worker processes (strips of rows)
+    :param threads: numba threads per worker (default: all threads divided by the workers)
+    :param affinity: optional list with the set of CPUs of every worker (os.sched_setaffinity())
+    :param name: name of the shared memory block (default: chosen by the system)
+    :param compact_links: see core.Simulation
+    :param normalize_every: see core.Simulation
+    """
+    def __init__(self, n, dt, g, workers, threads=None, affinity=None, name=None, compact_links=False,
+                 normalize_every=None):
+        import numba
+
+        if workers > n:
+            raise ValueError("More workers ({}) than rows of the lattice ({})".format(workers, n))
+        # the workers run the site kernels on the numba backend
+        get_backend('numba')
+
+        # the block is created here and initialized by the workers (see reset())
+        _, _, nbytes = core.field_layout((n ** 2,), compact_links)
+        self.buffer, self.shm = core.allocate(nbytes, 'shared_memory', name, True)
+        self.name = self.shm.name
+        self.s = core.Simulation(n, dt, g, backend='numba', storage='shared_memory', name=self.name, create=False,
+                                 compact_links=compact_links, normalize_every=normalize_every)
+
+        # first and last row (exclusive) of every strip
+        self.rows = [(n * w // workers, n * (w + 1) // workers) for w in range(workers)]
+        if threads is None:
+            threads = max(1, numba.config.NUMBA_NUM_THREADS // workers)
+
+        self.t_munu_shm = None
+
+        context = multiprocessing.get_context('spawn')
+        self.results = context.Queue()
+        self.commands = []
+        self.processes = []
+        barrier = context.Barrier(workers)
+        for w in range(workers):
+            commands = context.Queue()
+            cpus = affinity[w] if affinity is not None else None
+            process = context.Process(target=_worker, args=(w, self.name, n, dt, g, compact_links, normalize_every,
+                                                            self.rows[w], threads, cpus, commands, self.results,
+                                                            barrier), daemon=True)
+            process.start()
+            self.commands.append(commands)
+            self.processes.append(process)
+
+        self.reset()
+        _track(self.shm)
+
+    def reset(self):
+        """Same as Simulation.reset(), every worker initializes its own strip."""
+        self.s._header[...] = 0
+        self._command('reset')
+        self.s._bind()
+
+    def evolve(self, steps=1):
+        """Perform 'steps' leapfrog steps, same as core.evolve_leapfrog_n(self.s, steps)."""
+        self._command('evolve', steps)
+
+        # same time steps and buffers as in the workers
+        s = self.s
+        for step in range(steps):
+            s.swap()
+            s.t += s.dt
+            s.step += 1
+
+    def compute_energy(self, en):
+        """Compute the means of energy.Energy(self.s) (en.fields is ignored)."""
+        sums = np.sum(self._command('energy'), axis=0)
+        en.set_sums(sums)
+
+    def compute_tmunu(self, t_munu):
+        """Compute the field of tmunu.EnergyMomentumTensor(self.s), every worker writes its strip."""
+        if self.t_munu_shm is None:
+            from multiprocessing import shared_memory
+            self.t_munu_shm = shared_memory.SharedMemory(create=True, size=t_munu.t_munu.nbytes)
+        self._command('tmunu', self.t_munu_shm.name, t_munu.t_munu.dtype.str)
+        _track(self.t_munu_shm)
+        t_munu.t_munu[...] = np.ndarray(t_munu.t_munu.shape, dtype=t_munu.t_munu.dtype, buffer=self.t_munu_shm.buf)
+
+    def close(self):
+        """Stop the workers and remove the shared memory."""
+        if self.shm is None:
+            return
+        for commands in self.commands:
+            commands.put(('close', None, ()))
+        for process in self.processes:
+            process.join()
+
+        self.s.close()
+        self.buffer = None
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+        if self.t_munu_shm is not None:
+            self.t_munu_shm.close()
+            self.t_munu_shm.unlink()
+            self.t_munu_shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def _command(self, command, *args):
+        # every command carries the time and buffer rotation of the main process
+        header = self.s._header[:3].tolist()
+        for commands in self.commands:
+            commands.put((command, header, args))
+
+        results = [None] * len(self.commands)
+        errors = []
+        for _ in self.commands:
+            worker, status, result = self.results.get()
+            if status == 'error':
+                errors.append("Worker {}:\n{}".format(worker, result))
+            results[worker] = result
+        if errors:
+            raise RuntimeError("Command '{}' failed\n{}".format(command, "\n".join(errors)))
+        return results
+
+
+def _track(shm):
+    # The workers share the resource tracker of the main process, attaching to a block
+    # (create=False, see core.allocate()) removed it from the tracker.
+    # Register it again (after all workers attached) so that it is cleaned up by unlink().
+    from multiprocessing import resource_tracker
+    resource_tracker.register(shm._name, 'shared_memory')
+
+
+def _worker(index, name, n, dt, g, compact_links, normalize_every, rows, threads, cpus, commands, results, barrier):
+    import numba
+
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+    numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+
+    s = core.Simulation(n, dt, g, backend='numba', storage='shared_memory', name=name, create=False,
+                        compact_links=compact_links, normalize_every=normalize_every)
+    # time and buffer rotation are private (sent with every command)
+    s._header = s._header.copy()
+
+    offset = rows[0] * n
+    sites = (rows[1] - rows[0]) * n
+    t_munu_blocks = {}
+
+    while True:
+        command, header, args = commands.get()
+        if command == 'close':
+            break
+        try:
+            s._header[:3] = header
+            s._bind()
+            result = None
+            if command == 'reset':
+                unit = np.array(su.unit())[:s.shapes['u'][-1]]
+                for (field_name, slot), field in s._fields.items():
+                    my_parallel_fill(field[offset:offset + sites], unit if field_name == 'u' else 0, sites,
+                                     backend=s.backend)
+            elif command == 'evolve':
+                for step in range(args[0]):
+                    s.swap()
+                    s.t += s.dt
+                    _evolve_strip(s, offset, sites)
+                    s.step += 1
+                    if s.normalize_every and s.step % s.normalize_every == 0:
+                        my_parallel_loop(normalize_all_strip_kernel, sites, offset, s.u1, s.pt1, s.aeta1, s.peta1,
+                                         backend=s.backend)
+                    # the neighbouring strips read the halo rows in the next step
+                    barrier.wait()
+            elif command == 'energy':
+                result = my_parallel_reduce(energy_strip_kernel, sites, offset, n, s.nn, s.u0, s.u1, s.pt1, s.aeta0,
+                                            s.aeta1, s.peta1, s.dt, s.dt / 2.0, s.t, n_outputs=4, backend=s.backend)
+            elif command == 'tmunu':
+                block_name, dtype = args
+                if block_name not in t_munu_blocks:
+                    from multiprocessing import shared_memory, resource_tracker
+                    block = shared_memory.SharedMemory(name=block_name)
+                    resource_tracker.unregister(block._name, 'shared_memory')
+                    t_munu_blocks[block_name] = block
+                t_munu = np.ndarray((n ** 2, 10), dtype=dtype, buffer=t_munu_blocks[block_name].buf)
+                my_parallel_loop(tmunu_strip_kernel, sites, offset, n, s.nn, s.u0, s.aeta0, s.peta1, s.peta0, s.pt1,
+                                 s.pt0, s.t, t_munu, backend=s.backend)
+                del t_munu
+            results.put((index, 'ok', result))
+        except Exception:
+            # release the other workers waiting at the barrier
+            barrier.abort()
+            results.put((index, 'error', traceback.format_exc()))
+
+    s.close()
+    for block in t_munu_blocks.values():
+        block.close()
+
+
+def _evolve_strip(s, offset, sites):
+    my_parallel_loop(evolve_strip_kernel, sites, offset, s.u0, s.u1, s.pt1, s.pt0, s.aeta0, s.aeta1, s.peta1,
+                     s.peta0, s.dt, s.dt * 0.5, s.t, s.n, s.nn, backend=s.backend)
+
+
+# Site kernels on the sites offset ... offset + sites - 1 of a strip
+
+@site_kernel
+@mynonparjit
+def evolve_strip_kernel(i, offset, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, dth, t, n, nn):
+    leapfrog.evolve_kernel(offset + i, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, dth, t, n, nn)
+
+
+@site_kernel
+@mynonparjit
+def normalize_all_strip_kernel(i, offset, u1, pt1, aeta1, peta1):
+    leapfrog.normalize_all_kernel(offset + i, u1, pt1, aeta1, peta1)
+
+
+@site_kernel
+@mynonparjit
+def energy_strip_kernel(i, offset, n, nn, u0, u1, pt1, aeta0, aeta1, peta1, dt, dth, t):
+    # without stored plaquettes and transports (placeholders aeta0, pt1, see core.Simulation.plaquettes())
+    return energy.energy_kernel(offset + i, n, nn, u0, u1, pt1, aeta0, aeta1, peta1, dt, dth, t, aeta0, False,
+                                pt1, False)
+
+
+@site_kernel
+@mynonparjit
+def tmunu_strip_kernel(i, offset, n, nn, u0, aeta0, peta1, peta0, pt1, pt0, tau, t_munu):
+    tmunu.tmunu_kernel(offset + i, n, nn, u0, aeta0, peta1, peta0, pt1, pt0, tau, t_munu, aeta0, False, pt0, False)
@@ -0,0 +1,67 @@
+"""
+    Diagnostics accumulated by the leapfrog step itself (see core.evolve_leapfrog(s, diagnostics=...)):
+    the energy density components and optionally the violation of the Gauss constraint, without
+    a second sweep over the lattice after the step.
+
+    Usage:
+
+        diag = diagnostics.Diagnostics(s, gauss=True)
+        for step in range(steps):
+            if step % measure_every == 0:
+                core.evolve_leapfrog(s, diagnostics=diag)
+                print(diag.t, diag.energy_density, diag.gauss_max)
+            else:
+                core.evolve_leapfrog(s)
+
+    The step only reads the fields at its own site and the neighbours of u0, aeta0, pt0, peta0.
+    The diagnostics are therefore taken at the time t of the step (s.t), not at t + dt / 2 as
+    energy.Energy: the magnetic components from u0, aeta0 at t, the electric components as the
+    average of the squared momenta at t - dt / 2 (pt0, peta0) and t + dt / 2 (pt1, peta1), i.e.
+    the same averaging as energy.Energy shifted by half a step. The Gauss violation is the one
+    of pt0, peta0 at t - dt / 2, i.e. gauss.Gauss(s).compute() of the previous step.
+"""
+import numpy as np
+
+
+class Diagnostics:
+    def __init__(self, s, gauss=False):
+        """
+        :param s: Simulation object (single event, leapfrog integrator)
+        :param gauss: also compute the total and maximum violation |G(x)|^2 of the Gauss constraint
+        """
+        self.s = s
+        self.gauss = gauss
+
+        # time of the last step with diagnostics
+        self.t = None
+
+        self.EL_mean = 0.0
+        self.BL_mean = 0.0
+        self.ET_mean = 0.0
+        self.BT_mean = 0.0
+
+        self.energy_density = 0.0
+        self.pL = 0.0
+        self.pT = 0.0
+
+        # sum, mean and maximum of |G(x)|^2 (only with gauss=True)
+        self.gauss_total = 0.0
+        self.gauss_mean = 0.0
+        self.gauss_max = 0.0
+
+    def set_sums(self, sums):
+        """Set the results from the sums of leapfrog.evolve_diagnostics_kernel() (EL, BL, ET, BT, |G|^2, max |G|^2)."""
+        s = self.s
+        self.t = s.t
+        sums = np.asarray(sums)
+        self.EL_mean, self.BL_mean, self.ET_mean, self.BT_mean = sums[:4] / s.n ** 2 / s.g ** 2
+
+        # compute density and pressures (as energy.Energy)
+        self.energy_density = (self.EL_mean + self.BL_mean + self.ET_mean + self.BT_mean) / s.t
+        self.pL = (self.ET_mean + self.BT_mean - (self.EL_mean + self.BL_mean)) / s.t
+        self.pT = (self.EL_mean + self.BL_mean) / s.t
+
+        if self.gauss:
+            self.gauss_total = sums[4]
+            self.gauss_mean = sums[4] / s.n ** 2
+            self.gauss_max = sums[5]
@@ -0,0 +1,310 @@
+"""
+    Distributed simulations with MPI (optional dependency: mpi4py).
+
+    Usage (e.g. mpirun -n 4 python script.py):
+
+        import curraun.distributed as distributed
+
+        s = distributed.DistributedSimulation(n, dt, g)    # one block of the lattice per rank
+        va = distributed.wilson(s, mu, m, uv, num_sheets)
+        vb = distributed.wilson(s, mu, m, uv, num_sheets)
+        distributed.init(s, va, vb)
+
+        en = energy.Energy(s)
+        for t in range(steps):
+            distributed.evolve_leapfrog(s)
+            distributed.compute_energy(s, en)               # same means as en.compute(), on all ranks
+        t_munu, means = distributed.compute_tmunu(s)
+
+        u0 = distributed.gather(s, s.u0)                    # (n ** 2, ...) array on rank 0, None elsewhere
+
+    The ranks form a periodic 2D cartesian grid (MPI.Compute_dims()). Every rank owns a block
+    x0 <= x < x1, y0 <= y < y1 of the n x n lattice. Its fields have (lx + 2) * (ly + 2) sites
+    (lx = x1 - x0, ly = y1 - y0): the block with a halo of one site on every side, corners
+    included, stored row by row. The neighbour table s.nn points into the padded block.
+
+    The site kernels run with the same compiled drivers as in the serial simulation on all sites
+    of the padded block (the kernels are compiled with fastmath, a different driver may round
+    differently). The values computed on the halo are overwritten by the halo exchange or
+    discarded. Only the reductions are restricted to the inner sites of the block
+    (my_parallel_reduce(..., indices=s.inner)).
+
+    After every time step the halos of u, aeta and pt are exchanged with the neighbouring ranks
+    (rows first, then the columns including the halo rows, which fills the corners). Every site
+    is computed with the same operations as in the serial simulation, so the fields are
+    bit-identical to core.evolve_leapfrog() on the whole lattice. The Wilson lines use the
+    random numbers of mv.wilson() in the same order (drawn on rank 0) and a distributed FFT
+    (slabs of rows, transposed with alltoall) for the Poisson equation.
+
+    Only the numba and python backends are supported. The functions of the other modules
+    (core.evolve_leapfrog(), Energy.compute(), ...) must not be called on a DistributedSimulation:
+    they loop over n ** 2 sites and do not exchange the halos.
+"""
+import math
+
+import numpy as np
+
+from curraun.numba_target import my_parallel_loop, my_parallel_reduce
+import curraun.core as core
+import curraun.profiling as profiling
+import curraun.leapfrog as leapfrog
+import curraun.initial as initial
+import curraun.tmunu as tmunu
+import curraun.energy as energy
+import curraun.mv as mv
+import curraun.su as su
+
+
+class DistributedSimulation(core.Simulation):
+    """
+    Block of the lattice owned by one MPI rank.
+
+    :param n: lattice size
+    :param dt: time step
+    :param g: coupling constant
+    :param comm: MPI communicator (default: MPI.COMM_WORLD)
+    :param dims: number of blocks in x and y (default: MPI.Compute_dims(comm.size, 2))
+    :param backend: 'numba' or 'python' (default: MY_NUMBA_TARGET)
+    :param compact_links: see core.Simulation
+    :param normalize_every: see core.Simulation
+    """
+    def __init__(self, n, dt, g, comm=None, dims=None, backend=None, compact_links=False, normalize_every=None):
+        from mpi4py import MPI
+
+        if comm is None:
+            comm = MPI.COMM_WORLD
+        if dims is None:
+            dims = MPI.Compute_dims(comm.size, 2)
+        if dims[0] > n or dims[1] > n:
+            raise ValueError("More blocks {} than rows and columns of the lattice ({})".format(tuple(dims), n))
+        if comm.size > n:
+            raise ValueError("More ranks ({}) than rows of the lattice ({})".format(comm.size, n))
+
+        self.comm = comm.Create_cart(dims, periods=[True, True], reorder=False)
+        self.dims = tuple(dims)
+        cx, cy = self.comm.Get_coords(self.comm.rank)
+        self.x0, self.x1 = n * cx // dims[0], n * (cx + 1) // dims[0]
+        self.y0, self.y1 = n * cy // dims[1], n * (cy + 1) // dims[1]
+        self.lx = self.x1 - self.x0
+        self.ly = self.y1 - self.y0
+
+        # ranks of the neighbouring blocks: (lower, upper) in x and y
+        self.neighbours = [self.comm.Shift(d, 1) for d in range(2)]
+
+        # blocks of all ranks (x0, x1, y0, y1), used to redistribute and gather fields
+        self.blocks = self.comm.allgather((self.x0, self.x1, self.y0, self.y1))
+
+        super().__init__(n, dt, g, backend=backend, neighbour_table=False, compact_links=compact_links,
+                         normalize_every=normalize_every)
+        if self.backend.use_cuda:
+            raise ValueError("Distributed simulations are not available on the CUDA backend")
+
+        self.nn = self.d_nn = block_neighbour_table(self.lx + 2, self.ly + 2)
+
+        # inner sites of the padded block (the sites computed by this rank)
+        rows = np.arange(1, self.lx + 1)[:, None] * (self.ly + 2)
+        self.inner = (rows + np.arange(1, self.ly + 1)[None, :]).reshape(-1)
+
+    @property
+    def sites_shape(self):
+        return ((self.lx + 2) * (self.ly + 2),)
+
+    def padded(self, field):
+        """View of a field as (lx + 2, ly + 2, ...) array."""
+        return field.reshape((self.lx + 2, self.ly + 2) + field.shape[1:])
+
+
+def block_neighbour_table(nx, ny):
+    """
+    Nearest neighbours (see lattice.neighbour_table()) inside a padded block of nx * ny sites.
+    Neighbours outside of the block are replaced by the site itself (never read).
+    """
+    x = np.arange(nx * ny)
+    r0, r1 = x // ny, x % ny
+    nn = np.empty((nx * ny, 2, 2), dtype=np.int32)
+    nn[:, 0, 0] = np.where(r0 + 1 < nx, x + ny, x)
+    nn[:, 0, 1] = np.where(r0 > 0, x - ny, x)
+    nn[:, 1, 0] = np.where(r1 + 1 < ny, x + 1, x)
+    nn[:, 1, 1] = np.where(r1 > 0, x - 1, x)
+    return nn
+
+
+def exchange_halos(s, *fields):
+    """Copy the border sites of every field into the halos of the neighbouring blocks."""
+    with profiling.region('distributed.exchange_halos'):
+        (x_lower, x_upper), (y_lower, y_upper) = s.neighbours
+        lx, ly = s.lx, s.ly
+        for field in fields:
+            f = s.padded(field)
+
+            # rows (contiguous)
+            s.comm.Sendrecv(f[lx], dest=x_upper, recvbuf=f[0], source=x_lower)
+            s.comm.Sendrecv(f[1], dest=x_lower, recvbuf=f[lx + 1], source=x_upper)
+
+            # columns including the halo rows
+            received = np.empty_like(f[:, 0])
+            s.comm.Sendrecv(np.ascontiguousarray(f[:, ly]), dest=y_upper, recvbuf=received, source=y_lower)
+            f[:, 0] = received
+            s.comm.Sendrecv(np.ascontiguousarray(f[:, 1]), dest=y_lower, recvbuf=received, source=y_upper)
+            f[:, ly + 1] = received
+
+
+def evolve_leapfrog(s):
+    """Same as core.evolve_leapfrog() on the whole lattice, followed by the halo exchange."""
+    with profiling.region('distributed.evolve_leapfrog'):
+        s.swap()
+        s.t += s.dt
+        sites = s.u0.shape[0]
+        my_parallel_loop(leapfrog.evolve_kernel, sites, s.u0, s.u1, s.pt1, s.pt0, s.aeta0, s.aeta1, s.peta1, s.peta0,
+                         s.dt, s.dt * 0.5, s.t, s.n, s.nn, backend=s.backend)
+        s.step += 1
+        if s.normalize_every and s.step % s.normalize_every == 0:
+            my_parallel_loop(leapfrog.normalize_all_kernel, sites, s.u1, s.pt1, s.aeta1, s.peta1, backend=s.backend)
+        exchange_halos(s, s.u1, s.aeta1, s.pt1)
+
+
+def init(s, w1, w2):
+    """Same as initial.init() with the Wilson lines of distributed.wilson()."""
+    initial.init(s, w1, w2, exchange=lambda *fields: exchange_halos(s, *fields))
+
+
+def compute_energy(s, en):
+    """Compute the means of en = energy.Energy(s) (en.fields is ignored) on all ranks."""
+    # the time steps do not store the plaquettes and transports (placeholders aeta0, pt1, see
+    # core.Simulation.plaquettes())
+    sums = my_parallel_reduce(energy.energy_kernel, len(s.inner), s.n, s.nn, s.u0, s.u1, s.pt1, s.aeta0, s.aeta1,
+                              s.peta1, s.dt, s.dt / 2.0, s.t, s.aeta0, False, s.pt1, False, n_outputs=4,
+                              backend=s.backend, indices=s.inner)
+    en.set_sums(s.comm.allreduce(np.asarray(sums)))
+
+
+def compute_tmunu(s, t_munu=None):
+    """
+    Energy-momentum tensor (see tmunu.EnergyMomentumTensor) on the sites of the padded block
+    (zero on the halo) and its mean over the whole lattice.
+
+    :param t_munu: optional array for the result, shape (sites, 10)
+    :return: t_munu, means (10 components, on all ranks)
+    """
+    if t_munu is None:
+        t_munu = np.zeros(s.sites_shape + (10,), dtype=su.GROUP_TYPE_REAL)
+    my_parallel_loop(tmunu.tmunu_kernel, t_munu.shape[0], s.n, s.nn, s.u0, s.aeta0, s.peta1, s.peta0, s.pt1, s.pt0,
+                     s.t, t_munu, s.aeta0, False, s.pt0, False, backend=s.backend)
+    inner = t_munu[s.inner]
+    t_munu[...] = 0
+    t_munu[s.inner] = inner
+    means = s.comm.allreduce(np.sum(inner, axis=0)) / s.n ** 2
+    return t_munu, means
+
+
+def gather(s, field, root=0):
+    """Collect the inner sites of a field from all ranks into a (n ** 2, ...) array on 'root'."""
+    block = s.padded(field)[1:s.lx + 1, 1:s.ly + 1]
+    blocks = s.comm.gather(np.ascontiguousarray(block), root=root)
+    if s.comm.rank != root:
+        return None
+
+    result = np.empty((s.n, s.n) + field.shape[1:], dtype=field.dtype)
+    for (x0, x1, y0, y1), block in zip(s.blocks, blocks):
+        result[x0:x1, y0:y1] = block
+    return result.reshape((s.n ** 2,) + field.shape[1:])
+
+
+def wilson(s, mu, m, uv, num_sheets, shape_func=None):
+    """
+    Same as mv.wilson() (numpy random numbers), returns the Wilson lines on the padded block.
+
+    Every rank computes the Wilson lines of a slab of rows. The charges are drawn on rank 0 in
+    the order of mv.wilson() and sent to the owners of the slabs. The Poisson equation is solved
+    with the two-dimensional real FFT of numpy split into its one-dimensional transforms: along
+    y on the slabs of rows, along x on slabs of columns (transposed with alltoall).
+    """
+    n = s.n
+    comm = s.comm
+    size = comm.size
+    rank = comm.rank
+
+    # slabs of rows (x) and of columns in momentum space (ky)
+    new_n = (n // 2 + 1) if n % 2 == 0 else (n + 1) // 2
+    rows = [(n * r // size, n * (r + 1) // size) for r in range(size)]
+    columns = [(new_n * r // size, new_n * (r + 1) // size) for r in range(size)]
+    x0, x1 = rows[rank]
+    k0, k1 = columns[rank]
+    lx = x1 - x0
+
+    # poisson kernel (n * new_n values, computed by the kernel of mv.wilson() for identical round-off)
+    kernel = np.zeros((n, new_n), dtype=su.GROUP_TYPE_REAL)
+    my_parallel_loop(mv.wilson_compute_poisson_kernel, n, m, n, new_n, uv, kernel, backend=s.backend)
+    kernel = kernel[:, k0:k1]
+
+    if shape_func is not None:
+        shape_mask = np.zeros((lx, n), dtype=su.GROUP_TYPE_REAL)
+        for ix in range(x0, x1):
+            for iy in range(n):
+                shape_mask[ix - x0, iy] = shape_func(ix - n // 2, iy - n // 2)
+
+    wilsonfield = np.zeros((lx * n, su.GROUP_ELEMENTS), dtype=su.GROUP_TYPE)
+    my_parallel_loop(mv.reset_wilsonfield, lx * n, wilsonfield, backend=s.backend)
+
+    for sheet in range(num_sheets):
+        # random color charges, drawn in the order of mv.wilson()
+        scale = s.g ** 2 * mu / math.sqrt(num_sheets)
+        if rank == 0:
+            for r in range(size):
+                charges = mv.random_np.normal(loc=0.0, scale=scale,
+                                              size=((rows[r][1] - rows[r][0]) * n * su.ALGEBRA_ELEMENTS))
+                if r == 0:
+                    field = charges
+                else:
+                    comm.Send(charges, dest=r)
+        else:
+            field = np.empty(lx * n * su.ALGEBRA_ELEMENTS, dtype=np.float64)
+            comm.Recv(field, source=0)
+        field = field.reshape((lx, n, su.ALGEBRA_ELEMENTS))
+
+        # apply shape mask
+        if shape_func is not None:
+            field = field[:, :, :] * shape_mask[:, :, None]
+
+        # fourier transform charge density (numpy.fft.rfft2: y first, then x)
+        field_fft = np.fft.rfft(field, n, axis=1)
+        field_fft = _transpose(comm, field_fft, [c[1] - c[0] for c in columns], 1, 0)
+        field_fft = np.fft.fft(field_fft, n, axis=0)
+
+        # apply poisson kernel
+        field_fft = field_fft * kernel[:, :, None]
+
+        # fourier transform back (numpy.fft.irfft2: x first, then y)
+        field_fft = np.fft.ifft(field_fft, n, axis=0)
+        field_fft = _transpose(comm, field_fft, [r[1] - r[0] for r in rows], 0, 1)
+        field = np.fft.irfft(field_fft, n, axis=1).reshape((lx * n, su.ALGEBRA_ELEMENTS))
+
+        # exponentiate and multiply with previous sheets
+        my_parallel_loop(mv.wilson_exponentiation_kernel, lx * n, field, wilsonfield, backend=s.backend)
+
+    return _slabs_to_blocks(s, wilsonfield.reshape((lx, n, su.GROUP_ELEMENTS)), rows)
+
+
+def _transpose(comm, slab, counts, split_axis, concat_axis):
+    # split 'slab' along split_axis into parts for every rank and concatenate the received parts along concat_axis
+    bounds = np.cumsum([0] + counts)
+    parts = [np.take(slab, np.arange(bounds[r], bounds[r + 1]), axis=split_axis) for r in range(comm.size)]
+    return np.concatenate(comm.alltoall(parts), axis=concat_axis)
+
+
+def _slabs_to_blocks(s, slab, rows):
+    # slabs of rows (see wilson()) -> padded blocks (halos included) of all ranks
+    n = s.n
+    x0, x1 = rows[s.comm.rank]
+    parts = []
+    for bx0, bx1, by0, by1 in s.blocks:
+        gx = np.arange(bx0 - 1, bx1 + 1) % n
+        gy = np.arange(by0 - 1, by1 + 1) % n
+        selected = np.nonzero((gx >= x0) & (gx < x1))[0]
+        parts.append((selected, slab[gx[selected] - x0][:, gy]))
+
+    padded = np.empty((s.lx + 2, s.ly + 2) + slab.shape[2:], dtype=slab.dtype)
+    for selected, part in s.comm.alltoall(parts):
+        padded[selected] = part
+    return padded.reshape((-1,) + slab.shape[2:])
+
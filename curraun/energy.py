@@ -1,41 +1,50 @@
-from curraun.numba_target import myjit, prange, my_parallel_loop, use_cuda, mynonparjit
+from curraun.numba_target import myjit, prange, my_parallel_loop, my_parallel_reduce, my_parallel_zeros, mynonparjit, \
+    site_kernel, cuda
 import numpy as np
 import curraun.lattice as l
 import curraun.su as su
-import os
+import curraun.profiling as profiling
 
 NC = su.NC
 
-if use_cuda:
-    import numba.cuda as cuda
-
 """
     A module for computing energy density components
 """
 
-# set precision of variable
-su_precision = os.environ.get('PRECISION', 'double')
-if su_precision == 'single':
-    DTYPE = np.float32
-elif su_precision == 'double':
-    DTYPE = np.float64
+# set precision of variable (double for PRECISION=mixed)
+DTYPE = su.GROUP_TYPE_REAL
 
 
 class Energy():
-    def __init__(self, s):
+    def __init__(self, s, fields=False):
+        """
+        :param s: Simulation object
+        :param fields: also store the energy density components EL, BL, ET, BT of every lattice site.
+                       Otherwise only the means are computed, without any temporary arrays.
+                       For a BatchedSimulation the fields are always stored and the means
+                       (energy_density, pL, pT, ...) are arrays with one entry per event.
+        """
         self.s = s
+        self.fields = fields or s.batch is not None
+
+        self.EL = None
+        self.BL = None
+        self.ET = None
+        self.BT = None
 
-        self.EL = np.zeros(shape=s.n ** 2, dtype=DTYPE)
-        self.BL = np.zeros(shape=s.n ** 2, dtype=DTYPE)
-        self.ET = np.zeros(shape=s.n ** 2, dtype=DTYPE)
-        self.BT = np.zeros(shape=s.n ** 2, dtype=DTYPE)
+        if self.fields:
+            nsites = int(np.prod(s.sites_shape))
+            self.EL = my_parallel_zeros(s.sites_shape, DTYPE, nsites, backend=s.backend)
+            self.BL = my_parallel_zeros(s.sites_shape, DTYPE, nsites, backend=s.backend)
+            self.ET = my_parallel_zeros(s.sites_shape, DTYPE, nsites, backend=s.backend)
+            self.BT = my_parallel_zeros(s.sites_shape, DTYPE, nsites, backend=s.backend)
 
         self.d_EL = self.EL
         self.d_BL = self.BL
         self.d_ET = self.ET
         self.d_BT = self.BT
 
-        if use_cuda:
+        if s.backend.use_cuda and self.fields:
             self.copy_to_device()
 
         self.EL_mean = 0.0
@@ -59,6 +68,7 @@ class Energy():
         self.d_ET.copy_to_host(self.ET)
         self.d_BT.copy_to_host(self.BT)
 
+    @profiling.profile('energy.Energy.compute')
     def compute(self):
         # compute contributions in 2d
         u0 = self.s.d_u0
@@ -72,27 +82,51 @@ class Energy():
         dth = dt / 2.0
         t = self.s.t
 
-        EL = self.d_EL
-        BL = self.d_BL
-        ET = self.d_ET
-        BT = self.d_BT
-
         n = self.s.n
-
-        my_parallel_loop(fields_kernel, n ** 2, n, u0, u1, pt1, aeta0, aeta1, peta1, dt, dth, t, EL, BL, ET, BT)
-
-        # if t==0.5:
-        #     fields_kernel.parallel_diagnostics(level=4)
-
-        # compute means (very inefficient, but want to keep the arrays intact)
-        if use_cuda:
-            self.copy_to_host()
-
-        self.EL_mean = np.mean(EL) / self.s.g ** 2
-        self.BL_mean = np.mean(BL) / self.s.g ** 2
-        self.ET_mean = np.mean(ET) / self.s.g ** 2
-        self.BT_mean = np.mean(BT) / self.s.g ** 2
-
+        nn = self.s.d_nn
+
+        # plaquettes and transports of u0, aeta0 stored by the last time step
+        # (see core.Simulation.plaquettes(), transports())
+        plaq, cached = self.s.plaquettes()
+        aeta_fwd, fwd_cached = self.s.transports()
+
+        if self.fields:
+            EL = self.d_EL
+            BL = self.d_BL
+            ET = self.d_ET
+            BT = self.d_BT
+
+            if self.s.batch is None:
+                my_parallel_loop(fields_kernel, n ** 2, n, nn, u0, u1, pt1, aeta0, aeta1, peta1, dt, dth, t, plaq, cached,
+                                 aeta_fwd, fwd_cached, EL, BL, ET, BT, backend=self.s.backend)
+            else:
+                my_parallel_loop(fields_batch_kernel, self.s.batch * n ** 2, n, nn, u0, u1, pt1, aeta0, aeta1, peta1,
+                                 dt, dth, t, plaq, cached, aeta_fwd, fwd_cached, EL, BL, ET, BT,
+                                 backend=self.s.backend)
+
+            # if t==0.5:
+            #     fields_kernel.parallel_diagnostics(level=4)
+
+            if self.s.backend.use_cuda:
+                self.copy_to_host()
+
+        if self.s.batch is None:
+            # compute means (reduction keeps the field arrays intact)
+            sums = my_parallel_reduce(energy_kernel, n ** 2, n, nn, u0, u1, pt1, aeta0, aeta1, peta1, dt, dth, t, plaq,
+                                      cached, aeta_fwd, fwd_cached, n_outputs=4, backend=self.s.backend)
+            self.set_sums(sums)
+        else:
+            # means of every event
+            self.EL_mean, self.BL_mean, self.ET_mean, self.BT_mean = \
+                [np.mean(x, axis=1, dtype=np.float64) / self.s.g ** 2 for x in (self.EL, self.BL, self.ET, self.BT)]
+            self.set_means()
+
+    def set_sums(self, sums):
+        """Set the means from the sums of energy_kernel() over all sites (EL, BL, ET, BT)."""
+        self.EL_mean, self.BL_mean, self.ET_mean, self.BT_mean = sums / self.s.n ** 2 / self.s.g ** 2
+        self.set_means()
+
+    def set_means(self):
         # compute density and pressures
         self.energy_density = (self.EL_mean + self.BL_mean + self.ET_mean + self.BT_mean) / self.s.t
         self.pL = (self.ET_mean + self.BT_mean - (self.EL_mean + self.BL_mean)) / self.s.t
@@ -100,34 +134,70 @@ class Energy():
 
 
 # @myjit
+@site_kernel
 @mynonparjit
-def fields_kernel(xi, n, u0, u1, pt1, aeta0, aeta1, peta1, dt, dth, t, EL, BL, ET, BT):
+def fields_kernel(xi, n, nn, u0, u1, pt1, aeta0, aeta1, peta1, dt, dth, t, plaq, cached, aeta_fwd, fwd_cached,
+                  EL, BL, ET, BT):
+    EL[xi], BL[xi], ET[xi], BT[xi] = energy_kernel(xi, n, nn, u0, u1, pt1, aeta0, aeta1, peta1, dt, dth, t, plaq,
+                                                   cached, aeta_fwd, fwd_cached)
+
+
+# @myjit
+@site_kernel
+@mynonparjit
+def fields_batch_kernel(xb, n, nn, u0, u1, pt1, aeta0, aeta1, peta1, dt, dth, t, plaq, cached, aeta_fwd, fwd_cached,
+                        EL, BL, ET, BT):
+    # site xi of event b (BatchedSimulation)
+    b = xb // (n * n)
+    xi = xb - b * n * n
+    fields_kernel(xi, n, nn, u0[b], u1[b], pt1[b], aeta0[b], aeta1[b], peta1[b], dt, dth, t, plaq[b], cached,
+                  aeta_fwd[b], fwd_cached, EL[b], BL[b], ET[b], BT[b])
+
+
+# @myjit
+@site_kernel
+@mynonparjit
+def energy_kernel(xi, n, nn, u0, u1, pt1, aeta0, aeta1, peta1, dt, dth, t, plaq, cached, aeta_fwd, fwd_cached):
+    # cached: read the plaquette of u0 from plaq (see core.Simulation.plaquettes())
+    # fwd_cached: read the transports of aeta0 from aeta_fwd (see core.Simulation.transports())
+
     # longitudinal electric field at t + dth
-    EL[xi] = su.sq(peta1[xi]) * (t + dth)
+    EL = su.sq(su.load_algebra(peta1[xi])) * (t + dth)
 
     # transverse electric field at t + dth
-    ET[xi] = su.sq(pt1[xi, 0]) / (t + dth) + su.sq(pt1[xi, 1]) / (t + dth)
+    ET = su.sq(su.load_algebra(pt1[xi, 0])) / (t + dth) + su.sq(su.load_algebra(pt1[xi, 1])) / (t + dth)
 
     # longitudinal magnetic field at t + dth (averaged)
-    #BL[xi] = (NC - su.tr(l.plaq_pos(u0, xi, 0, 1, n)).real) * t + (NC - su.tr(l.plaq_pos(u1, xi, 0, 1, n)).real) * (t + dt)
-    BL[xi] = 0.5 * (su.sq(su.ah(l.plaq_pos(u0, xi, 0, 1, n))) * t + su.sq(su.ah(l.plaq_pos(u1, xi, 0, 1, n))) * (t+dt))
+    #BL = (NC - su.tr(l.plaq_pos(u0, xi, 0, 1, n)).real) * t + (NC - su.tr(l.plaq_pos(u1, xi, 0, 1, n)).real) * (t + dt)
+    if cached:
+        BL = 0.5 * (su.sq(su.load_algebra(plaq[xi])) * t + su.sq(su.ah(l.plaq_pos(u1, xi, 0, 1, n, nn))) * (t+dt))
+    else:
+        BL = 0.5 * (su.sq(su.ah(l.plaq_pos(u0, xi, 0, 1, n, nn))) * t + su.sq(su.ah(l.plaq_pos(u1, xi, 0, 1, n, nn))) * (t+dt))
 
     # transverse magnetic field at t + dth (averaged)
     d = 0
-    buffer1 = l.transport(aeta0, u0, xi, d, 1, n)
-    buffer1 = l.add_mul(buffer1, aeta0[xi], -1)
-    BT[xi] = su.sq(buffer1) / 2 / t
+    if fwd_cached:
+        buffer1 = su.load_algebra(aeta_fwd[xi, d])
+    else:
+        buffer1 = l.transport(aeta0, u0, xi, d, 1, n, nn)
+    buffer1 = l.add_mul(buffer1, su.load_algebra(aeta0[xi]), -1)
+    BT = su.sq(buffer1) / 2 / t
 
-    buffer1 = l.transport(aeta1, u1, xi, d, 1, n)
-    buffer1 = l.add_mul(buffer1, aeta1[xi], -1)
-    BT[xi] += su.sq(buffer1) / 2 / (t + dt)
+    buffer1 = l.transport(aeta1, u1, xi, d, 1, n, nn)
+    buffer1 = l.add_mul(buffer1, su.load_algebra(aeta1[xi]), -1)
+    BT += su.sq(buffer1) / 2 / (t + dt)
 
     d = 1
-    buffer1 = l.transport(aeta0, u0, xi, d, 1, n)
-    buffer1 = l.add_mul(buffer1, aeta0[xi], -1)
-    BT[xi] += su.sq(buffer1) / 2 / t
-
-    buffer1 = l.transport(aeta1, u1, xi, d, 1, n)
-    buffer1 = l.add_mul(buffer1, aeta1[xi], -1)
-    BT[xi] += su.sq(buffer1) / 2 / (t + dt)
-
+    if fwd_cached:
+        buffer1 = su.load_algebra(aeta_fwd[xi, d])
+    else:
+        buffer1 = l.transport(aeta0, u0, xi, d, 1, n, nn)
+    buffer1 = l.add_mul(buffer1, su.load_algebra(aeta0[xi]), -1)
+    BT += su.sq(buffer1) / 2 / t
+
+    buffer1 = l.transport(aeta1, u1, xi, d, 1, n, nn)
+    buffer1 = l.add_mul(buffer1, su.load_algebra(aeta1[xi]), -1)
+    BT += su.sq(buffer1) / 2 / (t + dt)
+
+    # all results in the precision of the reduction
+    return float(EL), float(BL), float(ET), float(BT)
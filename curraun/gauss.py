@@ -0,0 +1,157 @@
+from curraun.numba_target import mynonparjit, my_parallel_loop, my_parallel_reduce, my_parallel_zeros, site_kernel, \
+    cuda
+import numpy as np
+import curraun.lattice as l
+import curraun.su as su
+import curraun.profiling as profiling
+
+"""
+    A module for monitoring the Gauss constraint
+
+        G(x) = sum_i [E^i(x) - U^dagger_i(x - i) E^i(x - i) U_i(x - i)] + [A_eta(x), P^eta(x)] = 0
+
+    which is conserved by the time steps up to round-off errors. The violation |G(x)|^2
+    (in lattice units) shows the accumulated round-off errors (e.g. in single precision, see
+    core.Simulation, normalize_every) or errors in the initial conditions.
+
+    The momenta pt1, peta1 are paired with the links u1 and A_eta aeta1 at the end of the last
+    coordinate update of the step, with which they are consistent for all integrators
+    (see leapfrog.INTEGRATORS). The fields u0, aeta0 at the beginning of the step only give
+    the same result for the leapfrog scheme.
+"""
+
+# set precision of variable (double for PRECISION=mixed)
+DTYPE = su.GROUP_TYPE_REAL
+
+
+class Gauss:
+    def __init__(self, s, fields=False, seed=None):
+        """
+        :param s: Simulation object
+        :param fields: also store the violation |G(x)|^2 of every lattice site in self.G.
+                       Otherwise only the total and the maximum are computed, without any temporary arrays.
+        :param seed: seed of the random sites for compute(samples=...)
+
+        The monitor is cheap enough to run during long productions, e.g. on 1000 random sites every k steps:
+
+            gauss_monitor = gauss.Gauss(s)
+            core.evolve_leapfrog_n(s, steps, callback=lambda s: print(gauss_monitor.compute(1000)), every=k)
+        """
+        self.s = s
+        self.fields = fields
+
+        # number of sites (of all events for a BatchedSimulation)
+        self.nsites = s.n ** 2 if s.batch is None else s.batch * s.n ** 2
+
+        self.G = None
+        if self.fields:
+            self.G = my_parallel_zeros(s.sites_shape, DTYPE, self.nsites, backend=s.backend)
+        self.d_G = self.G
+
+        if s.backend.use_cuda and self.fields:
+            self.copy_to_device()
+
+        self.random = np.random.default_rng(seed)
+
+        # sum, mean and maximum of |G(x)|^2
+        self.total = 0.0
+        self.mean = 0.0
+        self.max = 0.0
+
+    def copy_to_device(self):
+        self.d_G = cuda.to_device(self.G)
+
+    def copy_to_host(self):
+        self.d_G.copy_to_host(self.G)
+
+    @profiling.profile('gauss.Gauss.compute')
+    def compute(self, samples=None):
+        """
+        Compute the violation of the Gauss constraint of pt1, peta1 (with u1, aeta1).
+
+        :param samples: number of random lattice sites to check (default: all sites).
+                        The total is then estimated from the mean of the samples.
+        :return: total and maximum of |G(x)|^2
+        """
+        s = self.s
+        n = s.n
+        kernel = gauss_kernel if s.batch is None else gauss_batch_kernel
+
+        if self.fields:
+            if samples is not None:
+                raise ValueError("The field of the violation is only computed on all sites")
+            my_parallel_loop(fields_kernel if s.batch is None else fields_batch_kernel, self.nsites, n, s.d_nn,
+                             s.d_u1, s.d_pt1, s.d_aeta1, s.d_peta1, self.d_G, backend=s.backend)
+            if s.backend.use_cuda:
+                self.copy_to_host()
+            self.set_results(np.sum(self.G, dtype=np.float64), np.max(self.G), self.nsites)
+
+        elif samples is None or samples >= self.nsites:
+            total, maximum = my_parallel_reduce(kernel, self.nsites, n, s.d_nn, s.d_u1, s.d_pt1, s.d_aeta1, s.d_peta1,
+                                                n_outputs=2, ops=('sum', 'max'), backend=s.backend)
+            self.set_results(total, maximum, self.nsites)
+
+        else:
+            indices = np.sort(self.random.choice(self.nsites, samples, replace=False))
+            if s.backend.use_cuda:
+                indices = cuda.to_device(indices)
+            total, maximum = my_parallel_reduce(kernel, samples, n, s.d_nn, s.d_u1, s.d_pt1, s.d_aeta1, s.d_peta1,
+                                                n_outputs=2, ops=('sum', 'max'), backend=s.backend, indices=indices)
+            self.set_results(total, maximum, samples)
+
+        return self.total, self.max
+
+    def set_results(self, total, maximum, sites):
+        """Set the results from the sum and maximum of |G(x)|^2 on 'sites' lattice sites."""
+        self.mean = total / sites
+        self.total = self.mean * self.nsites
+        self.max = maximum
+
+
+# @myjit
+@site_kernel
+@mynonparjit
+def fields_kernel(xi, n, nn, u1, pt1, aeta1, peta1, G):
+    G[xi] = gauss_kernel(xi, n, nn, u1, pt1, aeta1, peta1)[0]
+
+
+# @myjit
+@site_kernel
+@mynonparjit
+def fields_batch_kernel(xb, n, nn, u1, pt1, aeta1, peta1, G):
+    # site xi of event b (BatchedSimulation)
+    b = xb // (n * n)
+    xi = xb - b * n * n
+    fields_kernel(xi, n, nn, u1[b], pt1[b], aeta1[b], peta1[b], G[b])
+
+
+# @myjit
+@site_kernel
+@mynonparjit
+def gauss_kernel(xi, n, nn, u1, pt1, aeta1, peta1):
+    # divergence of the transverse electric field pt1 with the links u1 of the last coordinate update
+    # (for the leapfrog scheme u1 = exp(c pt1) u0, and u0 gives the same result)
+    buffer1 = su.zero()
+    for d in range(2):
+        xs = l.shift(xi, d, -1, n, nn)
+        buffer1 = su.add(buffer1, su.load_algebra(pt1[xi, d]))
+        buffer2 = l.act(su.dagger(su.load_link(u1[xs, d])), su.load_algebra(pt1[xs, d]))
+        buffer1 = l.add_mul(buffer1, buffer2, -1)
+
+    # longitudinal contribution
+    buffer2 = l.comm(su.load_algebra(aeta1[xi]), su.load_algebra(peta1[xi]))
+    buffer1 = su.add(buffer1, buffer2)
+
+    # same value for the sum and the maximum
+    result = float(su.sq(buffer1))
+    return result, result
+
+
+# @myjit
+@site_kernel
+@mynonparjit
+def gauss_batch_kernel(xb, n, nn, u1, pt1, aeta1, peta1):
+    # site xi of event b (BatchedSimulation)
+    b = xb // (n * n)
+    xi = xb - b * n * n
+    return gauss_kernel(xi, n, nn, u1[b], pt1[b], aeta1[b], peta1[b])
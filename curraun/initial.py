@@ -1,4 +1,4 @@
-from curraun.numba_target import myjit, my_parallel_loop, use_cuda, mynonparjit
+from curraun.numba_target import myjit, my_parallel_loop, my_parallel_reduce, mynonparjit, site_kernel
 import numpy as np
 import curraun.lattice as l
 import curraun.su as su
@@ -10,7 +10,19 @@ from numba import prange
 DEBUG = False
 
 
-def init(s, w1, w2):
+def init(s, w1, w2, exchange=None):
+    """
+    Initial conditions at tau = 0 from the Wilson lines w1, w2 of the two nuclei (see mv.wilson()).
+
+    :param exchange: optional function exchange(*fields), called whenever fields are read at
+                     neighbouring sites afterwards (halo exchange of a distributed.DistributedSimulation)
+    """
+    if s.batch is not None:
+        # w1, w2: Wilson lines of every event (see mv.wilson)
+        for i in range(s.batch):
+            init(s.event(i), w1[i], w2[i])
+        return
+
     u0 = s.u0
     u1 = s.u1
     pt1 = s.pt1
@@ -22,66 +34,76 @@ def init(s, w1, w2):
     v1 = w1
     v2 = w2
     n = s.n
+    nn = s.nn
     dt = s.dt
     dth = s.dt / 2.0
+    backend = s.backend
 
-    # temporary transverse gauge links for each nucleus
-    ua = np.zeros_like(u0)
-    ub = np.zeros_like(u0)
+    sites = u0.shape[0]
+    if exchange is None:
+        exchange = lambda *fields: None
 
-    en_EL = np.zeros(n ** 2, dtype=np.double)  # TODO: Think about alternative implementation that reduces on GPU?
-    en_BL = np.zeros(n ** 2, dtype=np.double)
+    # temporary transverse gauge links for each nucleus
+    ua = np.zeros((sites, 2, su.GROUP_ELEMENTS), dtype=su.GROUP_TYPE)
+    ub = np.zeros((sites, 2, su.GROUP_ELEMENTS), dtype=su.GROUP_TYPE)
 
     # TODO: keep arrays on GPU device during execution of these kernels
     t = time()
-    my_parallel_loop(init_kernel_1, n ** 2, v1, v2, n, ua, ub)
+    my_parallel_loop(init_kernel_1, sites, v1, v2, n, nn, ua, ub, backend=backend)
+    exchange(ua, ub)
     debug_print("Init: temporary transverse gauge links ({:3.2f}s)".format(time() - t))
     t = time()
     if su.N_C == 2:
-        my_parallel_loop(init_kernel_2, n ** 2, u0, u1, ua, ub)
+        my_parallel_loop(init_kernel_2, sites, u0, u1, ua, ub, backend=backend)
     elif su.N_C == 3:
-        if use_cuda:
-            my_parallel_loop(init_kernel_2_su3_cuda, n ** 2, u0, u1, ua, ub)
+        if backend.use_cuda:
+            my_parallel_loop(init_kernel_2_su3_cuda, sites, u0, u1, ua, ub, backend=backend)
         else:
-            my_parallel_loop(init_kernel_2_su3_numba, n ** 2, u0, u1, ua, ub)
+            my_parallel_loop(init_kernel_2_su3_numba, sites, u0, u1, ua, ub, backend=backend)
     else:
         print("initial.py: SU(N) code not implemented")
+    exchange(u0)
     debug_print("Init: transverse gauge links ({:3.2f}s)".format(time() - t))
     t = time()
-    my_parallel_loop(init_kernel_3, n ** 2, u0, peta1, n, ua, ub)
+    my_parallel_loop(init_kernel_3, sites, u0, peta1, n, nn, ua, ub, backend=backend)
     debug_print("Init: long. electric field ({:3.2f}s)".format(time() - t))
     t = time()
-    my_parallel_loop(init_kernel_4, n ** 2, u0, pt1, n, dt)
+    my_parallel_loop(init_kernel_4, sites, u0, pt1, n, nn, dt, backend=backend)
     debug_print("Init: trans. electric field corrections ({:3.2f}s)".format(time() - t))
     t = time()
-    my_parallel_loop(init_kernel_5, n ** 2, u0, u1, pt1, aeta0, aeta1, peta1, dt, dth)
+    my_parallel_loop(init_kernel_5, sites, u0, u1, pt1, aeta0, aeta1, peta1, dt, dth, backend=backend)
+    exchange(u1, pt1, aeta1)
     debug_print("Init: gauge link corrections field ({:3.2f}s)".format(time() - t))
     t = time()
-    my_parallel_loop(init_kernel_6, n ** 2, u0, u1, peta1, n, en_EL, en_BL)
+    en_EL_sum, en_BL_sum = my_parallel_reduce(init_kernel_6, sites, u0, u1, peta1, n, nn, n_outputs=2,
+                                              backend=backend)
     debug_print("Init: energy density check ({:3.2f}s)".format(time() - t))
 
     peta0[:,:] = peta1[:,:]
     pt0[:,:] = pt1[:,:]
 
-    en_EL_sum = np.sum(en_EL)
-    en_BL_sum = np.sum(en_BL)
+    # new u0, aeta0: plaquettes and transports stored by earlier time steps are outdated
+    # (see core.Simulation.plaquettes(), transports())
+    s.cache_valid = False
 
     debug_print("Init: e_EL = {}".format(en_EL_sum))
     debug_print("Init: e_BL = {}".format(en_BL_sum))
 
 
+@site_kernel
 @myjit
-def init_kernel_1(xi, v1, v2, n, ua, ub):
+def init_kernel_1(xi, v1, v2, n, nn, ua, ub):
     # temporary transverse gauge fields
     # for d in range(2):
     for d in prange(2):
-        xs = l.shift(xi, d, 1, n)
+        xs = l.shift(xi, d, 1, n, nn)
         buffer1 = su.mul(v1[xi], su.dagger(v1[xs]))
         su.store(ua[xi, d], buffer1)
         buffer2 = su.mul(v2[xi], su.dagger(v2[xs]))
         su.store(ub[xi, d], buffer2)
 
 
+@site_kernel
 @myjit
 def init_kernel_2(xi, u0, u1, ua, ub):
     # initialize transverse gauge links (longitudinal magnetic field)
@@ -94,31 +116,32 @@ def init_kernel_2(xi, u0, u1, ua, ub):
         b2 = su.dagger(b1)
         b2 = su.inv(b2)
         b3 = su.mul(b1, b2)
-        su.store(u0[xi, d], b3)
-        su.store(u1[xi, d], b3)
+        su.store_link(u0[xi, d], b3)
+        su.store_link(u1[xi, d], b3)
 
 # @myjit
+@site_kernel
 @mynonparjit
-def init_kernel_3(xi, u0, peta1, n, ua, ub):
+def init_kernel_3(xi, u0, peta1, n, nn, ua, ub):
     # initialize pi field (longitudinal electric field)
     # (see PhD thesis eq.(2.136))  # TODO: add proper link or reference
     tmp_peta1 = su.zero()
     # unsupported prange parrallelization with numba due to unsupported reduction functions
     # numba cannot parallelize the loop in which tmp_peta1 at d=1 depends on tmp_peta1 at d=0
     for d in range(2):
-        xs = l.shift(xi, d, -1, n)
+        xs = l.shift(xi, d, -1, n, nn)
 
         b1 = su.load(ub[xi, d])
         b1 = l.add_mul(b1, ua[xi, d], -1)
         b1 = su.dagger(b1)
 
-        b2 = su.mul(u0[xi, d], b1)
+        b2 = su.mul(su.load_link(u0[xi, d]), b1)
         b2 = l.add_mul(b2, b1, -1)
 
         b1 = su.load(ub[xs, d])
         b1 = l.add_mul(b1, ua[xs, d], -1)
 
-        b3 = su.mul(su.dagger(u0[xs, d]), b1)
+        b3 = su.mul(su.dagger(su.load_link(u0[xs, d])), b1)
         b3 = l.add_mul(b3, b1, -1)
 
         b2 = su.add(b2, b3)
@@ -126,53 +149,59 @@ def init_kernel_3(xi, u0, peta1, n, ua, ub):
 
         tmp_peta1 = su.add(tmp_peta1, b3)
     tmp_peta1 = su.mul_s(tmp_peta1, 0.5)
-    su.store(peta1[xi], tmp_peta1)
+    su.store_algebra(peta1[xi], tmp_peta1)
 
 
+@site_kernel
 @myjit
-def init_kernel_4(xi, u0, pt1, n, dt):
+def init_kernel_4(xi, u0, pt1, n, nn, dt):
     # pt corrections at tau = dt / 2
     # for d in range(2):
     for d in prange(2):
         # transverse electric field update
-        b1 = l.plaquettes(xi, d, u0, n)
-        b1 = l.add_mul(pt1[xi, d], b1, - dt ** 2 / 2.0)
-        su.store(pt1[xi, d], b1)
+        b1 = l.plaquettes(xi, d, u0, n, nn)
+        b1 = l.add_mul(su.load_algebra(pt1[xi, d]), b1, - dt ** 2 / 2.0)
+        su.store_algebra(pt1[xi, d], b1)
 
+@site_kernel
 @myjit
 def init_kernel_5(xi, u0, u1, pt1, aeta0, aeta1, peta1, dt, dth):
     # coordinate update
     # for d in range(2):
     for d in prange(2):
         # transverse link variables update
-        b0 = su.mul_s(pt1[xi, d], dt / dth)
+        b0 = su.mul_s(su.load_algebra(pt1[xi, d]), dt / dth)
         b1 = su.mexp(b0)
-        b2 = su.mul(b1, u0[xi, d])
-        su.store(u1[xi, d], b2)
+        b2 = su.mul(b1, su.load_link(u0[xi, d]))
+        su.store_link(u1[xi, d], b2)
 
     # longitudinal gauge field update
-    b1 = l.add_mul(aeta0[xi], peta1[xi], dth * dt)
-    su.store(aeta1[xi], b1)
+    b1 = l.add_mul(su.load_algebra(aeta0[xi]), su.load_algebra(peta1[xi]), dth * dt)
+    su.store_algebra(aeta1[xi], b1)
 
 
 # @myjit
+@site_kernel
 @mynonparjit
-def init_kernel_6(xi, u0, u1, peta1, n, en_EL, en_BL):
+def init_kernel_6(xi, u0, u1, peta1, n, nn):
     # initial condition check (EL ~ BL?)
-    b1 = l.plaq(u0, xi, 0, 1, 1, 1, n)
+    b1 = l.plaq(u0, xi, 0, 1, 1, 1, n, nn)
     b2 = su.ah(b1)
-    en_BL[xi] += su.sq(b2) / 2
+    en_BL = su.sq(b2) / 2
 
-    b1 = l.plaq(u1, xi, 0, 1, 1, 1, n)
+    b1 = l.plaq(u1, xi, 0, 1, 1, 1, n, nn)
     b2 = su.ah(b1)
-    en_BL[xi] += su.sq(b2) / 2
+    en_BL += su.sq(b2) / 2
 
     # b1 = l.plaq(u0, xi, 0, 1, 1, 1, n)
-    # en_BL[0] += 2*(1.0 - b1[0])
+    # en_BL += 2*(1.0 - b1[0])
     # b1 = l.plaq(u1, xi, 0, 1, 1, 1, n)
-    # en_BL[0] += 2*(1.0 - b1[0])
+    # en_BL += 2*(1.0 - b1[0])
+
+    en_EL = su.sq(su.load_algebra(peta1[xi]))
 
-    en_EL[xi] += su.sq(peta1[xi])
+    # same type for both results (the reduction needs a homogeneous tuple)
+    return su.GROUP_TYPE_REAL(en_EL), su.GROUP_TYPE_REAL(en_BL)
 
 
 def debug_print(s):
@@ -1,4 +1,4 @@
-from curraun.numba_target import myjit, mynonparjit
+from curraun.numba_target import myjit, mynonparjit, site_kernel
 import numba
 import curraun.su as su
 from curraun.su3 import proj
@@ -21,6 +21,7 @@ ACCURACY_GOAL = 1e-16
 ITERATION_MAX_ROUND_1 = 100
 
 
+@site_kernel
 @myjit
 def init_kernel_2_su3_numba(xi, u0, u1, ua, ub):
     # initialize transverse gauge links (longitudinal magnetic field)
@@ -35,10 +36,11 @@ def init_kernel_2_su3_numba(xi, u0, u1, ua, ub):
         # if check > ACCURACY_GOAL:
         #     print("Kernel xi:", xi, "d: ", d, "did not reach goal. check: ", check)
 
-        su.store(u0[xi, d], b3)
-        su.store(u1[xi, d], b3)
+        su.store_link(u0[xi, d], b3)
+        su.store_link(u1[xi, d], b3)
 
 
+@site_kernel
 @myjit
 def init_kernel_2_su3_cuda(xi, u0, u1, ua, ub):
     # initialize transverse gauge links (longitudinal magnetic field)
@@ -52,8 +54,8 @@ def init_kernel_2_su3_cuda(xi, u0, u1, ua, ub):
         # if check > ACCURACY_GOAL:
         #     print("Kernel xi:", xi, "d: ", d, "did not reach goal. check: ", check)
 
-        su.store(u0[xi, d], b3)
-        su.store(u1[xi, d], b3)
+        su.store_link(u0[xi, d], b3)
+        su.store_link(u1[xi, d], b3)
 
 
 """
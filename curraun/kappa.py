@@ -1,9 +1,9 @@
-from curraun.numba_target import myjit, use_cuda, my_parallel_loop, my_cuda_sum, mycudajit
+from curraun.numba_target import myjit, mynonparjit, my_parallel_loop, my_parallel_reduce, my_parallel_zeros, \
+    site_kernel, get_backend, cuda
 import numpy as np
 import curraun.lattice as l
 import curraun.su as su
-if use_cuda:
-    import numba.cuda as cuda
+import curraun.profiling as profiling
 
 """
     A module for various calculations related to momentum broadening and the \hat{q} parameter.
@@ -15,23 +15,27 @@ class TransportedForce:
         self.n = s.n
         self.dtstep = round(1.0 / s.dt)
 
+        # number of sites (of all events for a BatchedSimulation)
+        nsites = self.n ** 2 if s.batch is None else s.batch * self.n ** 2
+
         # transported force
-        self.f = np.zeros((self.n ** 2, 3, su.GROUP_ELEMENTS), dtype=su.GROUP_TYPE)
+        self.f = my_parallel_zeros((nsites, 3, su.ALGEBRA_STORAGE_ELEMENTS), su.ALGEBRA_TYPE, nsites, backend=s.backend)
 
         # integrated force
-        self.fi = np.zeros((self.n ** 2, 3, su.GROUP_ELEMENTS), dtype=su.GROUP_TYPE)
+        self.fi = my_parallel_zeros((nsites, 3, su.ALGEBRA_STORAGE_ELEMENTS), su.ALGEBRA_TYPE, nsites, backend=s.backend)
 
         # single components
-        self.p_perp_x = np.zeros(self.n ** 2, dtype=np.double)
-        self.p_perp_y = np.zeros(self.n ** 2, dtype=np.double)
-        self.p_perp_z = np.zeros(self.n ** 2, dtype=np.double)
-
-        # mean values
-        self.p_perp_mean = np.zeros(3, dtype=np.double)
-        if use_cuda:
+        self.p_perp_x = my_parallel_zeros(nsites, np.double, nsites, backend=s.backend)
+        self.p_perp_y = my_parallel_zeros(nsites, np.double, nsites, backend=s.backend)
+        self.p_perp_z = my_parallel_zeros(nsites, np.double, nsites, backend=s.backend)
+
+        # mean values (one row per event for a BatchedSimulation)
+        mean_shape = 3 if s.batch is None else (s.batch, 3)
+        self.p_perp_mean = np.zeros(mean_shape, dtype=np.double)
+        if s.backend.use_cuda:
             # use pinned memory for asynchronous data transfer
-            self.p_perp_mean = cuda.pinned_array(3, dtype=np.double)
-            self.p_perp_mean[0:3] = 0.0
+            self.p_perp_mean = cuda.pinned_array(mean_shape, dtype=np.double)
+            self.p_perp_mean[...] = 0.0
 
         # time counter
         self.t = 0
@@ -66,20 +70,24 @@ class TransportedForce:
     def copy_mean_to_host(self, stream=None):
         self.d_p_perp_mean.copy_to_host(self.p_perp_mean, stream)
 
+    @profiling.profile('kappa.TransportedForce.compute')
     def compute(self, stream=None):
+        # the time step may change between the calls (schedule.TimeStepSchedule)
+        self.dtstep = round(1.0 / self.s.dt)
         tint = round(self.s.t / self.s.dt)
         if tint % self.dtstep == 0 and tint >= 1:
             # compute un-transported f (temporal gauge does not need any transport)
             compute_f(self.s, self.d_f, stream)
 
             # integrate f
-            integrate_f(self.d_f, self.d_fi, self.s.n, 1.0, stream)
+            integrate_f(self.d_f, self.d_fi, self.s.n, 1.0, stream, self.s.backend)
 
             # integrate perpendicular momentum
-            compute_p_perp(self.d_fi, self.d_p_perp_x, self.d_p_perp_y, self.d_p_perp_z, self.s.n, stream)
+            compute_p_perp(self.d_fi, self.d_p_perp_x, self.d_p_perp_y, self.d_p_perp_z, self.s.n, stream, self.s.backend)
 
             # calculate mean
-            compute_mean(self.d_p_perp_x, self.d_p_perp_y, self.d_p_perp_z, self.d_p_perp_mean, stream)
+            compute_mean(self.d_p_perp_x, self.d_p_perp_y, self.d_p_perp_z, self.d_p_perp_mean, stream, self.s.backend,
+                         self.s.batch)
 
 """
     Correctly aligned calculation of the force for a resting particle (kappa).
@@ -100,10 +108,17 @@ def compute_f(s, f, stream):
     dth = s.dt / 2.0
     tau = s.t
 
-    my_parallel_loop(compute_f_kernel, n * n, n, u0, peta1, peta0, pt1, pt0, f, tau, stream=stream)
+    if s.batch is None:
+        my_parallel_loop(compute_f_kernel, n * n, n, s.d_nn, u0, peta1, peta0, pt1, pt0, f, tau, stream=stream,
+                         backend=s.backend)
+    else:
+        f = f.reshape((s.batch, n * n) + f.shape[1:])
+        my_parallel_loop(compute_f_batch_kernel, s.batch * n * n, n, s.d_nn, u0, peta1, peta0, pt1, pt0, f, tau,
+                         stream=stream, backend=s.backend)
 
+@site_kernel
 @myjit
-def compute_f_kernel(xi, n, u0, peta1, peta0, pt1, pt0, f, tau):
+def compute_f_kernel(xi, n, nn, u0, peta1, peta0, pt1, pt0, f, tau):
     #### F_X & F_Y
 
     for d in range(2):
@@ -113,16 +128,16 @@ def compute_f_kernel(xi, n, u0, peta1, peta0, pt1, pt0, f, tau):
 
         # quadratically accurate +Ex
         # quadratically accurate +Ey
-        bf = su.add(bf, pt1[xi, d])
-        bf = su.add(bf, pt0[xi, d])
+        bf = su.add(bf, su.load_algebra(pt1[xi, d]))
+        bf = su.add(bf, su.load_algebra(pt0[xi, d]))
 
-        xs = l.shift(xi, d, -1, n)
-        b1 = l.act(su.dagger(u0[xs, d]), pt1[xs, d])
+        xs = l.shift(xi, d, -1, n, nn)
+        b1 = l.act(su.dagger(su.load_link(u0[xs, d])), su.load_algebra(pt1[xs, d]))
         bf = su.add(bf, b1)
-        b1 = l.act(su.dagger(u0[xs, d]), pt0[xs, d])
+        b1 = l.act(su.dagger(su.load_link(u0[xs, d])), su.load_algebra(pt0[xs, d]))
         bf = su.add(bf, b1)
         bf = su.mul_s(bf, 0.25 / tau)
-        su.store(f[xi, d], bf)
+        su.store_algebra(f[xi, d], bf)
 
     #### F_Z
 
@@ -130,64 +145,73 @@ def compute_f_kernel(xi, n, u0, peta1, peta0, pt1, pt0, f, tau):
     bf = su.zero()
 
     # Accurate +E_z
-    bf = su.add(bf, peta1[xi])
-    bf = su.add(bf, peta0[xi])
+    bf = su.add(bf, su.load_algebra(peta1[xi]))
+    bf = su.add(bf, su.load_algebra(peta0[xi]))
     bf = su.mul_s(bf, 0.5)
-    su.store(f[xi, 2], bf)
+    su.store_algebra(f[xi, 2], bf)
 
 
-def integrate_f(f, fi, n, dt, stream):
-    my_parallel_loop(integrate_f_kernel, n * n, f, fi, dt, stream=stream)
+# @myjit
+@site_kernel
+@mynonparjit
+def compute_f_batch_kernel(xb, n, nn, u0, peta1, peta0, pt1, pt0, f, tau):
+    # site xi of event b (BatchedSimulation)
+    b = xb // (n * n)
+    xi = xb - b * n * n
+    compute_f_kernel(xi, n, nn, u0[b], peta1[b], peta0[b], pt1[b], pt0[b], f[b], tau)
 
+
+def integrate_f(f, fi, n, dt, stream, backend=None):
+    # f.shape[0] == n * n for a single event
+    my_parallel_loop(integrate_f_kernel, f.shape[0], f, fi, dt, stream=stream, backend=backend)
+
+@site_kernel
 @myjit
 def integrate_f_kernel(xi, f, fi, dt):
     for d in range(3):
-        bfi = l.add_mul(fi[xi, d], f[xi, d], dt)
-        su.store(fi[xi, d], bfi)
+        bfi = l.add_mul(su.load_algebra(fi[xi, d]), su.load_algebra(f[xi, d]), dt)
+        su.store_algebra(fi[xi, d], bfi)
 
 
-def compute_p_perp(fi, p_perp_x, p_perp_y, p_perp_z, n, stream):
-    my_parallel_loop(compute_p_perp_kernel, n * n, fi, p_perp_x, p_perp_y, p_perp_z, stream=stream)
+def compute_p_perp(fi, p_perp_x, p_perp_y, p_perp_z, n, stream, backend=None):
+    my_parallel_loop(compute_p_perp_kernel, fi.shape[0], fi, p_perp_x, p_perp_y, p_perp_z, stream=stream,
+                     backend=backend)
 
 
+@site_kernel
 @myjit
 def compute_p_perp_kernel(xi, fi, p_perp_x, p_perp_y, p_perp_z):
     #p_perp[xi] = 0
-    p_perp_x[xi] = su.sq(fi[xi, 0])
-    p_perp_y[xi] = su.sq(fi[xi, 1])
-    p_perp_z[xi] = su.sq(fi[xi, 2])
-
-
-def compute_mean(p_perp_x, p_perp_y, p_perp_z, p_perp_mean, stream):
-    if use_cuda:
-        # # Unfortunately, this version is blocking:
-        # p_perp_mean[0] = sum_reduce(p_perp_x) / p_perp_x.size
-        # p_perp_mean[1] = sum_reduce(p_perp_y) / p_perp_y.size
-        # p_perp_mean[2] = sum_reduce(p_perp_z) / p_perp_z.size
-
-        # TODO: use GPU summation which keeps the array intact
-
-        # TODO: use Cupy.sum: https://docs-cupy.chainer.org/en/stable/reference/generated/cupy.sum.html#cupy.sum
-
-        # CUDA version which does not require copy to host
-        # It leaves the sum in array[0] and leaves the rest
-        # of the array in an undefined state.
-        my_cuda_sum(p_perp_x, stream)
-        my_cuda_sum(p_perp_y, stream)
-        my_cuda_sum(p_perp_z, stream)
-        collect_results[1, 1, stream](p_perp_mean, p_perp_x, p_perp_y, p_perp_z)
+    p_perp_x[xi] = su.sq(su.load_algebra(fi[xi, 0]))
+    p_perp_y[xi] = su.sq(su.load_algebra(fi[xi, 1]))
+    p_perp_z[xi] = su.sq(su.load_algebra(fi[xi, 2]))
+
+
+def compute_mean(p_perp_x, p_perp_y, p_perp_z, p_perp_mean, stream, backend=None, batch=None):
+    backend = get_backend(backend)
+    if batch is None:
+        # The reduction leaves p_perp_x, p_perp_y, p_perp_z intact
+        sums = my_parallel_reduce(p_perp_sum_kernel, p_perp_x.size, p_perp_x, p_perp_y, p_perp_z, n_outputs=3,
+                                  stream=stream, backend=backend)
+        means = sums / p_perp_x.size
     else:
-        p_perp_mean[0] = np.mean(p_perp_x)
-        p_perp_mean[1] = np.mean(p_perp_y)
-        p_perp_mean[2] = np.mean(p_perp_z)
-
-# @cuda.reduce
-# def sum_reduce(a, b):
-#    return a + b
+        # mean of every event
+        means = np.zeros((batch, 3), dtype=np.double)
+        for d, p_perp in enumerate([p_perp_x, p_perp_y, p_perp_z]):
+            if backend.use_cuda:
+                p_perp = p_perp.copy_to_host(stream=stream)
+                if stream is not None:
+                    stream.synchronize()
+            means[:, d] = np.mean(p_perp.reshape(batch, -1), axis=1)
+
+    if backend.use_cuda:
+        p_perp_mean.copy_to_device(means, stream=stream)
+    else:
+        p_perp_mean[...] = means
 
 
-@mycudajit  # @cuda.jit
-def collect_results(p_perp_mean, p_perp_x, p_perp_y, p_perp_z):
-    p_perp_mean[0] = p_perp_x[0] / p_perp_x.size
-    p_perp_mean[1] = p_perp_y[0] / p_perp_y.size
-    p_perp_mean[2] = p_perp_z[0] / p_perp_z.size
+# @myjit
+@site_kernel
+@mynonparjit
+def p_perp_sum_kernel(xi, p_perp_x, p_perp_y, p_perp_z):
+    return p_perp_x[xi], p_perp_y[xi], p_perp_z[xi]
@@ -6,6 +6,7 @@ from curraun.numba_target import myjit, mynonparjit
 import curraun.su as su
 
 import math
+import numpy as np
 
 """
     SU(2) group & algebra functions
@@ -50,86 +51,137 @@ def comm(a, b):
 # compute 'positive' plaquette U_{x, i, j}
 # @myjit
 @mynonparjit
-def plaq_pos(u, x, i, j, n):
-    x1 = shift(x, i, 1, n)
-    x2 = shift(x, j, 1, n)
+def plaq_pos(u, x, i, j, n, nn=None):
+    x1 = shift(x, i, 1, n, nn)
+    x2 = shift(x, j, 1, n, nn)
 
     # U_{x, i} * U_{x+i, j} * U_{x+j, i}^t * U_{x, j}^t
-    plaquette = mul4(u[x, i], u[x1, j], su.dagger(u[x2, i]), su.dagger(u[x, j]))
+    plaquette = mul4(su.load_link(u[x, i]), su.load_link(u[x1, j]), su.dagger(su.load_link(u[x2, i])),
+                     su.dagger(su.load_link(u[x, j])))
     return plaquette
 
 # compute 'negative' plaquette U_{x, i, -j}
 # @myjit
 @mynonparjit
-def plaq_neg(u, x, i, j, n):
+def plaq_neg(u, x, i, j, n, nn=None):
     x0 = x
-    x1 = shift(shift(x0, i, 1, n), j, -1, n)
-    x2 = shift(x1, i, -1, n)
+    x1 = shift(shift(x0, i, 1, n, nn), j, -1, n, nn)
+    x2 = shift(x1, i, -1, n, nn)
     x3 = x2
 
     # U_{x, i} * U_{x+i-j, j}^t * U_{x-j, i}^t * U_{x-j, j}
-    return mul4(u[x0, i], su.dagger(u[x1, j]), su.dagger(u[x2, i]), u[x3, j])
+    return mul4(su.load_link(u[x0, i]), su.dagger(su.load_link(u[x1, j])), su.dagger(su.load_link(u[x2, i])),
+                su.load_link(u[x3, j]))
 
 
 # compute general plaquette U_{x, oi*i, oj*j}
 # @myjit
 @mynonparjit
-def plaq(u, x, i, j, oi, oj, n):
+def plaq(u, x, i, j, oi, oj, n, nn=None):
     x0 = x
-    x1 = shift(x0, i, oi, n)
-    x2 = shift(x1, j, oj, n)
-    x3 = shift(x2, i, -oi, n)
+    x1 = shift(x0, i, oi, n, nn)
+    x2 = shift(x1, j, oj, n, nn)
+    x3 = shift(x2, i, -oi, n, nn)
 
-    u0 = get_link(u, x0, i, oi, n)
-    u1 = get_link(u, x1, j, oj, n)
-    u2 = get_link(u, x2, i, -oi, n)
-    u3 = get_link(u, x3, j, -oj, n)
+    u0 = get_link(u, x0, i, oi, n, nn)
+    u1 = get_link(u, x1, j, oj, n, nn)
+    u2 = get_link(u, x2, i, -oi, n, nn)
+    u3 = get_link(u, x3, j, -oj, n, nn)
 
     # U_{x, i} * U_{x+i, j} * U_{x+i+j, -i} * U_{x+j, -j}
     return mul4(u0, u1, u2, u3)
 
 # @myjit
 @mynonparjit
-def get_link(u, x, i, oi, n):
+def get_link(u, x, i, oi, n, nn=None):
     if oi > 0:
-        return su.load(u[x, i])
+        return su.load_link(u[x, i])
     else:
-        xs = shift(x, i, oi, n)
-        return su.dagger(u[xs, i])
+        xs = shift(x, i, oi, n, nn)
+        return su.dagger(su.load_link(u[xs, i]))
 
 # compute staple sum for optimized eom
 # @myjit
 @mynonparjit
-def plaquettes(x, d, u, n):
-    ci1 = shift(x, d, 1, n)
+def plaquettes(x, d, u, n, nn=None):
+    ci1 = shift(x, d, 1, n, nn)
     i = (d + 1) % 2
-    ci2 = shift(x, i, 1, n)
-    ci3 = shift(ci1, i, -1, n)
-    ci4 = shift(x, i, -1, n)
-    buffer1 = su.mul(u[ci1, i], su.dagger(u[ci2, d]))
-    buffer_S = su.mul(buffer1, su.dagger(u[x, i]))
-    buffer1 = su.mul(su.dagger(u[ci3, i]), su.dagger(u[ci4, d]))
-    buffer2 = su.mul(buffer1, u[ci4, i])
+    ci2 = shift(x, i, 1, n, nn)
+    ci3 = shift(ci1, i, -1, n, nn)
+    ci4 = shift(x, i, -1, n, nn)
+    buffer1 = su.mul(su.load_link(u[ci1, i]), su.dagger(su.load_link(u[ci2, d])))
+    buffer_S = su.mul(buffer1, su.dagger(su.load_link(u[x, i])))
+    buffer1 = su.mul(su.dagger(su.load_link(u[ci3, i])), su.dagger(su.load_link(u[ci4, d])))
+    buffer2 = su.mul(buffer1, su.load_link(u[ci4, i]))
     buffer_S = su.add(buffer_S, buffer2)
-    buffer1 = su.mul(u[x, d], buffer_S)
+    buffer1 = su.mul(su.load_link(u[x, d]), buffer_S)
     result = su.ah(buffer1)
     return result
 
+# plaquettes(x, 0, u, n, nn) and the anti-hermitian part of the plaquette U_{x, 0, 1},
+# which is the link U_{x, 0} times the first staple
+# @myjit
+@mynonparjit
+def plaquettes_plaq(x, u, n, nn=None):
+    d = 0
+    ci1 = shift(x, d, 1, n, nn)
+    i = 1
+    ci2 = shift(x, i, 1, n, nn)
+    ci3 = shift(ci1, i, -1, n, nn)
+    ci4 = shift(x, i, -1, n, nn)
+    buffer1 = su.mul(su.load_link(u[ci1, i]), su.dagger(su.load_link(u[ci2, d])))
+    buffer_S = su.mul(buffer1, su.dagger(su.load_link(u[x, i])))
+    u_local = su.load_link(u[x, d])
+    plaquette = su.ah(su.mul(u_local, buffer_S))
+    buffer1 = su.mul(su.dagger(su.load_link(u[ci3, i])), su.dagger(su.load_link(u[ci4, d])))
+    buffer2 = su.mul(buffer1, su.load_link(u[ci4, i]))
+    buffer_S = su.add(buffer_S, buffer2)
+    buffer1 = su.mul(u_local, buffer_S)
+    result = su.ah(buffer1)
+    return result, plaquette
+
+# sum of the anti-hermitian parts of the four plaquettes around x in the transverse plane,
+#   ah(U_{x, 0, 1}) - ah(U_{x, 0, -1}) + ah(U_{x, 1, -0}) - ah(U_{x, -1, -0}),
+# from the stored anti-hermitian parts plaq[y] = ah(U_{y, 0, 1}) of the positive plaquettes
+# (see core.Simulation, plaquette_buffer): the other three plaquettes are positive plaquettes
+# of the neighbouring sites, transported to x.
+# @myjit
+@mynonparjit
+def clover(plaq, u, x, n, nn=None):
+    result = su.load_algebra(plaq[x])
+
+    # U_{x, 0, -1} = U_{y, 1}^t U_{y, 0, 1}^t U_{y, 1} with y = x - 1
+    y = shift(x, 1, -1, n, nn)
+    buffer1 = act(su.dagger(su.load_link(u[y, 1])), su.load_algebra(plaq[y]))
+    result = su.add(result, buffer1)
+
+    # U_{x, 1, -0} = U_{y, 0}^t U_{y, 0, 1} U_{y, 0} with y = x - 0
+    y = shift(x, 0, -1, n, nn)
+    buffer1 = act(su.dagger(su.load_link(u[y, 0])), su.load_algebra(plaq[y]))
+    result = su.add(result, buffer1)
+
+    # U_{x, -1, -0} = V^t U_{w, 0, 1}^t V with w = x - 0 - 1, V = U_{w, 1} U_{y, 0}
+    w = shift(y, 1, -1, n, nn)
+    buffer2 = su.mul(su.load_link(u[w, 1]), su.load_link(u[y, 0]))
+    buffer1 = act(su.dagger(buffer2), su.load_algebra(plaq[w]))
+    result = su.add(result, buffer1)
+    return result
+
 
 """
-    Parallel transport of 'scalar' fields (aeta, peta)
+    Parallel transport of 'scalar' fields (aeta, peta), stored as su.ALGEBRA_STORAGE
 """
 
 # @myjit
 @mynonparjit
-def transport(f, u, x, i, o, n):
-    xs = shift(x, i, o, n)
+def transport(f, u, x, i, o, n, nn=None):
+    xs = shift(x, i, o, n, nn)
     if o > 0:
-        u1 = u[x, i]  # np-array
-        result = act(u1, f[xs])
+        u1 = su.load_link(u[x, i])
+        result = act(u1, su.load_algebra(f[xs]))
     else:
-        u2 = su.dagger(u[xs, i])  # tuple
-        result = act(u2, f[xs])
+        u2 = su.dagger(su.load_link(u[xs, i]))
+        result = act(u2, su.load_algebra(f[xs]))
     return result
 
 """
@@ -163,11 +215,33 @@ def get_point(x, n):
 #@cuda.jit(device=True)
 # @myjit
 @mynonparjit
-def shift(x, i, o, n):
-    r0, r1 = get_point(x, n)
+def shift(x, i, o, n, nn=None):
+    # nearest neighbours from the table (see neighbour_table())
+    if nn is not None:
+        if o == 1:
+            return nn[x, i, 0]
+        if o == -1:
+            return nn[x, i, 1]
+
+    # power of two: modulo by bit mask
+    if n & (n - 1) == 0:
+        if i == 0:
+            return (x + o * n) & (n * n - 1)
+        r1 = x & (n - 1)
+        return x - r1 + ((r1 + o) & (n - 1))
+
     if i == 0:
-        r0 = (r0 + o) % n
-    else:
-        r1 = (r1 + o) % n
-    result = get_index_nm(r0, r1, n)
-    return result
+        return (x + o * n) % (n * n)
+    r1 = x % n
+    return x - r1 + (r1 + o) % n
+
+# table of nearest neighbours: nn[x, i, 0] = x + i, nn[x, i, 1] = x - i
+def neighbour_table(n):
+    x = np.arange(n * n)
+    r0, r1 = x // n, x % n
+    nn = np.empty((n * n, 2, 2), dtype=np.int32)
+    nn[:, 0, 0] = n * ((r0 + 1) % n) + r1
+    nn[:, 0, 1] = n * ((r0 - 1) % n) + r1
+    nn[:, 1, 0] = n * r0 + (r1 + 1) % n
+    nn[:, 1, 1] = n * r0 + (r1 - 1) % n
+    return nn
@@ -1,13 +1,41 @@
-from curraun.numba_target import myjit, prange, my_parallel_loop, mynonparjit
+from curraun.numba_target import myjit, prange, my_parallel_loop, my_parallel_reduce, mynonparjit, site_kernel, \
+    use_cache, cuda
 import curraun.lattice as l
 import curraun.su as su
+import curraun.profiling as profiling
+from curraun.gauss import Gauss
 import numpy as np
+import math
 
+# Integrators of core.Simulation (integrator=...): symmetric compositions
+#     K(a_0 dt) D(b_0 dt) K(a_1 dt) ... D(b_(m-1) dt) K(a_m dt)
+# of momentum updates (kicks K) and coordinate updates (drifts D) as (kicks a, drifts b), see evolve_composed().
+# 'leapfrog' is the default second order scheme of evolve_kernel() with one force evaluation per step.
+OMELYAN_LAMBDA = 0.1931833275037836
+FOREST_RUTH_THETA = 1.0 / (2.0 - 2.0 ** (1.0 / 3.0))
+INTEGRATORS = {
+    'leapfrog': None,
+    # second order with a ten times smaller error constant (Omelyan, Mryglod, Folk 2003)
+    'omelyan': ([OMELYAN_LAMBDA, 1.0 - 2.0 * OMELYAN_LAMBDA, OMELYAN_LAMBDA], [0.5, 0.5]),
+    # fourth order (Forest, Ruth 1990)
+    'forest_ruth': ([FOREST_RUTH_THETA / 2, (1.0 - FOREST_RUTH_THETA) / 2, (1.0 - FOREST_RUTH_THETA) / 2,
+                     FOREST_RUTH_THETA / 2], [FOREST_RUTH_THETA, 1.0 - 2.0 * FOREST_RUTH_THETA, FOREST_RUTH_THETA]),
+}
 
-def evolve(s, stream=None):
+
+def evolve(s, stream=None, diagnostics=None):
     # Standard way to 'cast' numpy arrays from python objects
     # cdef cnp.ndarray[double, ndim=1, mode="c"] array = s.array
 
+    if diagnostics is not None:
+        evolve_diagnostics(s, diagnostics, stream)
+        return
+
+    if s.integrator != 'leapfrog':
+        kicks, drifts = INTEGRATORS[s.integrator]
+        evolve_composed(s, kicks, drifts, stream)
+        return
+
     u0 = s.d_u0
     u1 = s.d_u1
     pt1 = s.d_pt1
@@ -21,14 +49,242 @@ def evolve(s, stream=None):
     dth = s.dt * 0.5
     t = s.t
     n = s.n
+    nn = s.d_nn
+
+    if s.tile and s.backend.use_numba and s.batch is None:
+        if profiling.enabled:
+            start = profiling.clock()
+
+        _get_compiled(evolve_tiles)(u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, dth, t, n, nn, s.tile)
+
+        if profiling.enabled:
+            profiling.record('curraun.leapfrog.evolve_tiles', 'kernel', start, profiling.clock(),
+                             n ** 2, profiling.estimate_bytes(s.data))
+    elif s.plaq is not None or s.aeta_fwd is not None:
+        # also store the plaquettes and transports of u0, aeta0 for the observables
+        # (see core.Simulation.plaquettes(), transports())
+        if s.batch is None:
+            my_parallel_loop(evolve_cache_kernel, n * n, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, dth, t,
+                             n, nn, *cache_arguments(s), stream=stream, backend=s.backend)
+        else:
+            my_parallel_loop(evolve_cache_batch_kernel, s.batch * n * n, u0, u1, pt1, pt0, aeta0, aeta1, peta1,
+                             peta0, dt, dth, t, n, nn, *cache_arguments(s), stream=stream, backend=s.backend)
+        s.cache_valid = True
+    elif s.batch is None:
+        my_parallel_loop(evolve_kernel, n * n, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, dth, t, n, nn,
+                         stream=stream, backend=s.backend)
+    else:
+        my_parallel_loop(evolve_batch_kernel, s.batch * n * n, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0,
+                         dt, dth, t, n, nn, stream=stream, backend=s.backend)
+
+
+def evolve_diagnostics(s, diagnostics, stream=None):
+    """
+    Leapfrog step of evolve() which also accumulates the energy density components
+    (and optionally the Gauss violation) of diagnostics.Diagnostics in the same sweep
+    over the lattice, while the fields of every site are loaded anyway.
+
+    The sums are reduced per thread (numba) or per block (CUDA), see my_parallel_reduce().
+    The plaquette and transport buffers of s are filled as in evolve().
+    """
+    if s.integrator != 'leapfrog' or s.batch is not None:
+        raise ValueError("Diagnostics are only accumulated by the leapfrog step of a single event")
+
+    dt = s.dt
+    n = s.n
+    sums = my_parallel_reduce(evolve_diagnostics_kernel, n * n, s.d_u0, s.d_u1, s.d_pt1, s.d_pt0, s.d_aeta0,
+                              s.d_aeta1, s.d_peta1, s.d_peta0, dt, dt * 0.5, s.t, n, s.d_nn, *cache_arguments(s),
+                              diagnostics.gauss, n_outputs=6, ops=('sum',) * 5 + ('max',), stream=stream,
+                              backend=s.backend)
+    s.cache_valid = s.plaq is not None or s.aeta_fwd is not None
+    diagnostics.set_sums(sums)
+
+
+def evolve_n(s, steps, stream=None):
+    """
+    Perform several leapfrog steps including the buffer rotation and time update of
+    every step (see core.evolve_leapfrog()).
+
+    With the numba backend all steps run inside one compiled function (evolve_n_loop)
+    without returning to python in between. With a plaquette or transport buffer the
+    last step is done by evolve(), which fills the buffers.
+    """
+    if not s.backend.use_numba or s.batch is not None or s.integrator != 'leapfrog':
+        for step in range(steps):
+            s.swap()
+            s.t += s.dt
+            evolve(s, stream)
+        return
+
+    last = 1 if (s.plaq is not None or s.aeta_fwd is not None) and steps > 0 else 0
+    loop_steps = steps - last
+
+    if profiling.enabled:
+        start = profiling.clock()
+
+    _get_compiled(evolve_n_loop)(loop_steps, s.d_u0, s.d_u1, s.d_pt1, s.d_pt0, s.d_aeta0, s.d_aeta1, s.d_peta1,
+                                 s.d_peta0, s.dt, s.dt * 0.5, s.t, s.n, s.d_nn, s.tile or 0)
+
+    # same time steps and buffers as after 'loop_steps' calls of swap()
+    for step in range(loop_steps):
+        s.t += s.dt
+    if loop_steps % 2 == 1:
+        s.swap()
+
+    if profiling.enabled:
+        profiling.record('curraun.leapfrog.evolve_n_loop', 'kernel', start, profiling.clock(),
+                         loop_steps * s.n ** 2, loop_steps * profiling.estimate_bytes(s.data))
+
+    if last:
+        s.swap()
+        s.t += s.dt
+        evolve(s, stream)
+
 
-    my_parallel_loop(evolve_kernel, n * n, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, dth, t, n, stream=stream)
+def evolve_composed(s, kicks, drifts, stream=None):
+    """
+    One time step of the symmetric composition K(a_0 dt) D(b_0 dt) K(a_1 dt) ... D(b_(m-1) dt) K(a_m dt)
+    (kicks a, drifts b, see INTEGRATORS), with the same fields before and after the step as evolve().
+
+    The kicks are evaluated at the end of the previous drift, the drifts are integrated exactly
+    in tau (the momenta are constant during a drift):
+        U -> exp(log(tau_b / tau_a) P^i) U,   A_eta -> A_eta + (tau_b ** 2 - tau_a ** 2) / 2 P^eta
+    so that the order of the composition is not reduced by the time dependence of the equations.
+
+    The momenta of the simulation are staggered as in the leapfrog scheme: pt1, peta1 are the
+    momenta at t + dt minus half a kick at t + dt (see kick()). The first kick of the step
+    therefore includes an additional half kick and the step ends with a kick of (a_m - 1 / 2) dt.
+    The m drifts alternate between u1, aeta1 and a scratch buffer, such that the last one ends in u1, aeta1.
+    """
+    if s.batch is not None:
+        raise ValueError("Integrator '{}' is not available for batched simulations".format(s.integrator))
+    if s.scratch is None:
+        s.scratch = [np.zeros_like(s.u0), np.zeros_like(s.aeta0)]
+        if s.backend.use_cuda:
+            s.scratch = [cuda.to_device(a) for a in s.scratch]
+
+    dt = s.dt
+    n = s.n
+    nn = s.d_nn
+    tau = s.t
+    u_in, aeta_in = s.d_u0, s.d_aeta0
+    pt_in, peta_in = s.d_pt0, s.d_peta0
+    for k, b in enumerate(drifts):
+        kick_dt = (kicks[k] + (0.5 if k == 0 else 0.0)) * dt
+        tau_next = tau + b * dt
+        if (len(drifts) - 1 - k) % 2 == 0:
+            u_out, aeta_out = s.d_u1, s.d_aeta1
+        else:
+            u_out, aeta_out = s.scratch
+        # the first kick also stores the plaquettes and transports of u0, aeta0 (see evolve())
+        if k == 0:
+            cache = cache_arguments(s)
+        else:
+            cache = s.d_aeta0, False, s.d_pt0, False
+        my_parallel_loop(kick_drift_kernel, n * n, u_in, u_out, s.d_pt1, pt_in, aeta_in, aeta_out, s.d_peta1, peta_in,
+                         kick_dt, tau, math.log(tau_next / tau), (tau_next ** 2 - tau ** 2) / 2, n, nn, *cache,
+                         False, False, stream=stream, backend=s.backend)
+        u_in, aeta_in = u_out, aeta_out
+        pt_in, peta_in = s.d_pt1, s.d_peta1
+        tau = tau_next
+    s.cache_valid = s.plaq is not None or s.aeta_fwd is not None
+
+    kick_dt = (kicks[-1] - 0.5) * dt
+    if kick_dt != 0.0:
+        my_parallel_loop(kick_kernel, n * n, s.d_u1, s.d_pt1, s.d_pt1, s.d_aeta1, s.d_peta1, s.d_peta1, kick_dt,
+                         s.t + dt, n, nn, stream=stream, backend=s.backend)
+
+
+def cache_arguments(s):
+    """
+    Arguments (plaq, store_plaq, aeta_fwd, store_fwd) of kick_drift_kernel() which fill the
+    plaquette and transport buffers of s. Missing buffers are replaced by placeholders
+    of the same type (aeta0, pt0), which are not written.
+    """
+    if s.plaq is not None:
+        plaq, store_plaq = s.d_plaq, True
+    else:
+        plaq, store_plaq = s.d_aeta0, False
+    if s.aeta_fwd is not None:
+        aeta_fwd, store_fwd = s.d_aeta_fwd, True
+    else:
+        aeta_fwd, store_fwd = s.d_pt0, False
+    return plaq, store_plaq, aeta_fwd, store_fwd
+
+
+def kick(s, kick_dt, stream=None):
+    """
+    Momentum update of pt1, peta1 by kick_dt with the forces of u1, aeta1 (at tau = t + dt).
+
+    pt1 is the momentum at t + dt minus half a kick of dt, therefore kick(s, (s.dt - dt_new) / 2)
+    changes the staggering to a new time step dt_new (see core.Simulation.set_dt()).
+    """
+    if s.batch is None:
+        my_parallel_loop(kick_kernel, s.n ** 2, s.d_u1, s.d_pt1, s.d_pt1, s.d_aeta1, s.d_peta1, s.d_peta1, kick_dt,
+                         s.t + s.dt, s.n, s.d_nn, stream=stream, backend=s.backend)
+    else:
+        my_parallel_loop(kick_batch_kernel, s.batch * s.n ** 2, s.d_u1, s.d_pt1, s.d_pt1, s.d_aeta1, s.d_peta1,
+                         s.d_peta1, kick_dt, s.t + s.dt, s.n, s.d_nn, stream=stream, backend=s.backend)
+
+
+# Loops of the numba backend that run outside of my_parallel_loop(), compiled on first use
+_compiled = {}
+
+
+def _get_compiled(function):
+    if function not in _compiled:
+        import types
+        import numba
+        import curraun.numba_target as numba_target
+        # named after the configuration like the parallel drivers (see numba_target._make_driver())
+        tagged = types.FunctionType(function.__code__, function.__globals__, function.__name__)
+        tagged.__qualname__ = function.__qualname__ + '_' + numba_target._config_tag()
+        tagged.__module__ = function.__module__
+        _compiled[function] = numba.jit(parallel=True, nogil=True, fastmath=True, cache=use_cache)(tagged)
+    return _compiled[function]
+
+
+def evolve_n_loop(steps, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, dth, t, n, nn, tile):
+    for step in range(steps):
+        # buffer rotation as in Simulation.swap()
+        peta1, peta0 = peta0, peta1
+        pt1, pt0 = pt0, pt1
+        u1, u0 = u0, u1
+        aeta1, aeta0 = aeta0, aeta1
+        t += dt
+
+        if tile > 0:
+            # see evolve_tiles()
+            tiles = (n + tile - 1) // tile
+            for it in prange(tiles * tiles):
+                ix0 = (it // tiles) * tile
+                iy0 = (it % tiles) * tile
+                for ix in range(ix0, min(ix0 + tile, n)):
+                    for iy in range(iy0, min(iy0 + tile, n)):
+                        evolve_kernel(n * ix + iy, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, dth, t, n, nn)
+        else:
+            for xi in prange(n * n):
+                evolve_kernel(xi, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, dth, t, n, nn)
+
+
+def evolve_tiles(u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, dth, t, n, nn, tile):
+    # The sites are visited in blocks of tile x tile sites (one block per thread at a time).
+    # The rows x - 1, x, x + 1 of a block stay in the cache, whereas a linear walk over
+    # all n * n sites evicts them for large n.
+    tiles = (n + tile - 1) // tile
+    for it in prange(tiles * tiles):
+        ix0 = (it // tiles) * tile
+        iy0 = (it % tiles) * tile
+        for ix in range(ix0, min(ix0 + tile, n)):
+            for iy in range(iy0, min(iy0 + tile, n)):
+                evolve_kernel(n * ix + iy, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, dth, t, n, nn)
 
 
 # @myjit
+@site_kernel
 @mynonparjit
-def evolve_kernel(xi, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, dth, t, n):
-    # Momentum update
+def evolve_kernel(xi, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, dth, t, n, nn):
+    # Momentum and coordinate update
     # Input:
     #   t-dt/2: pt0, peta0
     #   t: u0, aeta0
@@ -36,84 +292,220 @@ def evolve_kernel(xi, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, dth, t,
     # Output:
     #   t+dt/2: pt1, peta1
     #   t+dt: u1, aeta1
+    # (aeta0, pt0 are only placeholders for the plaquette and transport buffers, which are not written)
+    kick_drift_kernel(xi, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, t, dt / (t + dth), (t + dth) * dt, n, nn,
+                      aeta0, False, pt0, False, False, False)
 
-    peta_local = su.load(peta0[xi])
+
+# @myjit
+@site_kernel
+@mynonparjit
+def evolve_cache_kernel(xi, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, dth, t, n, nn, plaq, store_plaq,
+                        aeta_fwd, store_fwd):
+    # evolve_kernel() which also stores the plaquettes and transports of u0, aeta0 (see cache_arguments())
+    kick_drift_kernel(xi, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, t, dt / (t + dth), (t + dth) * dt, n, nn,
+                      plaq, store_plaq, aeta_fwd, store_fwd, False, False)
+
+
+# @myjit
+@site_kernel
+@mynonparjit
+def evolve_diagnostics_kernel(xi, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, dth, t, n, nn, plaq, store_plaq,
+                              aeta_fwd, store_fwd, gauss):
+    # evolve_cache_kernel() which also returns the contributions of the site to the diagnostics
+    # (EL, BL, ET, BT, |G(x)|^2, |G(x)|^2), reduced to the sums and the maximum of |G(x)|^2
+    EL, BL, ET, BT, G = kick_drift_kernel(xi, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, t, dt / (t + dth),
+                                          (t + dth) * dt, n, nn, plaq, store_plaq, aeta_fwd, store_fwd, True, gauss)
+    return EL, BL, ET, BT, G, G
+
+
+# @myjit
+@site_kernel
+@mynonparjit
+def kick_drift_kernel(xi, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, kick_dt, t, drift_u, drift_aeta, n, nn,
+                      plaq, store_plaq, aeta_fwd, store_fwd, diagnostics, gauss):
+    # Momentum update with the forces of u0, aeta0 at time t (pt0, peta0 -> pt1, peta1, which may be the same arrays),
+    # followed by the coordinate update with the new momenta:
+    #   u1 = exp(drift_u * pt1) u0, aeta1 = aeta0 + drift_aeta * peta1
+    # With store_plaq the anti-hermitian part of the plaquette U_{x, 0, 1} of u0 is stored in plaq[xi],
+    # with store_fwd the transports U_{x, d} aeta0(x + d) U_{x, d}^t in aeta_fwd[xi, d].
+    #
+    # With diagnostics (only for the leapfrog step, where pt0, peta0 are the momenta at t - kick_dt / 2
+    # and not overwritten) the contributions of the site to the energy density components
+    # EL, BL, ET, BT at time t are returned (see diagnostics.Diagnostics), with gauss also the
+    # violation |G(x)|^2 of the Gauss constraint at t - kick_dt / 2 (see gauss.Gauss). Otherwise zeros.
+    peta_local = su.load_algebra(peta0[xi])
+    aeta_local = su.load_algebra(aeta0[xi])
+
+    EL = 0.0
+    BL = 0.0
+    ET = 0.0
+    BT = 0.0
+    G = 0.0
+    buffer3 = su.zero()
 
     for d in range(2):
+        # the link U_{x,d} is loaded once for the staples, the transport and the coordinate update
+        u_local = su.load_link(u0[xi, d])
+        xs = l.shift(xi, d, 1, n, nn)
+        pt_local = su.load_algebra(pt0[xi, d])
+
         # transverse electric field update
-        buffer2 = l.plaquettes(xi, d, u0, n)
-        b2 = l.add_mul(pt0[xi, d], buffer2, - t * dt)
-        buffer1 = l.transport(aeta0, u0, xi, d, 1, n)
-        buffer2 = l.comm(buffer1, aeta0[xi])
-        b2 = l.add_mul(b2, buffer2, + dt / t)
-        su.store(pt1[xi, d], b2)
+        if (store_plaq or diagnostics) and d == 0:
+            buffer2, buffer0 = l.plaquettes_plaq(xi, u0, n, nn)
+            if store_plaq:
+                su.store_algebra(plaq[xi], buffer0)
+            if diagnostics:
+                BL = su.sq(buffer0) * t
+        else:
+            buffer2 = l.plaquettes(xi, d, u0, n, nn)
+        b2 = l.add_mul(pt_local, buffer2, - t * kick_dt)
+        transport_fwd = l.act(u_local, su.load_algebra(aeta0[xs]))
+        if store_fwd:
+            su.store_algebra(aeta_fwd[xi, d], transport_fwd)
+        buffer2 = l.comm(transport_fwd, aeta_local)
+        b2 = l.add_mul(b2, buffer2, + kick_dt / t)
+        su.store_algebra(pt1[xi, d], b2)
 
-        # longitudinal electric field update
-        buffer1 = l.transport(aeta0, u0, xi, d, 1, n)
-        buffer2 = l.transport(aeta0, u0, xi, d, -1, n)
-        buffer1 = su.add(buffer1, buffer2)
-        buffer1 = l.add_mul(buffer1, aeta0[xi], -2)
-        peta_local = l.add_mul(peta_local, buffer1, + dt / t)
+        if diagnostics:
+            # transverse electric field averaged over t -+ kick_dt / 2, transverse magnetic field at t
+            ET += 0.5 * (su.sq(pt_local) / (t - 0.5 * kick_dt) + su.sq(b2) / (t + 0.5 * kick_dt))
+            buffer2 = l.add_mul(transport_fwd, aeta_local, -1)
+            BT += su.sq(buffer2) / t
+            if gauss:
+                # divergence of pt0
+                xs2 = l.shift(xi, d, -1, n, nn)
+                buffer3 = su.add(buffer3, pt_local)
+                buffer2 = l.act(su.dagger(su.load_link(u0[xs2, d])), su.load_algebra(pt0[xs2, d]))
+                buffer3 = l.add_mul(buffer3, buffer2, -1)
 
-    su.store(peta1[xi], peta_local)
+        # longitudinal electric field update
+        buffer2 = l.transport(aeta0, u0, xi, d, -1, n, nn)
+        buffer1 = su.add(transport_fwd, buffer2)
+        buffer1 = l.add_mul(buffer1, aeta_local, -2)
+        peta_local = l.add_mul(peta_local, buffer1, + kick_dt / t)
 
-    # Coordinate update
-    for d in range(2):
+        # Coordinate update
         # transverse link variables update
-        buffer0 = su.mul_s(pt1[xi, d], dt / (t + dth))
+        buffer0 = su.mul_s(b2, drift_u)
         buffer1 = su.mexp(buffer0)
-        buffer2 = su.mul(buffer1, u0[xi, d])
-        su.store(u1[xi, d], buffer2)
+        buffer2 = su.mul(buffer1, u_local)
+        su.store_link(u1[xi, d], buffer2)
+
+    su.store_algebra(peta1[xi], peta_local)
+
+    if diagnostics:
+        # longitudinal electric field averaged over t -+ kick_dt / 2
+        buffer2 = su.load_algebra(peta0[xi])
+        EL = 0.5 * (su.sq(buffer2) * (t - 0.5 * kick_dt) + su.sq(peta_local) * (t + 0.5 * kick_dt))
+        if gauss:
+            buffer3 = su.add(buffer3, l.comm(aeta_local, buffer2))
+            G = su.sq(buffer3)
 
     # longitudinal gauge field update
-    b2 = l.add_mul(aeta0[xi], peta1[xi], (t + dth) * dt)
-    su.store(aeta1[xi], b2)
+    b2 = l.add_mul(aeta_local, peta_local, drift_aeta)
+    su.store_algebra(aeta1[xi], b2)
 
-@myjit
-def gauss(s):
-    u0 = s.u0
-    pt1 = s.pt1
-    aeta0 = s.aeta0
-    peta1 = s.peta1
+    # all results in the precision of the reduction
+    return float(EL), float(BL), float(ET), float(BT), float(G)
 
-    n = s.n
 
-    result = 0.0
+# @myjit
+@site_kernel
+@mynonparjit
+def kick_kernel(xi, u0, pt1, pt0, aeta0, peta1, peta0, kick_dt, t, n, nn):
+    # Momentum update of kick_drift_kernel() without the coordinate update
+    peta_local = su.load_algebra(peta0[xi])
+    aeta_local = su.load_algebra(aeta0[xi])
+
+    for d in range(2):
+        # transverse electric field update
+        buffer2 = l.plaquettes(xi, d, u0, n, nn)
+        b2 = l.add_mul(su.load_algebra(pt0[xi, d]), buffer2, - t * kick_dt)
+        transport_fwd = l.transport(aeta0, u0, xi, d, 1, n, nn)
+        buffer2 = l.comm(transport_fwd, aeta_local)
+        b2 = l.add_mul(b2, buffer2, + kick_dt / t)
+        su.store_algebra(pt1[xi, d], b2)
 
-    buffer1 = l.zero()
+        # longitudinal electric field update
+        buffer2 = l.transport(aeta0, u0, xi, d, -1, n, nn)
+        buffer1 = su.add(transport_fwd, buffer2)
+        buffer1 = l.add_mul(buffer1, aeta_local, -2)
+        peta_local = l.add_mul(peta_local, buffer1, + kick_dt / t)
 
-    for xi in prange(n * n):
-        for d in range(2):
-            xs = l.shift(xi, d, -1, n)
-            buffer2 = l.act(u0[xs, d], pt1[xs, d], -1)
-            buffer2 = l.add_mul(buffer2, pt1[xi, d], -1)
-            buffer1 = l.add(buffer1, buffer2)
+    su.store_algebra(peta1[xi], peta_local)
 
-        buffer2 = l.comm(l.load(aeta0[xi]), peta1[xi])
-        buffer1 = l.add_mul(buffer1, buffer2, -1)
 
-        result += l.sq(buffer1)
+# @myjit
+@site_kernel
+@mynonparjit
+def kick_batch_kernel(xb, u0, pt1, pt0, aeta0, peta1, peta0, kick_dt, t, n, nn):
+    # site xi of event b (BatchedSimulation)
+    b = xb // (n * n)
+    xi = xb - b * n * n
+    kick_kernel(xi, u0[b], pt1[b], pt0[b], aeta0[b], peta1[b], peta0[b], kick_dt, t, n, nn)
 
-    return result
+
+# @myjit
+@site_kernel
+@mynonparjit
+def evolve_batch_kernel(xb, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, dth, t, n, nn):
+    # site xi of event b (BatchedSimulation)
+    b = xb // (n * n)
+    xi = xb - b * n * n
+    evolve_kernel(xi, u0[b], u1[b], pt1[b], pt0[b], aeta0[b], aeta1[b], peta1[b], peta0[b], dt, dth, t, n, nn)
 
 
-def normalize_all(s):
+# @myjit
+@site_kernel
+@mynonparjit
+def evolve_cache_batch_kernel(xb, u0, u1, pt1, pt0, aeta0, aeta1, peta1, peta0, dt, dth, t, n, nn, plaq, store_plaq,
+                              aeta_fwd, store_fwd):
+    # site xi of event b (BatchedSimulation)
+    b = xb // (n * n)
+    xi = xb - b * n * n
+    evolve_cache_kernel(xi, u0[b], u1[b], pt1[b], pt0[b], aeta0[b], aeta1[b], peta1[b], peta0[b], dt, dth, t, n, nn,
+                        plaq[b], store_plaq, aeta_fwd[b], store_fwd)
+
+def gauss(s, samples=None):
+    """Total violation of the Gauss constraint sum_x |G(x)|^2 of pt1, peta1, see gauss.Gauss."""
+    return Gauss(s).compute(samples)[0]
+
+
+def normalize_all(s, stream=None):
+    """
+    Remove accumulated round-off errors: project the links back onto the group and the
+    electric fields and A_eta onto the (traceless) anti-hermitian algebra.
+
+    Only the time slices read by the next time step (u1, pt1, aeta1, peta1) are projected.
+    See core.Simulation.normalize_every for calling this periodically.
+    """
     n = s.n
-    u0 = s.d_u0
     u1 = s.d_u1
     pt1 = s.d_pt1
-    aeta0 = s.d_aeta0
     aeta1 = s.d_aeta1
     peta1 = s.d_peta1
-    my_parallel_loop(normalize_all_kernel, n ** 2, u0, u1, pt1, aeta0, aeta1, peta1)
+    if s.batch is None:
+        my_parallel_loop(normalize_all_kernel, n * n, u1, pt1, aeta1, peta1, stream=stream, backend=s.backend)
+    else:
+        my_parallel_loop(normalize_all_batch_kernel, s.batch * n * n, u1, pt1, aeta1, peta1, n,
+                         stream=stream, backend=s.backend)
 
 
-@myjit
-def normalize_all_kernel(xi, u0, u1, pt1, aeta0, aeta1, peta1):
+@site_kernel
+@mynonparjit
+def normalize_all_kernel(xi, u1, pt1, aeta1, peta1):
     for d in range(2):
-        l.normalize(u0[xi, d])
-        l.normalize(u1[xi, d])
-        pt1[xi, d, 0] = 0.0
-    aeta0[xi, 0] = 0.0
-    aeta1[xi, 0] = 0.0
-    peta1[xi,0] = 0.0
+        su.store_link(u1[xi, d], su.unitarize(su.load_link(u1[xi, d])))
+        # projection onto the algebra
+        su.store_algebra(pt1[xi, d], su.ah(su.load_algebra(pt1[xi, d])))
+    su.store_algebra(aeta1[xi], su.ah(su.load_algebra(aeta1[xi])))
+    su.store_algebra(peta1[xi], su.ah(su.load_algebra(peta1[xi])))
+
+
+@site_kernel
+@mynonparjit
+def normalize_all_batch_kernel(xb, u1, pt1, aeta1, peta1, n):
+    b = xb // (n * n)
+    xi = xb - b * n * n
+    normalize_all_kernel(xi, u1[b], pt1[b], aeta1[b], peta1[b])
@@ -1,50 +1,60 @@
-from curraun.numba_target import myjit, my_parallel_loop, use_cuda, mynonparjit
+from curraun.numba_target import myjit, my_parallel_loop, mynonparjit, site_kernel, cuda
 import curraun.su as su
 import numpy as np
 from numpy.fft import rfft2, irfft2
 from numpy import newaxis as na
 import math
 
-# Use cupy only if cuda is available
+# Use cupy for simulations on the CUDA backend (imported on first use)
 # cupy can be turned off by changing 'use_cupy'
-if use_cuda:
-    use_cupy = True
-    import numba.cuda as cuda
-    import cupy
-else:
-    use_cupy = False
+use_cupy = True
 
 PI = np.pi
 
 from numba import prange
 
-if use_cupy:
-    random_cupy = cupy.random.RandomState()
+random_cupy = None
+random_cupy_seed = None
 random_np = np.random.RandomState()
 
 # This function can be used to fix seeds. Note that cupy and numpy give different results
 # with the same seed.
 def set_seed(seed):
-    if use_cupy:
-        global random_cupy
-        random_cupy = cupy.random.RandomState(seed)
-    else:
-        global random_np
-        random_np = np.random.RandomState(seed)
+    global random_np, random_cupy, random_cupy_seed
+    random_np = np.random.RandomState(seed)
+    random_cupy = None
+    random_cupy_seed = seed
+
+
+def import_cupy():
+    global random_cupy
+    import cupy
+    if random_cupy is None:
+        random_cupy = cupy.random.RandomState(random_cupy_seed)
+    return cupy, random_cupy
 
 
 def wilson(s, mu, m, uv, num_sheets, shape_func=None):
+    if s.batch is not None:
+        # independent Wilson lines for every event of a BatchedSimulation
+        return np.stack([wilson(s.event(i), mu, m, uv, num_sheets, shape_func) for i in range(s.batch)])
+
     n = s.n
     g = s.g
+    backend = s.backend
+
+    gpu = use_cupy and backend.use_cuda
+    if gpu:
+        cupy, random_cupy = import_cupy()
 
     # compute poisson kernel
     new_n = (n // 2 + 1) if n % 2 == 0 else (n + 1) // 2
     kernel = np.zeros((n, new_n), dtype=su.GROUP_TYPE_REAL)
     d_kernel = kernel
-    if use_cupy:
+    if gpu:
         d_kernel = cupy.array(kernel)
 
-    my_parallel_loop(wilson_compute_poisson_kernel, n, m, n, new_n, uv, d_kernel)
+    my_parallel_loop(wilson_compute_poisson_kernel, n, m, n, new_n, uv, d_kernel, backend=backend)
 
     # create shape 'mask' array for charge density (this is pretty slow..)
     if shape_func is not None:
@@ -54,28 +64,28 @@ def wilson(s, mu, m, uv, num_sheets, shape_func=None):
                 shape_mask[ix, iy] = shape_func(ix - n // 2, iy - n // 2)
 
         d_shape_mask = shape_mask
-        if use_cupy:
+        if gpu:
             d_shape_mask = cupy.array(shape_mask)
             d_shape_mask = d_shape_mask.reshape(n * n)
 
     # initialize wilson lines
     wilsonfield = np.zeros((n ** 2, su.GROUP_ELEMENTS), dtype=su.GROUP_TYPE)
     d_wilsonfield = wilsonfield
-    if use_cupy:
+    if gpu:
         d_wilsonfield = cuda.to_device(wilsonfield)
 
-    my_parallel_loop(reset_wilsonfield, n ** 2, d_wilsonfield)
+    my_parallel_loop(reset_wilsonfield, n ** 2, d_wilsonfield, backend=backend)
 
     # create color sheets and multiply them
     for sheet in range(num_sheets):
-        if use_cupy:
+        if gpu:
             # generate random color charges
             d_charge = random_cupy.randn(n * n * su.ALGEBRA_ELEMENTS, dtype=np.float32) \
                        * (g ** 2 * mu / math.sqrt(num_sheets))
             d_charge = cupy.reshape(d_charge, (n * n, su.ALGEBRA_ELEMENTS))
             # apply shape mask
             if shape_func is not None:
-                my_parallel_loop(modulate_kernel, n ** 2, d_charge, su.ALGEBRA_ELEMENTS, d_shape_mask)
+                my_parallel_loop(modulate_kernel, n ** 2, d_charge, su.ALGEBRA_ELEMENTS, d_shape_mask, backend=backend)
 
             # fourier transform charge density
             d_charge = cupy.reshape(d_charge, (n, n, su.ALGEBRA_ELEMENTS))
@@ -84,7 +94,7 @@ def wilson(s, mu, m, uv, num_sheets, shape_func=None):
             # apply poisson kernel
             d_kernel = cupy.reshape(d_kernel, n * new_n)
             d_field_fft = cupy.reshape(d_field_fft, (n * new_n, su.ALGEBRA_ELEMENTS))
-            my_parallel_loop(modulate_kernel, n * new_n, d_field_fft, su.ALGEBRA_ELEMENTS, d_kernel)
+            my_parallel_loop(modulate_kernel, n * new_n, d_field_fft, su.ALGEBRA_ELEMENTS, d_kernel, backend=backend)
             d_field_fft = cupy.reshape(d_field_fft, (n, new_n, su.ALGEBRA_ELEMENTS))
 
             # fourier transform back
@@ -92,7 +102,7 @@ def wilson(s, mu, m, uv, num_sheets, shape_func=None):
             d_field = cupy.reshape(d_field, (n * n, su.ALGEBRA_ELEMENTS))
 
             # exponentiate and multiply with previous sheets
-            my_parallel_loop(wilson_exponentiation_kernel, n ** 2, d_field, d_wilsonfield)
+            my_parallel_loop(wilson_exponentiation_kernel, n ** 2, d_field, d_wilsonfield, backend=backend)
 
         else:
             # generate random color charges
@@ -115,9 +125,9 @@ def wilson(s, mu, m, uv, num_sheets, shape_func=None):
             ).reshape((n ** 2, su.ALGEBRA_ELEMENTS))
 
             # exponentiate and multiply with previous sheets
-            my_parallel_loop(wilson_exponentiation_kernel, n ** 2, field, d_wilsonfield)
+            my_parallel_loop(wilson_exponentiation_kernel, n ** 2, field, d_wilsonfield, backend=backend)
 
-    if use_cupy:
+    if gpu:
         d_wilsonfield.copy_to_host(wilsonfield)
 
     return wilsonfield
@@ -128,16 +138,19 @@ def wilson(s, mu, m, uv, num_sheets, shape_func=None):
 """
 
 
+@site_kernel
 @myjit
 def modulate_kernel(xi, field, num, kernel):
     for i in range(num):
         field[xi, i] = field[xi, i] * kernel[xi]
 
 # @myjit
+@site_kernel
 @mynonparjit
 def reset_wilsonfield(x, wilsonfield):
     su.store(wilsonfield[x], su.unit())
 
+@site_kernel
 @myjit
 def wilson_compute_poisson_kernel(x, mass, n, new_n, uv, kernel):
     # for y in range(new_n):
@@ -147,6 +160,7 @@ def wilson_compute_poisson_kernel(x, mass, n, new_n, uv, kernel):
             kernel[x, y] = 1.0 / (k2 + mass ** 2)
 
 # @myjit
+@site_kernel
 @mynonparjit
 def wilson_exponentiation_kernel(x, field, wilsonfield):
     a = su.get_algebra_element(field[x])
@@ -1,8 +1,13 @@
 """
 Switch between CPU Numba version and CUDA version.
+
+MY_NUMBA_TARGET selects how the device functions are compiled and the default backend.
+Individual simulations can run on another backend, see get_backend().
 """
 import os
 import math
+import numpy as np
+import curraun.profiling as profiling
 
 # from packaging.version import Version
 # import numba
@@ -29,6 +34,7 @@ if target == 'cuda':
     use_numba = False
     print("Using CUDA")
 elif target == 'python':
+    cuda = None
     myjit = lambda a : a
     mynonparjit = lambda a : a
     mycudajit = lambda a : a
@@ -39,6 +45,7 @@ elif target == 'python':
     print("Using Python")
 elif target == 'numba':
     import numba
+    from numba import cuda
     myjit = numba.jit(parallel=True, nogil=True, fastmath=True)
     mynonparjit = numba.jit(nogil=True, fastmath=True)
     mycudajit = lambda a : a
@@ -54,77 +61,472 @@ else:
 
 ##############################################################################
 
-# Unique counter for compiling python or CUDA functions
-_unique_counter = 0
+# Registry of all kernels that are executed once per lattice site
+site_kernels = {}
+
+# Parallel drivers (prange loops or CUDA kernels) built for the site kernels,
+# stored by (backend name, kernel function, number of reduced outputs, maximum outputs)
+_drivers = {}
+
+# Allow disabling of the on-disk cache of the compiled drivers
+use_cache = os.environ.get('MY_NUMBA_CACHE', '1') != '0'
+
+
+def site_kernel(kernel_function):
+    """Decorator that registers a kernel function with arguments (xi, *args)
+    which is executed for every lattice site xi by my_parallel_loop().
+
+    The decorator has to be applied on top of the jit decorator:
+
+        @site_kernel
+        @myjit
+        def some_kernel(xi, a, b):
+            ...
+
+    :param kernel_function: compiled (or plain python) kernel function
+    :return: the unchanged kernel function
+    """
+    py_func = _get_py_func(kernel_function)
+    site_kernels[py_func.__module__ + '.' + py_func.__qualname__] = kernel_function
+    return kernel_function
+
+
+def _kernel_name(kernel_function):
+    py_func = _get_py_func(kernel_function)
+    return getattr(py_func, '__module__', '') + '.' + getattr(py_func, '__qualname__', 'no_name')
+
+
+def _get_py_func(kernel_function):
+    # Numba dispatchers and CUDA device functions provide the original python function,
+    # the CUDA simulator does not.
+    return getattr(kernel_function, 'py_func', kernel_function)
+
+
+_source_checksum = None
+
+
+def _source_version():
+    # Numba only checks the source file of a cached function, not the files of the device
+    # functions it calls (su, lattice, ...). A checksum of all curraun modules is therefore
+    # part of the cache file name: any change of the sources leads to a recompilation.
+    global _source_checksum
+    if _source_checksum is None:
+        import glob
+        import zlib
+        crc = 0
+        for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+            with open(path, 'rb') as f:
+                crc = zlib.crc32(f.read(), crc)
+        _source_checksum = '{:08x}'.format(crc)
+    return _source_checksum
+
+
+def _constants_version(modules):
+    # Checksum of the module-level constants (upper case names with numbers, strings or booleans)
+    # of the given modules, e.g. the tunables su3.EXP_MIN_TERMS, EXP_MAX_TERMS, EXP_ACCURACY_SQUARED.
+    # Numba freezes the values read by a kernel into the compiled code.
+    import zlib
+    crc = 0
+    for module in modules:
+        for name, value in sorted(vars(module).items()):
+            if name.isupper() and isinstance(value, (bool, int, float, complex, str)):
+                crc = zlib.crc32('{}.{}={!r};'.format(module.__name__, name, value).encode(), crc)
+    return '{:08x}'.format(crc)
+
+
+def _config_tag():
+    # Gauge group, precision, the SU(3) exponential map, the storage of algebra-valued fields
+    # and the tunables of the group modules are baked into the compiled code as global constants.
+    # They are part of the cache file name so that the different configurations
+    # do not overwrite each other.
+    # The import target decides how the device functions called by the drivers are compiled.
+    import sys
+    su = sys.modules.get('curraun.su')
+    if su is None:
+        return target + '_' + _source_version()
+    tag = '{}_{}_{}_{}'.format(su.su_group, su.su_precision, target, _source_version())
+    exp_method = getattr(su, 'EXP_METHOD', 'taylor')
+    if exp_method != 'taylor':
+        tag += '_' + exp_method
+    algebra_storage = getattr(su, 'ALGEBRA_STORAGE', 'group')
+    if algebra_storage != 'group':
+        tag += '_' + algebra_storage
+    group = sys.modules.get('curraun.' + su.su_group)
+    tag += '_' + _constants_version([su] if group is None else [su, group])
+    return tag
+
+
+# Templates for the parallel drivers. The global '_kernel_function' is set
+# separately for every kernel function (see _make_driver()).
+
+def _numba_prange_driver(iter_max, *args):
+    for xi in prange(iter_max):
+        _kernel_function(xi, *args)
+
+
+def _cuda_driver(iter_max, *args):
+    xi = cuda.grid(1)
+    if xi < iter_max:
+        _kernel_function(xi, *args)
+
+
+def _numba_reduce_driver(iter_max, partial, *args):
+    # Every chunk of sites is summed up by one thread into its own row of 'partial'
+    # (or reduced to the maximum for the outputs j with _maximum[j])
+    num_chunks, num_outputs = partial.shape
+    chunk_size = (iter_max + num_chunks - 1) // num_chunks
+    for c in prange(num_chunks):
+        for xi in range(c * chunk_size, min((c + 1) * chunk_size, iter_max)):
+            r = _kernel_function(xi, *args)
+            for j in range(num_outputs):
+                if _maximum[j]:
+                    partial[c, j] = max(partial[c, j], r[j])
+                else:
+                    partial[c, j] += r[j]
+
+
+def _indexed_kernel(i, indices, *args):
+    # site kernel on the sites given by an index array (see my_parallel_loop(), indices=...)
+    return _kernel_function(indices[i], *args)
+
+
+def _cuda_reduce_driver(iter_max, result, *args):
+    # Sum (or maximum for the outputs j with _maximum[j]) within a block using shared memory,
+    # then add the block sums to 'result'
+    tx = cuda.threadIdx.x
+    xi = cuda.grid(1)
+    block_sum = cuda.shared.array(shape=(_threads_per_block, _n_outputs), dtype=float64)
+    for j in range(_n_outputs):
+        block_sum[tx, j] = -_inf if _maximum[j] else 0.0
+    if xi < iter_max:
+        r = _kernel_function(xi, *args)
+        for j in range(_n_outputs):
+            block_sum[tx, j] = r[j]
+    cuda.syncthreads()
+
+    stride = _threads_per_block // 2
+    while stride > 0:
+        if tx < stride:
+            for j in range(_n_outputs):
+                if _maximum[j]:
+                    block_sum[tx, j] = max(block_sum[tx, j], block_sum[tx + stride, j])
+                else:
+                    block_sum[tx, j] += block_sum[tx + stride, j]
+        cuda.syncthreads()
+        stride //= 2
+
+    if tx == 0:
+        for j in range(_n_outputs):
+            if _maximum[j]:
+                cuda.atomic.max(result, j, block_sum[0, j])
+            else:
+                cuda.atomic.add(result, j, block_sum[0, j])
+
+
+def _make_driver(template, kernel_function, suffix, backend, **template_globals):
+    """Create a copy of a driver template that calls kernel_function.
+
+    The copy is attributed to the source file and line of the kernel function and is
+    named after it. Numba therefore stores the compiled driver next to the kernel in
+    the __pycache__ directory and invalidates it whenever the kernel source changes.
+    """
+    py_func = _get_py_func(kernel_function)
+    name = getattr(py_func, '__name__', 'no_name') + suffix
+    code = template.__code__
+    try:
+        code = code.replace(co_name=name,
+                            co_filename=py_func.__code__.co_filename,
+                            co_firstlineno=py_func.__code__.co_firstlineno)
+    except AttributeError:
+        # Probably running the CUDA simulator which does not provide the original function
+        pass
+    driver_globals = {'_kernel_function': kernel_function, 'prange': prange}
+    if backend.use_cuda:
+        driver_globals['cuda'] = cuda
+        driver_globals['float64'] = numba.float64
+    driver_globals.update(template_globals)
+    driver = type(template)(code, driver_globals, name)
+    driver.__module__ = getattr(py_func, '__module__', __name__)
+    driver.__qualname__ = getattr(py_func, '__qualname__', name) + suffix + '_' + _config_tag()
+    return driver
+
+
+# Number of threads per block for all CUDA drivers
+_threads_per_block = 256
+
+# Kernels on a subset of the sites, stored by (backend name, kernel function)
+_indexed_kernels = {}
+
+
+class Backend:
+    """Execution backend of a simulation.
+
+    The backend decides how the site kernels are executed:
+
+        'python': plain python loop over the (uncompiled) kernel function
+        'numba':  parallel loop over the sites using Numba's prange
+        'cuda':   one CUDA thread per site
 
-#TODO: create decorator version of functionality? i.e. @my_parallel_jit
+    The parallel drivers are compiled lazily for every backend and kernel function.
+    Several backends can be used next to each other in one process (see get_backend()).
+    """
+    def __init__(self, name):
+        self.name = name
+        self.use_python = name == 'python'
+        self.use_numba = name == 'numba'
+        self.use_cuda = name == 'cuda'
+
+    def __repr__(self):
+        return "Backend('{}')".format(self.name)
+
+    def _get_driver(self, kernel_function, n_outputs=None, maximum=None):
+        """Return the compiled parallel loop (n_outputs=None) or reduction (n_outputs=k)
+        for a kernel function. maximum: tuple of flags, the outputs to reduce to their maximum."""
+        if n_outputs is not None and maximum is None:
+            maximum = (False,) * n_outputs
+        key = (self.name, kernel_function, n_outputs, maximum)
+        driver = _drivers.get(key)
+        if driver is None:
+            if n_outputs is None:
+                if self.use_cuda:
+                    driver = _make_driver(_cuda_driver, kernel_function, '_cuda_kernel', self)
+                else:
+                    driver = _make_driver(_numba_prange_driver, kernel_function, '_numba_prange', self)
+            else:
+                suffix = '_reduce{}'.format(n_outputs)
+                if any(maximum):
+                    suffix += '_' + ''.join('m' if m else 's' for m in maximum)
+                if self.use_cuda:
+                    driver = _make_driver(_cuda_reduce_driver, kernel_function, '_cuda' + suffix, self,
+                                          _n_outputs=n_outputs, _threads_per_block=_threads_per_block,
+                                          _maximum=maximum, _inf=math.inf)
+                else:
+                    driver = _make_driver(_numba_reduce_driver, kernel_function, '_numba' + suffix, self,
+                                          _maximum=maximum)
+
+            if self.use_cuda:
+                driver = cuda.jit(cache=use_cache)(driver)  # alternative: cuda.jit(fastmath=True)
+            else:
+                driver = numba.jit(parallel=True, nogil=True, fastmath=True, cache=use_cache)(driver)
+            _drivers[key] = driver
+        return driver
+
+    def _get_indexed(self, kernel_function):
+        """Return a kernel with arguments (i, indices, *args) that calls kernel_function(indices[i], *args)."""
+        key = (self.name, kernel_function)
+        kernel = _indexed_kernels.get(key)
+        if kernel is None:
+            kernel = mynonparjit(_make_driver(_indexed_kernel, kernel_function, '_indexed', self))
+            _indexed_kernels[key] = kernel
+        return kernel
+
+    def parallel_loop(self, kernel_function, iter_max, *args, stream=None, indices=None):
+        """See my_parallel_loop()."""
+        if profiling.enabled:
+            start = profiling.clock()
+            self._loop(kernel_function, iter_max, args, stream, indices)
+            self._record(kernel_function, iter_max, args, stream, start)
+        else:
+            self._loop(kernel_function, iter_max, args, stream, indices)
+
+    def parallel_reduce(self, kernel_function, iter_max, *args, n_outputs=1, ops=None, stream=None, indices=None):
+        """See my_parallel_reduce()."""
+        if ops is None:
+            maximum = (False,) * n_outputs
+        else:
+            if len(ops) != n_outputs or any(op not in ('sum', 'max') for op in ops):
+                raise ValueError("Expected 'sum' or 'max' for each of the {} outputs: {}".format(n_outputs, ops))
+            maximum = tuple(op == 'max' for op in ops)
+        if profiling.enabled:
+            start = profiling.clock()
+            result = self._reduce(kernel_function, iter_max, args, n_outputs, stream, indices, maximum)
+            self._record(kernel_function, iter_max, args, stream, start)
+            return result
+        return self._reduce(kernel_function, iter_max, args, n_outputs, stream, indices, maximum)
+
+    def _record(self, kernel_function, iter_max, args, stream, start):
+        if self.use_cuda:
+            # wait for the kernel to finish
+            if stream is None:
+                cuda.synchronize()
+            else:
+                stream.synchronize()
+        profiling.record(_kernel_name(kernel_function), 'kernel', start, profiling.clock(),
+                         iter_max, profiling.estimate_bytes(args))
+
+    def _loop(self, kernel_function, iter_max, args, stream, indices=None):
+        if self.use_python:
+            # loop over the function directly:
+            kernel_function = _get_py_func(kernel_function)
+            for xi in (range(iter_max) if indices is None else indices[:iter_max]):
+                kernel_function(xi, *args)
+            return
+
+        if indices is not None:
+            kernel_function = self._get_indexed(kernel_function)
+            args = (indices,) + args
+
+        if self.use_cuda:
+            # Call the compiled cuda kernel function:
+            blockspergrid = math.ceil(iter_max / _threads_per_block)
+            self._get_driver(kernel_function)[blockspergrid, _threads_per_block, stream](iter_max, *args)
+
+        else: # use_numba
+            # Call the compiled numba prange function:
+            self._get_driver(kernel_function)(iter_max, *args)
+
+    def _reduce(self, kernel_function, iter_max, args, n_outputs, stream, indices=None, maximum=None):
+        if maximum is None:
+            maximum = (False,) * n_outputs
+        # initial values: 0 for the sums, -inf for the maxima
+        initial = np.where(maximum, -np.inf, 0.0)
+
+        if self.use_python:
+            kernel_function = _get_py_func(kernel_function)
+            result = initial.copy()
+            for xi in (range(iter_max) if indices is None else indices[:iter_max]):
+                r = kernel_function(xi, *args)
+                for j in range(n_outputs):
+                    if maximum[j]:
+                        result[j] = max(result[j], r[j])
+                    else:
+                        result[j] += r[j]
+            return result
+
+        if indices is not None:
+            kernel_function = self._get_indexed(kernel_function)
+            args = (indices,) + args
+
+        if self.use_cuda:
+            d_result = cuda.to_device(initial, stream=stream)
+            blockspergrid = math.ceil(iter_max / _threads_per_block)
+            self._get_driver(kernel_function, n_outputs, maximum)[blockspergrid, _threads_per_block, stream](
+                iter_max, d_result, *args)
+            return d_result.copy_to_host(stream=stream)
+
+        else: # use_numba
+            partial = np.tile(initial, (numba.get_num_threads(), 1))
+            self._get_driver(kernel_function, n_outputs, maximum)(iter_max, partial, *args)
+            return np.where(maximum, np.max(partial, axis=0), np.sum(partial, axis=0))
+
+
+_backends = {}
+
+
+def available_backends():
+    """Names of the backends that can be used with the current import target.
+
+    The import target (MY_NUMBA_TARGET) decides how the device functions are compiled:
+    with 'numba' they are CPU functions which can also be called by the pure python loop
+    and, if a GPU is present, be compiled for CUDA as well. With 'cuda' they are CUDA
+    device functions and with 'python' they are not compiled at all.
+    """
+    if use_python:
+        return ['python']
+    if use_cuda:
+        return ['cuda']
+    if cuda.is_available():
+        return ['python', 'numba', 'cuda']
+    return ['python', 'numba']
 
-def my_parallel_loop(kernel_function, iter_max, *args, stream=None):
+
+def get_backend(backend=None):
+    """Return the backend with the given name.
+
+    :param backend: 'python', 'numba', 'cuda', a Backend instance or None for the
+                    default backend given by MY_NUMBA_TARGET
+    :return: Backend instance (one shared instance per name)
+    """
+    if isinstance(backend, Backend):
+        return backend
+    name = target if backend is None else backend.lower()
+    instance = _backends.get(name)
+    if instance is None:
+        if name not in available_backends():
+            raise ValueError("Backend '{}' not available with MY_NUMBA_TARGET={} (available: {})"
+                             .format(name, target, ", ".join(available_backends())))
+        instance = Backend(name)
+        _backends[name] = instance
+    return instance
+
+
+def my_parallel_loop(kernel_function, iter_max, *args, stream=None, backend=None, indices=None):
     """Perform parallel loop over a kernel function either on CPU
     (using Numba's prange) or on GPU (using a compiled cuda kernel).
 
+    The parallel loop is compiled once per backend and kernel function and cached on disk.
+
     :param kernel_function: kernel function with arguments (i, *args)
     :param iter_max: maximum index for iteration
     :param args: optional arguments
+    :param backend: backend (or its name) to run on, default: MY_NUMBA_TARGET
+    :param indices: optional integer array (on the device) of the sites i = indices[0] ... indices[iter_max - 1]
+                    to run on, instead of i = 0 ... iter_max - 1
     """
-    global _unique_counter
+    get_backend(backend).parallel_loop(kernel_function, iter_max, *args, stream=stream, indices=indices)
 
-    if use_python:
-        # loop over the function directly:
-        for xi in range(iter_max):
-            kernel_function(xi, *args)
-
-    elif use_cuda:
-        if not hasattr(kernel_function, 'compiled_cuda_kernel'):
-            # Create compiled cuda kernel for given kernel function
-
-            # Create string of arguments 'c1, c2, c3, [...]' for len(args)
-            args_string = ', '.join('c' + str(i) for i in range(len(args)))
-            _unique_counter += 1
-            try:
-                original_name = kernel_function.py_func.__name__
-            except AttributeError:
-                # Probably running the CUDA simulator which does not provide the name
-                original_name = "no_name"
-            code = """def {}_cuda_kernel(iter_max, {}):
-                          xi = cuda.grid(1)
-                          if xi < iter_max:
-                              _kernel_function_{}(xi, {})""".format(original_name, args_string, _unique_counter, args_string)
-            locals_copy = locals()
-            globals()['_kernel_function_{}'.format(_unique_counter)] = kernel_function
-            exec(code, globals(), locals_copy)
-            cuda_kernel = locals_copy[original_name + '_cuda_kernel']
-            kernel_function.compiled_cuda_kernel = cuda.jit(cuda_kernel)  # alternative: cuda.jit(fastmath=True)(cuda_kernel)
 
-        # Call the compiled cuda kernel function:
-        threadsperblock = 256
-        blockspergrid = math.ceil(iter_max / threadsperblock)
-        kernel_function.compiled_cuda_kernel[blockspergrid, threadsperblock,stream](iter_max, *args)
-
-    else: # use_numba
-        if not hasattr(kernel_function, 'compiled_numba_prange'):
-            # Create compiled prange loop for given kernel function
-
-            # Create string of arguments 'c1, c2, c3, [...]' for len(args)
-            args_string = ', '.join('c' + str(i) for i in range(len(args)))
-            _unique_counter += 1
-            original_name = kernel_function.py_func.__name__
-            code = """def {}_numba_prange(iter_max, {}):
-                          for xi in prange(iter_max):
-                              _kernel_function_{}(xi, {})""".format(original_name, args_string, _unique_counter, args_string)
-            locals_copy = locals()
-            globals()['_kernel_function_{}'.format(_unique_counter)] = kernel_function
-            exec(code, globals(), locals_copy)
-            numba_prange = locals_copy[original_name + '_numba_prange']
-            kernel_function.compiled_numba_prange = myjit(numba_prange)
-
-        # Call the compiled numba prange function:
-        kernel_function.compiled_numba_prange(iter_max, *args)
+def my_parallel_reduce(kernel_function, iter_max, *args, n_outputs=1, ops=None, stream=None, backend=None,
+                       indices=None):
+    """Sum the values of a kernel function over all sites, either on CPU
+    (per-thread partial sums using Numba's prange) or on GPU (block-wise
+    reduction in shared memory).
 
+    In contrast to my_cuda_sum() no per-site array has to be filled
+    and the arguments are left intact.
 
-##############################################################################
+    :param kernel_function: kernel function with arguments (i, *args) that returns
+                            a tuple of n_outputs floats of the same type
+    :param iter_max: maximum index for iteration
+    :param args: optional arguments
+    :param n_outputs: number of values returned by the kernel function
+    :param ops: optional sequence with 'sum' or 'max' for every output (default: all 'sum')
+    :param backend: backend (or its name) to run on, default: MY_NUMBA_TARGET
+    :param indices: optional array of the sites to sum over, see my_parallel_loop()
+    :return: numpy array with the n_outputs sums or maxima (in double precision)
+    """
+    return get_backend(backend).parallel_reduce(kernel_function, iter_max, *args,
+                                                n_outputs=n_outputs, ops=ops, stream=stream, indices=indices)
+
+
+def my_parallel_fill(array, value, sites, backend=None):
+    """Set all entries of a host array whose leading dimensions are the 'sites' lattice sites.
+
+    On the numba backend the entries of every site are written by the thread that processes
+    this site in my_parallel_loop() (same partition of the sites). On NUMA systems the first
+    write to a page decides the memory node it is placed on: freshly allocated arrays filled
+    this way are local to the threads which later work on them.
+
+    :param array: numpy array with sites * k entries
+    :param value: scalar or values along the last axis of the array
+    :param sites: number of lattice sites (iter_max of the kernels using the array)
+    :param backend: backend (or its name), default: MY_NUMBA_TARGET
+    """
+    if not get_backend(backend).use_numba:
+        array[...] = value
+        return
+    rows = array.reshape(sites, -1)
+    row = np.resize(np.asarray(value, dtype=array.dtype), rows.shape[1])
+    my_parallel_loop(_fill_kernel, sites, rows, row, backend=backend)
 
-# TODO: implement GPU sum version which keeps the array intact
+
+def my_parallel_zeros(shape, dtype, sites, backend=None):
+    """Array of zeros whose pages are first touched in parallel, see my_parallel_fill()."""
+    # large arrays of zeros are allocated without touching the pages (calloc)
+    array = np.zeros(shape, dtype=dtype)
+    if get_backend(backend).use_numba:
+        my_parallel_fill(array, 0, sites, backend)
+    return array
+
+
+@site_kernel
+@mynonparjit
+def _fill_kernel(xi, rows, row):
+    for i in range(rows.shape[1]):
+        rows[xi, i] = row[i]
+
+
+##############################################################################
 
 def my_cuda_sum(array, stream=None):
     """
@@ -132,7 +534,8 @@ def my_cuda_sum(array, stream=None):
 
     The result is found in array[0].
     This operation leaves the rest of the array in an undefined state.
-    If you need your array afterwards, copy it before you apply the sum.
+    If you need your array afterwards, copy it before you apply the sum
+    or use my_parallel_reduce() instead.
     """
     nmax = array.size
     stride = 1
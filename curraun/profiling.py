@@ -0,0 +1,185 @@
+"""
+    Opt-in profiling of the site kernels and of the python code around them.
+
+    Usage:
+
+        import curraun.profiling as profiling
+        profiling.enable()
+
+        ... run the simulation ...
+
+        profiling.print_table()
+        profiling.export_chrome_trace("trace.json")   # open in chrome://tracing or ui.perfetto.dev
+
+    Profiling can also be switched on with the environment variable MY_NUMBA_PROFILE=1.
+
+    Every call of my_parallel_loop() and my_parallel_reduce() is recorded as a kernel with its
+    wall time, the number of sites and an estimate of the memory traffic, which is the total size
+    of all array arguments (every array counted once per call, i.e. read or written once).
+    Regions (e.g. evolve_leapfrog) are recorded around the kernels; the 'self' time of a region
+    is the time not spent in kernels, i.e. python dispatch and host code.
+
+    The first call of a kernel includes its compilation (see python -m curraun.warmup).
+    On the CUDA backend every kernel launch is synchronized while profiling is enabled,
+    therefore asynchronous execution is lost.
+"""
+import os
+import json
+import time
+import functools
+
+enabled = os.environ.get('MY_NUMBA_PROFILE', '0') != '0'
+
+# Accumulated statistics per name
+stats = {}
+
+# Recorded events in Chrome trace-event format
+events = []
+
+# Maximum number of stored trace events (statistics are always accumulated)
+max_events = 1000000
+
+# Open regions: [name, time spent in nested kernels and regions]
+_stack = []
+
+_t0 = time.perf_counter()
+
+clock = time.perf_counter
+
+
+class _Stat:
+    def __init__(self, category):
+        self.category = category
+        self.calls = 0
+        self.time = 0.0
+        self.self_time = 0.0
+        self.sites = 0
+        self.nbytes = 0
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    """Remove all recorded statistics and events."""
+    global _t0
+    stats.clear()
+    del events[:]
+    del _stack[:]
+    _t0 = time.perf_counter()
+
+
+def estimate_bytes(args):
+    """Total size of all array arguments (numpy, numba device or cupy arrays)."""
+    nbytes = 0
+    for a in args:
+        if hasattr(a, 'shape'):
+            nbytes += getattr(a, 'nbytes', 0)
+    return nbytes
+
+
+def record(name, category, start, end, sites=0, nbytes=0):
+    """Record an event that started and ended at the given clock() values."""
+    duration = end - start
+
+    stat = stats.get(name)
+    if stat is None:
+        stat = _Stat(category)
+        stats[name] = stat
+    stat.calls += 1
+    stat.time += duration
+    stat.sites += sites
+    stat.nbytes += nbytes
+
+    if _stack:
+        _stack[-1][1] += duration
+
+    if len(events) < max_events:
+        args = {}
+        if category == 'kernel':
+            args = {'sites': sites, 'bytes': nbytes}
+        events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                       'ts': (start - _t0) * 1e6, 'dur': duration * 1e6, 'args': args})
+    return stat
+
+
+class region:
+    """Context manager that records the enclosed code as a region.
+
+        with profiling.region('evolve_leapfrog'):
+            ...
+    """
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if enabled:
+            _stack.append([self.name, 0.0])
+            self.start = clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.start is not None:
+            end = clock()
+            children = _stack.pop()[1]
+            stat = record(self.name, 'region', self.start, end)
+            stat.self_time += end - self.start - children
+            self.start = None
+        return False
+
+
+def profile(name):
+    """Decorator that records every call of a function as a region."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with region(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def table():
+    """Return the accumulated statistics as a text table."""
+    total = sum(stat.time for stat in stats.values() if stat.category == 'kernel')
+    lines = []
+    lines.append("{:<55} {:>8} {:>10} {:>10} {:>7} {:>10} {:>10} {:>8}".format(
+        "Kernel / region", "Calls", "Total [s]", "Mean [ms]", "Kernel%", "Self [s]", "Sites/s", "GB/s"))
+    for category in ['kernel', 'region']:
+        items = [(name, stat) for name, stat in stats.items() if stat.category == category]
+        items.sort(key=lambda item: item[1].time, reverse=True)
+        for name, stat in items:
+            mean = stat.time / stat.calls * 1e3
+            if category == 'kernel':
+                fraction = "{:7.1f}".format(100.0 * stat.time / total) if total > 0 else "{:>7}".format("-")
+                self_time = "{:>10}".format("-")
+                rate = stat.sites / stat.time if stat.time > 0 else 0.0
+                bandwidth = stat.nbytes / stat.time / 1024 ** 3 if stat.time > 0 else 0.0
+                rates = "{:10.3g} {:8.2f}".format(rate, bandwidth)
+            else:
+                fraction = "{:>7}".format("-")
+                self_time = "{:10.4f}".format(stat.self_time)
+                rates = "{:>10} {:>8}".format("-", "-")
+            lines.append("{:<55} {:8d} {:10.4f} {:10.4f} {} {} {}".format(
+                name, stat.calls, stat.time, mean, fraction, self_time, rates))
+    return "\n".join(lines)
+
+
+def print_table():
+    print(table())
+
+
+def export_chrome_trace(filename):
+    """Write the recorded events as Chrome trace-event JSON."""
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
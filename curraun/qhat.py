@@ -1,10 +1,9 @@
-from curraun.numba_target import myjit, prange, my_parallel_loop, use_cuda
+from curraun.numba_target import myjit, mynonparjit, prange, my_parallel_loop, my_parallel_zeros, site_kernel, cuda
 import numpy as np
 import curraun.lattice as l
 import curraun.su as su
 import curraun.kappa as kappa
-if use_cuda:
-    import numba.cuda as cuda
+import curraun.profiling as profiling
 
 """
     A module for various calculations related to momentum broadening and the \hat{q} parameter.
@@ -17,27 +16,31 @@ class TransportedForce:
         self.n = s.n
         self.dtstep = round(1.0 / s.dt)
 
+        # number of sites (of all events for a BatchedSimulation)
+        nsites = self.n ** 2 if s.batch is None else s.batch * self.n ** 2
+
         # light-like wilson lines
-        self.v = np.zeros((self.n ** 2, su.GROUP_ELEMENTS), dtype=su.GROUP_TYPE)
-        my_parallel_loop(reset_wilsonfield, self.n ** 2, self.v)
+        self.v = np.zeros((nsites, su.GROUP_ELEMENTS), dtype=su.GROUP_TYPE)
+        my_parallel_loop(reset_wilsonfield, nsites, self.v, backend=s.backend)
 
         # transported force
-        self.f = np.zeros((self.n ** 2, 3, su.GROUP_ELEMENTS), dtype=su.GROUP_TYPE)
+        self.f = my_parallel_zeros((nsites, 3, su.ALGEBRA_STORAGE_ELEMENTS), su.ALGEBRA_TYPE, nsites, backend=s.backend)
 
         # integrated force
-        self.fi = np.zeros((self.n ** 2, 3, su.GROUP_ELEMENTS), dtype=su.GROUP_TYPE)
+        self.fi = my_parallel_zeros((nsites, 3, su.ALGEBRA_STORAGE_ELEMENTS), su.ALGEBRA_TYPE, nsites, backend=s.backend)
 
         # single components
-        self.p_perp_x = np.zeros(self.n ** 2, dtype=np.double)
-        self.p_perp_y = np.zeros(self.n ** 2, dtype=np.double)
-        self.p_perp_z = np.zeros(self.n ** 2, dtype=np.double)
-
-        # mean values
-        self.p_perp_mean = np.zeros(3, dtype=np.double)
-        if use_cuda:
+        self.p_perp_x = my_parallel_zeros(nsites, np.double, nsites, backend=s.backend)
+        self.p_perp_y = my_parallel_zeros(nsites, np.double, nsites, backend=s.backend)
+        self.p_perp_z = my_parallel_zeros(nsites, np.double, nsites, backend=s.backend)
+
+        # mean values (one row per event for a BatchedSimulation)
+        mean_shape = 3 if s.batch is None else (s.batch, 3)
+        self.p_perp_mean = np.zeros(mean_shape, dtype=np.double)
+        if s.backend.use_cuda:
             # use pinned memory for asynchronous data transfer
-            self.p_perp_mean = cuda.pinned_array(3, dtype=np.double)
-            self.p_perp_mean[0:3] = 0.0
+            self.p_perp_mean = cuda.pinned_array(mean_shape, dtype=np.double)
+            self.p_perp_mean[...] = 0.0
 
         # time counter
         self.t = 0
@@ -75,23 +78,27 @@ class TransportedForce:
     def copy_mean_to_host(self, stream=None):
         self.d_p_perp_mean.copy_to_host(self.p_perp_mean, stream)
 
+    @profiling.profile('qhat.TransportedForce.compute')
     def compute(self,stream=None):
+        # the time step may change between the calls (schedule.TimeStepSchedule)
+        self.dtstep = round(1.0 / self.s.dt)
         tint = round(self.s.t / self.s.dt)
         if tint % self.dtstep == 0 and tint >= 1:
             # compute un-transported f
             compute_f(self.s, self.d_f, round(self.s.t - 10E-8), stream)
 
             # apply parallel transport
-            apply_v(self.d_f, self.d_v, self.s.n, stream)
+            apply_v(self.d_f, self.d_v, self.s.n, stream, self.s.backend)
 
             # integrate f
-            integrate_f(self.d_f, self.d_fi, self.s.n, 1.0, stream)
+            integrate_f(self.d_f, self.d_fi, self.s.n, 1.0, stream, self.s.backend)
 
             # integrate perpendicular momentum
-            compute_p_perp(self.d_fi, self.d_p_perp_x, self.d_p_perp_y, self.d_p_perp_z, self.s.n, stream)
+            compute_p_perp(self.d_fi, self.d_p_perp_x, self.d_p_perp_y, self.d_p_perp_z, self.s.n, stream, self.s.backend)
 
             # calculate mean
-            compute_mean(self.d_p_perp_x, self.d_p_perp_y, self.d_p_perp_z, self.d_p_perp_mean, stream)
+            compute_mean(self.d_p_perp_x, self.d_p_perp_y, self.d_p_perp_z, self.d_p_perp_mean, stream, self.s.backend,
+                         self.s.batch)
 
         if tint % self.dtstep == self.dtstep / 2:
             # update v
@@ -99,6 +106,7 @@ class TransportedForce:
 
 
 
+@site_kernel
 @myjit
 def reset_wilsonfield(x, wilsonfield):
     su.store(wilsonfield[x], su.unit())
@@ -114,14 +122,29 @@ def update_v(s, v, t, stream):
     u = s.d_u0
     n = s.n
 
-    my_parallel_loop(update_v_kernel, n * n, u, v, t, n, stream=stream)
+    if s.batch is None:
+        my_parallel_loop(update_v_kernel, n * n, u, v, t, n, stream=stream, backend=s.backend)
+    else:
+        v = v.reshape((s.batch, n * n) + v.shape[1:])
+        my_parallel_loop(update_v_batch_kernel, s.batch * n * n, u, v, t, n, stream=stream, backend=s.backend)
 
+@site_kernel
 @myjit
 def update_v_kernel(xi, u, v, t, n):
     xs = l.shift(xi, 0, t, n)
 
-    b1 = su.mul(v[xi], u[xs, 0])
+    b1 = su.mul(v[xi], su.load_link(u[xs, 0]))
     su.store(v[xi], b1)
+
+
+# @myjit
+@site_kernel
+@mynonparjit
+def update_v_batch_kernel(xb, u, v, t, n):
+    # site xi of event b (BatchedSimulation)
+    b = xb // (n * n)
+    xi = xb - b * n * n
+    update_v_kernel(xi, u[b], v[b], t, n)
     #l.normalize(v[xi])
 
 
@@ -147,11 +170,23 @@ def compute_f(s, f, t, stream):
     tau = s.t # TODO: use tau_inverse = 1/s.t to avoid division in kernel? (measurable effect?)
     sign = +1.0 # TODO: can this constant be removed?
 
-    my_parallel_loop(compute_f_kernel, n * n, n, u0, aeta0, aeta1, peta1, peta0, pt1, pt0, f, t, tau,
-                     stream=stream)
+    # plaquettes and transports of u0, aeta0 stored by the last time step
+    # (see core.Simulation.plaquettes(), transports())
+    plaq, cached = s.plaquettes()
+    aeta_fwd, fwd_cached = s.transports()
 
+    if s.batch is None:
+        my_parallel_loop(compute_f_kernel, n * n, n, s.d_nn, u0, aeta0, aeta1, peta1, peta0, pt1, pt0, f, t, tau,
+                         plaq, cached, aeta_fwd, fwd_cached, stream=stream, backend=s.backend)
+    else:
+        f = f.reshape((s.batch, n * n) + f.shape[1:])
+        my_parallel_loop(compute_f_batch_kernel, s.batch * n * n, n, s.d_nn, u0, aeta0, aeta1, peta1, peta0, pt1, pt0, f, t,
+                         tau, plaq, cached, aeta_fwd, fwd_cached, stream=stream, backend=s.backend)
+
+@site_kernel
 @myjit
-def compute_f_kernel(xi, n, u0, aeta0, aeta1, peta1, peta0, pt1, pt0, f, t, tau):
+def compute_f_kernel(xi, n, nn, u0, aeta0, aeta1, peta1, peta0, pt1, pt0, f, t, tau, plaq, cached, aeta_fwd,
+                     fwd_cached):
 
     # f_1 = E_1 (index 0)
 
@@ -159,66 +194,86 @@ def compute_f_kernel(xi, n, u0, aeta0, aeta1, peta1, peta0, pt1, pt0, f, t, tau)
 
     bf0 = su.zero()
 
-    bf0 = su.add(bf0, pt1[xs, 0])
-    bf0 = su.add(bf0, pt0[xs, 0])
+    bf0 = su.add(bf0, su.load_algebra(pt1[xs, 0]))
+    bf0 = su.add(bf0, su.load_algebra(pt0[xs, 0]))
 
-    xs2 = l.shift(xs, 0, -1, n)
-    b1 = l.act(su.dagger(u0[xs2, 0]), pt1[xs2, 0])
+    xs2 = l.shift(xs, 0, -1, n, nn)
+    b1 = l.act(su.dagger(su.load_link(u0[xs2, 0])), su.load_algebra(pt1[xs2, 0]))
     bf0 = su.add(bf0, b1)
-    b1 = l.act(su.dagger(u0[xs2, 0]), pt0[xs2, 0])
+    b1 = l.act(su.dagger(su.load_link(u0[xs2, 0])), su.load_algebra(pt0[xs2, 0]))
     bf0 = su.add(bf0, b1)
     bf0 = su.mul_s(bf0, 0.25 / tau)
-    su.store(f[xi, 0], bf0)
+    su.store_algebra(f[xi, 0], bf0)
 
     # f_2 = E_2 - B_3 (index 1)
 
     xs = l.shift(xi, 0, t, n)
-    xs2 = l.shift(xs, 1, -1, n)
+    xs2 = l.shift(xs, 1, -1, n, nn)
 
     bf1 = su.zero()
 
     # quadratically accurate +Ey
-    bf1 = l.add_mul(bf1, pt1[xs, 1], 0.25 / tau)
-    bf1 = l.add_mul(bf1, pt0[xs, 1], 0.25 / tau)
-    xs3 = l.shift(xs, 1, -1, n)
-    b1 = l.act(su.dagger(u0[xs3, 1]), pt1[xs2, 1])
+    bf1 = l.add_mul(bf1, su.load_algebra(pt1[xs, 1]), 0.25 / tau)
+    bf1 = l.add_mul(bf1, su.load_algebra(pt0[xs, 1]), 0.25 / tau)
+    xs3 = l.shift(xs, 1, -1, n, nn)
+    b1 = l.act(su.dagger(su.load_link(u0[xs3, 1])), su.load_algebra(pt1[xs2, 1]))
     bf1 = l.add_mul(bf1, b1, 0.25 / tau)
-    b1 = l.act(su.dagger(u0[xs3, 1]), pt0[xs2, 1])
+    b1 = l.act(su.dagger(su.load_link(u0[xs3, 1])), su.load_algebra(pt0[xs2, 1]))
     bf1 = l.add_mul(bf1, b1, 0.25 / tau)
 
     # quadratically accurate -Bz
-    b1 = l.plaq(u0, xs, 0, 1, 1, 1, n)
-    b2 = su.ah(b1)
-    bf1 = l.add_mul(bf1, b2, +0.25)
+    if cached:
+        # from the stored plaquettes (see core.Simulation.plaquettes())
+        bf1 = l.add_mul(bf1, l.clover(plaq, u0, xs, n, nn), +0.25)
+    else:
+        b1 = l.plaq(u0, xs, 0, 1, 1, 1, n, nn)
+        b2 = su.ah(b1)
+        bf1 = l.add_mul(bf1, b2, +0.25)
 
-    b1 = l.plaq(u0, xs, 0, 1, 1, -1, n)
-    b2 = su.ah(b1)
-    bf1 = l.add_mul(bf1, b2, -0.25)
+        b1 = l.plaq(u0, xs, 0, 1, 1, -1, n, nn)
+        b2 = su.ah(b1)
+        bf1 = l.add_mul(bf1, b2, -0.25)
 
-    b1 = l.plaq(u0, xs, 1, 0, 1, -1, n)
-    b2 = su.ah(b1)
-    bf1 = l.add_mul(bf1, b2, +0.25)
+        b1 = l.plaq(u0, xs, 1, 0, 1, -1, n, nn)
+        b2 = su.ah(b1)
+        bf1 = l.add_mul(bf1, b2, +0.25)
 
-    b1 = l.plaq(u0, xs, 1, 0, -1, -1, n)
-    b2 = su.ah(b1)
-    bf1 = l.add_mul(bf1, b2, -0.25)
+        b1 = l.plaq(u0, xs, 1, 0, -1, -1, n, nn)
+        b2 = su.ah(b1)
+        bf1 = l.add_mul(bf1, b2, -0.25)
 
-    su.store(f[xi, 1], bf1)
+    su.store_algebra(f[xi, 1], bf1)
 
     # f_3 = E_3 + B_2 (index 2)
     bf2 = su.zero()
 
     # Accurate +E_z
-    bf2 = l.add_mul(bf2, peta1[xs], 0.5)
-    bf2 = l.add_mul(bf2, peta0[xs], 0.5)
+    bf2 = l.add_mul(bf2, su.load_algebra(peta1[xs]), 0.5)
+    bf2 = l.add_mul(bf2, su.load_algebra(peta0[xs]), 0.5)
 
     # Quadratically accurate +B_y
-    b1 = l.transport(aeta0, u0, xs, 0, +1, n)
-    b2 = l.transport(aeta0, u0, xs, 0, -1, n)
+    if fwd_cached:
+        # from the stored transports (see core.Simulation.transports())
+        b1 = su.load_algebra(aeta_fwd[xs, 0])
+    else:
+        b1 = l.transport(aeta0, u0, xs, 0, +1, n, nn)
+    b2 = l.transport(aeta0, u0, xs, 0, -1, n, nn)
     b1 = l.add_mul(b1, b2, -1.0)
     bf2 = l.add_mul(bf2, b1, 0.5 / tau)
 
-    su.store(f[xi, 2], bf2)
+    su.store_algebra(f[xi, 2], bf2)
+
+
+# @myjit
+@site_kernel
+@mynonparjit
+def compute_f_batch_kernel(xb, n, nn, u0, aeta0, aeta1, peta1, peta0, pt1, pt0, f, t, tau, plaq, cached, aeta_fwd,
+                           fwd_cached):
+    # site xi of event b (BatchedSimulation)
+    b = xb // (n * n)
+    xi = xb - b * n * n
+    compute_f_kernel(xi, n, nn, u0[b], aeta0[b], aeta1[b], peta1[b], peta0[b], pt1[b], pt0[b], f[b], t, tau, plaq[b],
+                     cached, aeta_fwd[b], fwd_cached)
 
 
 """
@@ -227,16 +282,18 @@ def compute_f_kernel(xi, n, u0, aeta0, aeta1, peta1, peta0, pt1, pt0, f, t, tau)
 """
 
 
-def apply_v(f, v, n, stream):
-    my_parallel_loop(apply_v_kernel, n * n, f, v, n, stream=stream)
+def apply_v(f, v, n, stream, backend=None):
+    # f.shape[0] == n * n for a single event
+    my_parallel_loop(apply_v_kernel, f.shape[0], f, v, n, stream=stream, backend=backend)
 
 
+@site_kernel
 @myjit
 def apply_v_kernel(xi, f, v, n):
     for d in range(3):
-        b1 = l.act(v[xi], f[xi, d])
+        b1 = l.act(v[xi], su.load_algebra(f[xi, d]))
         b1 = su.ah(b1)
-        su.store(f[xi, d], b1)
+        su.store_algebra(f[xi, d], b1)
 
 
 """
@@ -244,8 +301,8 @@ def apply_v_kernel(xi, f, v, n):
 """
 
 
-def integrate_f(f, fi, n, dt, stream):
-    kappa.integrate_f(f, fi, n, dt, stream)
+def integrate_f(f, fi, n, dt, stream, backend=None):
+    kappa.integrate_f(f, fi, n, dt, stream, backend)
 
 
 """
@@ -255,9 +312,9 @@ def integrate_f(f, fi, n, dt, stream):
 """
 
 
-def compute_p_perp(fi, p_perp_x, p_perp_y, p_perp_z, n, stream):
-    kappa.compute_p_perp(fi, p_perp_x, p_perp_y, p_perp_z, n, stream)
+def compute_p_perp(fi, p_perp_x, p_perp_y, p_perp_z, n, stream, backend=None):
+    kappa.compute_p_perp(fi, p_perp_x, p_perp_y, p_perp_z, n, stream, backend)
 
 
-def compute_mean(p_perp_x, p_perp_y, p_perp_z, p_perp_mean, stream):
-    kappa.compute_mean(p_perp_x, p_perp_y, p_perp_z, p_perp_mean, stream)
+def compute_mean(p_perp_x, p_perp_y, p_perp_z, p_perp_mean, stream, backend=None, batch=None):
+    kappa.compute_mean(p_perp_x, p_perp_y, p_perp_z, p_perp_mean, stream, backend, batch)
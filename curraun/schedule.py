@@ -0,0 +1,120 @@
+"""
+    Adaptive time steps: fine steps at early times, where the 1 / tau and tau factors of the
+    equations of motion are large, and coarse steps later, where the fields are smooth.
+
+    Usage:
+
+        s = core.Simulation(n, 1.0 / 64, g)
+        initial.init(s, va, vb)
+        sched = schedule.TimeStepSchedule(s, tol=1e-3, dts_min=4, dts_max=64)
+
+        while s.t < tmax:
+            sched.evolve()              # instead of core.evolve_leapfrog(s)
+            kappa_force.compute()       # observables as before
+            ...
+
+    The number of steps per lattice spacing DTS = 1 / dt is a power of two between dts_min and
+    dts_max, and it is only changed when the time reaches a multiple of 'every' lattice spacings.
+    The time s.t therefore stays an integer multiple of the current dt, and the integer (and half
+    integer) times of the observables (kappa.TransportedForce, qhat.TransportedForce) are hit exactly.
+
+    The time step is chosen from the residual of the energy balance of the boost invariant
+    fields, d(tau e) / d tau = - p_L, over the last step before every change:
+
+        r = |E(tau + dt) - E(tau) + dt (p_L(tau) + p_L(tau + dt)) / 2| / (dt E)
+
+    with E = tau e from energy.Energy. The residual decreases like dt ** 2.
+    If r exceeds tol the time step is halved, if r stayed below tol / 8 at the last 'patience'
+    checks it is doubled. A step is never repeated, the new time step applies from the current time on.
+"""
+import numpy as np
+
+import curraun.core as core
+import curraun.energy as energy
+
+
+class TimeStepSchedule:
+    """
+    :param s: Simulation object (dt = 1 / DTS with DTS a power of two between dts_min and dts_max)
+    :param tol: tolerance of the relative energy balance residual r
+    :param dts_min: smallest number of steps per lattice spacing (at least 2)
+    :param dts_max: largest number of steps per lattice spacing (default: the initial one)
+    :param every: lattice spacings between two checks (integer)
+    :param patience: number of checks with a small residual before the time step is doubled
+    """
+    def __init__(self, s, tol=1e-3, dts_min=2, dts_max=None, every=1, patience=2):
+        dts = round(1.0 / s.dt)
+        if dts_max is None:
+            dts_max = dts
+        for value in (dts, dts_min, dts_max):
+            if value < 2 or value & (value - 1):
+                raise ValueError("Steps per lattice spacing must be powers of two (at least 2): {}".format(value))
+        if s.dt != 1.0 / dts:
+            raise ValueError("Time step {} is not 1 / DTS".format(s.dt))
+        if not dts_min <= dts <= dts_max:
+            raise ValueError("Initial DTS = {} not within [{}, {}]".format(dts, dts_min, dts_max))
+        if round(s.t / s.dt) * s.dt != s.t:
+            raise ValueError("Time {} is not a multiple of the time step {}".format(s.t, s.dt))
+
+        self.s = s
+        self.tol = tol
+        self.dts_min = dts_min
+        self.dts_max = dts_max
+        self.every = every
+        self.patience = patience
+
+        self.energy = energy.Energy(s)
+        self.previous = None
+        self.small = 0
+        self.next_dt = None
+
+        # (time, DTS, residual) of every check
+        self.history = []
+
+    def evolve(self, stream=None):
+        """One time step (same as core.evolve_leapfrog()), followed by a check at the end of an interval."""
+        s = self.s
+        if self.next_dt is not None:
+            # change the time step only now, so that observables computed after the last step were still valid
+            s.set_dt(self.next_dt)
+            self.next_dt = None
+
+        core.evolve_leapfrog(s, stream)
+
+        # position of u1 (at t + dt) within the check interval
+        interval = round(self.every / s.dt)
+        position = round((s.t + s.dt) / s.dt) % interval
+        if position == interval - 1:
+            # one step before the end of the interval
+            self.previous = self._balance()
+        elif position == 0 and self.previous is not None:
+            self._check()
+
+    def _balance(self):
+        en = self.energy
+        en.compute()
+        # E = tau e and p_L at t + dt / 2
+        e = en.EL_mean + en.BL_mean + en.ET_mean + en.BT_mean
+        pl = (en.ET_mean + en.BT_mean - en.EL_mean - en.BL_mean) / (self.s.t + self.s.dt / 2)
+        return e, pl
+
+    def _check(self):
+        s = self.s
+        e0, pl0 = self.previous
+        e1, pl1 = self._balance()
+        self.previous = None
+
+        # largest residual of all events of a BatchedSimulation
+        r = np.max(np.abs(e1 - e0 + s.dt * (pl0 + pl1) / 2) / (s.dt * np.abs(e0 + e1) / 2))
+
+        dts = round(1.0 / s.dt)
+        self.history.append((s.t + s.dt, dts, float(r)))
+
+        # the residual grows by about a factor four when the time step is doubled
+        self.small = self.small + 1 if r < self.tol / 8 else 0
+        if r > self.tol and dts < self.dts_max:
+            self.next_dt = 1.0 / (2 * dts)
+            self.small = 0
+        elif self.small >= self.patience and dts > self.dts_min:
+            self.next_dt = 1.0 / (dts // 2)
+            self.small = 0
@@ -29,9 +29,34 @@ elif su_precision == 'double':
     print("Using double precision")
     GROUP_TYPE = np.float64
     GROUP_TYPE_REAL = np.float64
+elif su_precision == 'mixed':
+    # fields are stored in single precision, all arithmetic is done in double precision
+    print("Using mixed precision")
+    GROUP_TYPE = np.float64
+    GROUP_TYPE_REAL = np.float64
 else:
     print("Unsupported precision: " + su_precision)
 
+# Type of the fields of a Simulation (loaded with load(), load_link(), load_algebra())
+if su_precision == 'mixed':
+    GROUP_STORAGE_TYPE = np.float32
+else:
+    GROUP_STORAGE_TYPE = GROUP_TYPE
+GROUP_STORAGE_TYPE_REAL = GROUP_STORAGE_TYPE
+
+# Storage of algebra-valued fields (pt, aeta, peta and the transported forces), see load_algebra():
+#   'group'        ... GROUP_ELEMENTS entries (a[0] = 0 for algebra elements)
+#   'coefficients' ... ALGEBRA_ELEMENTS entries (algebra factors as in get_algebra_element())
+ALGEBRA_STORAGE = os.environ.get('ALGEBRA_STORAGE', 'group').lower()
+if ALGEBRA_STORAGE == 'group':
+    ALGEBRA_STORAGE_ELEMENTS = GROUP_ELEMENTS
+elif ALGEBRA_STORAGE == 'coefficients':
+    ALGEBRA_STORAGE_ELEMENTS = ALGEBRA_ELEMENTS
+else:
+    print("Unsupported algebra storage: " + ALGEBRA_STORAGE)
+ALGEBRA_STORAGE_TYPE = GROUP_STORAGE_TYPE
+ALGEBRA_TYPE = GROUP_TYPE
+
 # @myjit
 @mynonparjit
 def get_algebra_element(algebra_factors):
@@ -154,7 +179,33 @@ def store(g_to, g_from):
 # @myjit
 @mynonparjit
 def load(g):
-    return g[0], g[1], g[2], g[3]
+    return GROUP_TYPE(g[0]), GROUP_TYPE(g[1]), GROUP_TYPE(g[2]), GROUP_TYPE(g[3])
+
+# links are always stored with all GROUP_ELEMENTS entries (see su3.load_link() for compact links)
+load_link = load
+store_link = store
+
+# algebra element from stored algebra factors (same as get_algebra_element())
+# @myjit
+@mynonparjit
+def load_algebra_coefficients(c):
+    return GROUP_TYPE(0), GROUP_TYPE(0.5) * c[0], GROUP_TYPE(0.5) * c[1], GROUP_TYPE(0.5) * c[2]
+
+# store algebra factors of a (the anti-hermitian part of a is kept)
+# @myjit
+@mynonparjit
+def store_algebra_coefficients(c_to, a):
+    c_to[0] = 2 * a[1]
+    c_to[1] = 2 * a[2]
+    c_to[2] = 2 * a[3]
+
+# access to algebra-valued fields (see ALGEBRA_STORAGE)
+if ALGEBRA_STORAGE == 'coefficients':
+    load_algebra = load_algebra_coefficients
+    store_algebra = store_algebra_coefficients
+else:
+    load_algebra = load
+    store_algebra = store
 
 # trace
 # @myjit
@@ -174,6 +225,13 @@ def sq(a): # tr(mul(a,a)) - valid only for traceless matrices a.
 def dot(a, b): # TODO: remove
     return a[1] * b[1] + a[2] * b[2] + a[3] * b[3]
 
+# projection onto SU(2) (tuple version of normalize())
+# @myjit
+@mynonparjit
+def unitarize(u):
+    norm = GROUP_TYPE(1 / math.sqrt(u[0] ** 2 + u[1] ** 2 + u[2] ** 2 + u[3] ** 2))
+    return u[0] * norm, u[1] * norm, u[2] * norm, u[3] * norm
+
 # normalize su(2) group element
 @myjit
 def normalize(u):
@@ -42,13 +42,54 @@ elif su_precision == 'double':
     print("Using double precision")
     GROUP_TYPE = np.complex128 # two float64
     GROUP_TYPE_REAL = np.float64
+elif su_precision == 'mixed':
+    # fields are stored in single precision, all arithmetic is done in double precision
+    print("Using mixed precision")
+    GROUP_TYPE = np.complex128
+    GROUP_TYPE_REAL = np.float64
 else:
     print("Unsupported precision: " + su_precision)
 
+# Type of the fields of a Simulation (loaded with load(), load_link(), load_algebra())
+if su_precision == 'mixed':
+    GROUP_STORAGE_TYPE = np.complex64
+    GROUP_STORAGE_TYPE_REAL = np.float32
+else:
+    GROUP_STORAGE_TYPE = GROUP_TYPE
+    GROUP_STORAGE_TYPE_REAL = GROUP_TYPE_REAL
+
+# The constants are compiled into the kernels: changes have to be made before the first kernel
+# is compiled (they are part of the name of the cached drivers, see numba_target._config_tag()).
 EXP_MIN_TERMS = -1 # minimum number of terms in Taylor series
 EXP_MAX_TERMS = 100 # maximum number of terms in Taylor series
 EXP_ACCURACY_SQUARED = 1.e-40 # 1.e-32 # accuracy
 
+# Exponential map used by mexp() and dmexp():
+#   'taylor' ... Taylor series, valid for arbitrary matrices
+#   'exact'  ... closed form (Cayley-Hamilton), only valid for traceless anti-hermitian matrices
+EXP_METHOD = os.environ.get('SU3_EXP', 'taylor').lower()
+if EXP_METHOD not in ('taylor', 'exact'):
+    print("Unsupported SU(3) exponential: " + EXP_METHOD)
+
+EXP_EXACT_MIN_C1 = 1.e-20 # below this c1 = tr(Q^2)/2 the Taylor series is used by mexp_exact()
+DEXP_EXACT_MIN_C1 = 1.e-2 # below this c1 the Taylor series is used by dmexp_exact()
+
+# Storage of algebra-valued fields (pt, aeta, peta and the transported forces), see load_algebra():
+#   'group'        ... GROUP_ELEMENTS complex entries (full matrix)
+#   'coefficients' ... ALGEBRA_ELEMENTS real entries (algebra factors as in get_algebra_element())
+# ALGEBRA_STORAGE_TYPE is used for the simulation fields, ALGEBRA_TYPE for accumulated quantities.
+ALGEBRA_STORAGE = os.environ.get('ALGEBRA_STORAGE', 'group').lower()
+if ALGEBRA_STORAGE == 'group':
+    ALGEBRA_STORAGE_ELEMENTS = GROUP_ELEMENTS
+    ALGEBRA_STORAGE_TYPE = GROUP_STORAGE_TYPE
+    ALGEBRA_TYPE = GROUP_TYPE
+elif ALGEBRA_STORAGE == 'coefficients':
+    ALGEBRA_STORAGE_ELEMENTS = ALGEBRA_ELEMENTS
+    ALGEBRA_STORAGE_TYPE = GROUP_STORAGE_TYPE_REAL
+    ALGEBRA_TYPE = GROUP_TYPE_REAL
+else:
+    print("Unsupported algebra storage: " + ALGEBRA_STORAGE)
+
 def complex_tuple(*t):
     return tuple(map(GROUP_TYPE, t))
 
@@ -156,13 +197,13 @@ def mul(a, b):
 # exponential map
 # @myjit
 @mynonparjit
-def mexp(a):
+def mexp_taylor(a):
     """ Calculate exponential using Taylor series
 
-    mexp(a) = 1 + a + a^2 / 2 + a^3 / 6 + ...
+    mexp_taylor(a) = 1 + a + a^2 / 2 + a^3 / 6 + ...
 
     >>> a = id0
-    >>> mexp(a)
+    >>> mexp_taylor(a)
     ((2.7182818284590455+0j), 0j, 0j, 0j, (2.7182818284590455+0j), 0j, 0j, 0j, (2.7182818284590455+0j))
 
     """
@@ -184,14 +225,14 @@ def mexp(a):
 # derivative of exponential map
 # @myjit
 @mynonparjit
-def dmexp(a, da):
+def dmexp_taylor(a, da):
     """ Calculate derivative of exponential using Taylor series
 
-    dmexp(a, da) = 0 + da + (da a + a da) / 2 + (da a a + a da a + a a da) / 6 + ...
+    dmexp_taylor(a, da) = 0 + da + (da a + a da) / 2 + (da a a + a da a + a a da) / 6 + ...
 
     >>> a = id0
     >>> da = s1
-    >>> dmexp(a, da)
+    >>> dmexp_taylor(a, da)
     (0j, (2.7182818284590455+0j), 0j, (2.7182818284590455+0j), 0j, 0j, 0j, 0j, 0j)
 
     """
@@ -217,6 +258,182 @@ def dmexp(a, da):
         print("Derivative of exponential did not reach desired accuracy")  # TODO: remove debugging code
     return res
 
+# closed form of the exponential map for traceless anti-hermitian matrices
+# a = iQ with hermitian traceless Q, exp(iQ) = f0 + f1 Q + f2 Q^2 (Cayley-Hamilton)
+# see C. Morningstar, M. Peardon, Phys. Rev. D 69 (2004) 054501, hep-lat/0311018
+
+# xi0(w) = sin(w) / w
+# @myjit
+@mynonparjit
+def _exp_xi0(w):
+    if math.fabs(w) < 0.05:
+        w2 = w * w
+        return 1 - w2 / 6 * (1 - w2 / 20 * (1 - w2 / 42))
+    return math.sin(w) / w
+
+# xi1(w) = cos(w) / w^2 - sin(w) / w^3
+# @myjit
+@mynonparjit
+def _exp_xi1(w):
+    if math.fabs(w) < 0.05:
+        w2 = w * w
+        return -(1 - w2 / 10 * (1 - w2 / 28 * (1 - w2 / 54))) / 3
+    return math.cos(w) / (w * w) - math.sin(w) / (w * w * w)
+
+# auxiliary parameters u, w from c0 = det(Q) >= 0 and c1 = tr(Q^2) / 2 > 0
+# @myjit
+@mynonparjit
+def _exp_parameters(c0, c1):
+    c0_max = 2 * (c1 / 3) ** 1.5
+    theta = math.acos(min(c0 / c0_max, 1.0))
+    u = math.sqrt(c1 / 3) * math.cos(theta / 3)
+    w = math.sqrt(c1) * math.sin(theta / 3)
+    return u, w
+
+# coefficients f0, f1, f2 of exp(iQ), eqs. (29) - (33) of Morningstar, Peardon
+# @myjit
+@mynonparjit
+def _exp_coefficients(u, w):
+    xi0 = _exp_xi0(w)
+    cw = math.cos(w)
+    e2 = math.cos(2 * u) + 1j * math.sin(2 * u)
+    em = math.cos(u) - 1j * math.sin(u)
+    uu = u * u
+    ww = w * w
+
+    h0 = (uu - ww) * e2 + em * (8 * uu * cw + 2j * u * (3 * uu + ww) * xi0)
+    h1 = 2 * u * e2 - em * (2 * u * cw - 1j * (3 * uu - ww) * xi0)
+    h2 = e2 - em * (cw + 3j * u * xi0)
+
+    d = 9 * uu - ww
+    return h0 / d, h1 / d, h2 / d
+
+# f0 + f1 Q + f2 Q^2 = f0 - i f1 a - f2 a^2
+# @myjit
+@mynonparjit
+def _exp_combine(f0, f1, f2, a, a2):
+    r0 = GROUP_TYPE(f0) + GROUP_TYPE(-1j * f1) * a[0] + GROUP_TYPE(-f2) * a2[0]
+    r1 = GROUP_TYPE(-1j * f1) * a[1] + GROUP_TYPE(-f2) * a2[1]
+    r2 = GROUP_TYPE(-1j * f1) * a[2] + GROUP_TYPE(-f2) * a2[2]
+    r3 = GROUP_TYPE(-1j * f1) * a[3] + GROUP_TYPE(-f2) * a2[3]
+    r4 = GROUP_TYPE(f0) + GROUP_TYPE(-1j * f1) * a[4] + GROUP_TYPE(-f2) * a2[4]
+    r5 = GROUP_TYPE(-1j * f1) * a[5] + GROUP_TYPE(-f2) * a2[5]
+    r6 = GROUP_TYPE(-1j * f1) * a[6] + GROUP_TYPE(-f2) * a2[6]
+    r7 = GROUP_TYPE(-1j * f1) * a[7] + GROUP_TYPE(-f2) * a2[7]
+    r8 = GROUP_TYPE(f0) + GROUP_TYPE(-1j * f1) * a[8] + GROUP_TYPE(-f2) * a2[8]
+    return r0, r1, r2, r3, r4, r5, r6, r7, r8
+
+# @myjit
+@mynonparjit
+def _mexp_exact(a, c0, c1):
+    u, w = _exp_parameters(c0, c1)
+    f0, f1, f2 = _exp_coefficients(u, w)
+    return _exp_combine(f0, f1, f2, a, mul(a, a))
+
+# @myjit
+@mynonparjit
+def mexp_exact(a):
+    """ Calculate exponential of a traceless anti-hermitian matrix in closed form
+
+    mexp_exact(a) = f0 + f1 Q + f2 Q^2 with a = iQ
+
+    The result agrees with the Taylor series up to rounding errors:
+
+    >>> a = get_algebra_element((0.1, -0.7, 0.3, 1.2, 0.5, -0.4, 0.9, -1.1))
+    >>> b = add(mexp_exact(a), mul_s(mexp_taylor(a), -1))
+    >>> bool(sq(b) < 1.e-28)
+    True
+
+    """
+    # c1 = tr(Q^2) / 2, c0 = det(Q) = -Im det(a)
+    c1 = 0.5 * sq(a)
+    if c1 < EXP_EXACT_MIN_C1:
+        return mexp_taylor(a)
+    c0 = -det(a).imag
+    if c0 < 0:
+        # exp(a) = exp(-a)^dagger with det(-Q) > 0
+        return dagger(_mexp_exact(mul_s(a, -1), -c0, c1))
+    return _mexp_exact(a, c0, c1)
+
+# derivatives b1j = d f_j / d c1 and b2j = d f_j / d c0, eqs. (56) - (60) of Morningstar, Peardon
+# @myjit
+@mynonparjit
+def _dexp_coefficients(u, w, f0, f1, f2):
+    xi0 = _exp_xi0(w)
+    xi1 = _exp_xi1(w)
+    cw = math.cos(w)
+    e2 = math.cos(2 * u) + 1j * math.sin(2 * u)
+    em = math.cos(u) - 1j * math.sin(u)
+    uu = u * u
+    ww = w * w
+
+    r10 = 2 * (u + 1j * (uu - ww)) * e2 \
+        + 2 * em * (4 * u * (2 - 1j * u) * cw + 1j * (9 * uu + ww - 1j * u * (3 * uu + ww)) * xi0)
+    r11 = 2 * (1 + 2j * u) * e2 + em * (-2 * (1 - 1j * u) * cw + 1j * (6 * u + 1j * (ww - 3 * uu)) * xi0)
+    r12 = 2j * e2 + 1j * em * (cw - 3 * (1 - 1j * u) * xi0)
+    r20 = -2 * e2 + 2j * u * em * (cw + (1 + 4j * u) * xi0 + 3 * uu * xi1)
+    r21 = -1j * em * (cw + (1 + 2j * u) * xi0 - 3 * uu * xi1)
+    r22 = em * (xi0 - 3j * u * xi1)
+
+    d = 2 * (9 * uu - ww) ** 2
+    b10 = (2 * u * r10 + (3 * uu - ww) * r20 - 2 * (15 * uu + ww) * f0) / d
+    b11 = (2 * u * r11 + (3 * uu - ww) * r21 - 2 * (15 * uu + ww) * f1) / d
+    b12 = (2 * u * r12 + (3 * uu - ww) * r22 - 2 * (15 * uu + ww) * f2) / d
+    b20 = (r10 - 3 * u * r20 - 24 * u * f0) / d
+    b21 = (r11 - 3 * u * r21 - 24 * u * f1) / d
+    b22 = (r12 - 3 * u * r22 - 24 * u * f2) / d
+    return b10, b11, b12, b20, b21, b22
+
+# @myjit
+@mynonparjit
+def _dmexp_exact(a, da, c0, c1):
+    u, w = _exp_parameters(c0, c1)
+    f0, f1, f2 = _exp_coefficients(u, w)
+    b10, b11, b12, b20, b21, b22 = _dexp_coefficients(u, w, f0, f1, f2)
+
+    a2 = mul(a, a)
+    # dc0 = tr(Q^2 dQ), dc1 = tr(Q dQ) with dQ = -i da
+    dc0 = -tr(mul(a2, da)).imag
+    dc1 = -tr(mul(a, da)).real
+    df0 = b10 * dc1 + b20 * dc0
+    df1 = b11 * dc1 + b21 * dc0
+    df2 = b12 * dc1 + b22 * dc0
+
+    # df0 + df1 Q + df2 Q^2 + f1 dQ + f2 (dQ Q + Q dQ)
+    res = _exp_combine(df0, df1, df2, a, a2)
+    res = add(res, mul_s(da, -1j * f1))
+    return add(res, mul_s(add(mul(da, a), mul(a, da)), -f2))
+
+# @myjit
+@mynonparjit
+def dmexp_exact(a, da):
+    """ Calculate derivative of exponential of a traceless anti-hermitian matrix in closed form
+
+    The derivative is taken in the direction of the traceless anti-hermitian matrix da:
+
+    >>> a = get_algebra_element((0.1, -0.7, 0.3, 1.2, 0.5, -0.4, 0.9, -1.1))
+    >>> da = get_algebra_element((0.5, 0.2, -0.3, 0.1, 0.8, 0.0, -0.6, 0.4))
+    >>> b = add(dmexp_exact(a, da), mul_s(dmexp_taylor(a, da), -1))
+    >>> bool(sq(b) < 1.e-24)
+    True
+
+    """
+    c1 = 0.5 * sq(a)
+    if c1 < DEXP_EXACT_MIN_C1:
+        return dmexp_taylor(a, da)
+    c0 = -det(a).imag
+    if c0 < 0:
+        return dagger(_dmexp_exact(mul_s(a, -1), mul_s(da, -1), -c0, c1))
+    return _dmexp_exact(a, da, c0, c1)
+
+# exponential map and its derivative (see EXP_METHOD)
+if EXP_METHOD == 'exact':
+    mexp = mexp_exact
+    dmexp = dmexp_exact
+else:
+    mexp = mexp_taylor
+    dmexp = dmexp_taylor
+
 # inverse
 # @myjit
 @mynonparjit
@@ -397,7 +614,50 @@ def store(g_to, g_from):
 # @myjit
 @mynonparjit
 def load(g):
-    return g[0], g[1], g[2], g[3], g[4], g[5], g[6], g[7], g[8]
+    return GROUP_TYPE(g[0]), GROUP_TYPE(g[1]), GROUP_TYPE(g[2]), GROUP_TYPE(g[3]), GROUP_TYPE(g[4]), \
+           GROUP_TYPE(g[5]), GROUP_TYPE(g[6]), GROUP_TYPE(g[7]), GROUP_TYPE(g[8])
+
+# Compact links (see core.Simulation, compact_links=True) only store the first two rows.
+# The third row follows from unitarity and det(u) = 1: it is the complex conjugate of
+# the cross product of the first two rows.
+LINK_COMPACT_ELEMENTS = 6
+
+# load link from full or compact storage
+# @myjit
+@mynonparjit
+def load_link(u):
+    """
+    >>> u = mexp(get_algebra_element((.1, .2, .3, .4, .5, .6, .7, .8)))
+    >>> bool(np.allclose(load_link(np.array(u)[:LINK_COMPACT_ELEMENTS]), u))
+    True
+    """
+    if u.shape[0] == LINK_COMPACT_ELEMENTS:
+        r0 = GROUP_TYPE(u[0])
+        r1 = GROUP_TYPE(u[1])
+        r2 = GROUP_TYPE(u[2])
+        r3 = GROUP_TYPE(u[3])
+        r4 = GROUP_TYPE(u[4])
+        r5 = GROUP_TYPE(u[5])
+        r6 = (r1 * r5 - r2 * r4).conjugate()
+        r7 = (r2 * r3 - r0 * r5).conjugate()
+        r8 = (r0 * r4 - r1 * r3).conjugate()
+        return r0, r1, r2, r3, r4, r5, r6, r7, r8
+    return load(u)
+
+# store link into full or compact storage
+# @myjit
+@mynonparjit
+def store_link(u_to, g):
+    u_to[0] = g[0]
+    u_to[1] = g[1]
+    u_to[2] = g[2]
+    u_to[3] = g[3]
+    u_to[4] = g[4]
+    u_to[5] = g[5]
+    if u_to.shape[0] > LINK_COMPACT_ELEMENTS:
+        u_to[6] = g[6]
+        u_to[7] = g[7]
+        u_to[8] = g[8]
 
 # trace
 # @myjit
@@ -442,6 +702,39 @@ def check_unitary(u):  # TODO: remove debugging code
     #    print("Unitarity violated")  # TODO: remove debugging code
     return s
 
+# projection onto SU(3): Gram-Schmidt orthonormalization of the first two rows,
+# the third row is fixed by unitarity and det(u) = 1 (as in load_link())
+# @myjit
+@mynonparjit
+def unitarize(u):
+    """
+    >>> u = mul_s(mexp(get_algebra_element((.1, .2, .3, .4, .5, .6, .7, .8))), 1.01)
+    >>> v = unitarize(u)
+    >>> bool(check_unitary(v) < 1e-28), bool(np.isclose(det(v), 1))
+    (True, True)
+    """
+    norm = GROUP_TYPE_REAL(1 / math.sqrt(u[0].real ** 2 + u[0].imag ** 2 + u[1].real ** 2 + u[1].imag ** 2
+                                         + u[2].real ** 2 + u[2].imag ** 2))
+    r0 = u[0] * norm
+    r1 = u[1] * norm
+    r2 = u[2] * norm
+
+    # remove the component along the first row
+    p = r0.conjugate() * u[3] + r1.conjugate() * u[4] + r2.conjugate() * u[5]
+    r3 = u[3] - p * r0
+    r4 = u[4] - p * r1
+    r5 = u[5] - p * r2
+    norm = GROUP_TYPE_REAL(1 / math.sqrt(r3.real ** 2 + r3.imag ** 2 + r4.real ** 2 + r4.imag ** 2
+                                         + r5.real ** 2 + r5.imag ** 2))
+    r3 = r3 * norm
+    r4 = r4 * norm
+    r5 = r5 * norm
+
+    r6 = (r1 * r5 - r2 * r4).conjugate()
+    r7 = (r2 * r3 - r0 * r5).conjugate()
+    r8 = (r0 * r4 - r1 * r3).conjugate()
+    return r0, r1, r2, r3, r4, r5, r6, r7, r8
+
 """
     Functions for algebra elements
 """
@@ -485,6 +778,60 @@ def get_algebra_factors_from_group_element_approximate(g):
     r8 = tr(mul(s8, g)).imag
     return r1, r2, r3, r4, r5, r6, r7, r8
 
+INV_SQRT3 = 1 / math.sqrt(3)
+
+# algebra element from stored algebra factors
+# @myjit
+@mynonparjit
+def load_algebra_coefficients(c):
+    """
+    Same as get_algebra_element(c), written out for the traceless anti-hermitian matrix.
+
+    >>> c = (1., 2., 3., 4., 5., 6., 7., 8.)
+    >>> bool(np.allclose(load_algebra_coefficients(c), get_algebra_element(c)))
+    True
+    """
+    h = GROUP_TYPE_REAL(0.5)
+    d8 = GROUP_TYPE_REAL(c[7] * INV_SQRT3)
+    r0 = GROUP_TYPE(complex(0, h * (c[2] + d8)))
+    r1 = GROUP_TYPE(complex(h * c[1], h * c[0]))
+    r2 = GROUP_TYPE(complex(h * c[4], h * c[3]))
+    r3 = GROUP_TYPE(complex(-h * c[1], h * c[0]))
+    r4 = GROUP_TYPE(complex(0, h * (d8 - c[2])))
+    r5 = GROUP_TYPE(complex(h * c[6], h * c[5]))
+    r6 = GROUP_TYPE(complex(-h * c[4], h * c[3]))
+    r7 = GROUP_TYPE(complex(-h * c[6], h * c[5]))
+    r8 = GROUP_TYPE(complex(0, -d8))
+    return r0, r1, r2, r3, r4, r5, r6, r7, r8
+
+# store algebra factors of a (the traceless anti-hermitian part of a is kept)
+# @myjit
+@mynonparjit
+def store_algebra_coefficients(c_to, a):
+    """
+    >>> a = get_algebra_element((1., 2., 3., 4., 5., 6., 7., 8.))
+    >>> c = np.zeros(8)
+    >>> store_algebra_coefficients(c, a)
+    >>> bool(np.allclose(c, get_algebra_factors_from_group_element_approximate(a)))
+    True
+    """
+    c_to[0] = (a[1] + a[3]).imag
+    c_to[1] = (a[1] - a[3]).real
+    c_to[2] = (a[0] - a[4]).imag
+    c_to[3] = (a[2] + a[6]).imag
+    c_to[4] = (a[2] - a[6]).real
+    c_to[5] = (a[5] + a[7]).imag
+    c_to[6] = (a[5] - a[7]).real
+    c_to[7] = (a[0] + a[4] - 2 * a[8]).imag * INV_SQRT3
+
+# access to algebra-valued fields (see ALGEBRA_STORAGE)
+if ALGEBRA_STORAGE == 'coefficients':
+    load_algebra = load_algebra_coefficients
+    store_algebra = store_algebra_coefficients
+else:
+    load_algebra = load
+    store_algebra = store
+
 # @myjit
 @mynonparjit
 def proj(g, i, j):
@@ -4,14 +4,12 @@
     e.g. MUSIC.
 """
 
-from curraun.numba_target import myjit, prange, my_parallel_loop, use_cuda
+from curraun.numba_target import myjit, prange, my_parallel_loop, site_kernel, cuda
 from numba import jit
 import numpy as np
 import curraun.lattice as l
 import curraun.su as su
 import curraun.kappa as kappa
-if use_cuda:
-    import numba.cuda as cuda
 
 
 class EnergyMomentumTensor:
@@ -27,7 +25,7 @@ class EnergyMomentumTensor:
 
         self.d_t_munu = self.t_munu
 
-        if use_cuda:
+        if s.backend.use_cuda:
             self.copy_to_device()
 
     def copy_to_device(self):
@@ -52,67 +50,85 @@ class EnergyMomentumTensor:
         t = self.s.t
         n = self.n
 
-        my_parallel_loop(tmunu_kernel, n ** 2, n, u0, aeta0, peta1, peta0, pt1, pt0, t, self.d_t_munu)
+        # plaquettes and transports of u0, aeta0 stored by the last time step
+        # (see core.Simulation.plaquettes(), transports())
+        plaq, cached = self.s.plaquettes()
+        aeta_fwd, fwd_cached = self.s.transports()
+
+        my_parallel_loop(tmunu_kernel, n ** 2, n, self.s.d_nn, u0, aeta0, peta1, peta0, pt1, pt0, t, self.d_t_munu,
+                         plaq, cached, aeta_fwd, fwd_cached, backend=self.s.backend)
 
 
 # kernels
+@site_kernel
 @myjit
-def tmunu_kernel(xi, n, u0, aeta0, peta1, peta0, pt1, pt0, tau, t_munu):
+def tmunu_kernel(xi, n, nn, u0, aeta0, peta1, peta0, pt1, pt0, tau, t_munu, plaq, cached, aeta_fwd, fwd_cached):
     # Compute correctly averaged field strength components
     # Electric components: spatial and temporal (for Ex, Ey) and temporal (Ez)
     # Magnetic components: only spatial averaging (one direction for Bx, By, two for Bz)
     i = 0
     Ex = su.zero()
-    Ex = su.add(Ex, pt1[xi, i])
-    Ex = su.add(Ex, pt0[xi, i])
-    xs = l.shift(xi, i, -1, n)
-    b1 = l.act(su.dagger(u0[xs, i]), pt1[xs, i])
+    Ex = su.add(Ex, su.load_algebra(pt1[xi, i]))
+    Ex = su.add(Ex, su.load_algebra(pt0[xi, i]))
+    xs = l.shift(xi, i, -1, n, nn)
+    b1 = l.act(su.dagger(su.load_link(u0[xs, i])), su.load_algebra(pt1[xs, i]))
     Ex = su.add(Ex, b1)
-    b1 = l.act(su.dagger(u0[xs, i]), pt0[xs, i])
+    b1 = l.act(su.dagger(su.load_link(u0[xs, i])), su.load_algebra(pt0[xs, i]))
     Ex = su.add(Ex, b1)
     Ex = su.mul_s(Ex, 0.25 / tau)
     
     i = 1
     Ey = su.zero()
-    Ey = su.add(Ey, pt1[xi, i])
-    Ey = su.add(Ey, pt0[xi, i])
-    xs = l.shift(xi, i, -1, n)
-    b1 = l.act(su.dagger(u0[xs, i]), pt1[xs, i])
+    Ey = su.add(Ey, su.load_algebra(pt1[xi, i]))
+    Ey = su.add(Ey, su.load_algebra(pt0[xi, i]))
+    xs = l.shift(xi, i, -1, n, nn)
+    b1 = l.act(su.dagger(su.load_link(u0[xs, i])), su.load_algebra(pt1[xs, i]))
     Ey = su.add(Ey, b1)
-    b1 = l.act(su.dagger(u0[xs, i]), pt0[xs, i])
+    b1 = l.act(su.dagger(su.load_link(u0[xs, i])), su.load_algebra(pt0[xs, i]))
     Ey = su.add(Ey, b1)
     Ey = su.mul_s(Ey, 0.25 / tau)
 
     Ez = su.zero()
-    Ez = l.add_mul(Ez, peta1[xi], 0.5)
-    Ez = l.add_mul(Ez, peta0[xi], 0.5)
+    Ez = l.add_mul(Ez, su.load_algebra(peta1[xi]), 0.5)
+    Ez = l.add_mul(Ez, su.load_algebra(peta0[xi]), 0.5)
 
-    b1 = l.transport(aeta0, u0, xi, 1, +1, n)
-    b2 = l.transport(aeta0, u0, xi, 1, -1, n)
+    if fwd_cached:
+        # from the stored transports (see core.Simulation.transports())
+        b1 = su.load_algebra(aeta_fwd[xi, 1])
+    else:
+        b1 = l.transport(aeta0, u0, xi, 1, +1, n, nn)
+    b2 = l.transport(aeta0, u0, xi, 1, -1, n, nn)
     b2 = l.add_mul(b1, b2, -1.0)
     Bx = su.mul_s(b2, -0.5 / tau)
 
-    b1 = l.transport(aeta0, u0, xi, 0, +1, n)
-    b2 = l.transport(aeta0, u0, xi, 0, -1, n)
+    if fwd_cached:
+        b1 = su.load_algebra(aeta_fwd[xi, 0])
+    else:
+        b1 = l.transport(aeta0, u0, xi, 0, +1, n, nn)
+    b2 = l.transport(aeta0, u0, xi, 0, -1, n, nn)
     b2 = l.add_mul(b1, b2, -1.0)
     By = su.mul_s(b2, +0.5 / tau)
 
-    bf1 = su.zero()
-    b1 = l.plaq(u0, xi, 0, 1, 1, 1, n)
-    b2 = su.ah(b1)
-    bf1 = l.add_mul(bf1, b2, -0.25)
+    if cached:
+        # from the stored plaquettes (see core.Simulation.plaquettes())
+        Bz = su.mul_s(l.clover(plaq, u0, xi, n, nn), -0.25)
+    else:
+        bf1 = su.zero()
+        b1 = l.plaq(u0, xi, 0, 1, 1, 1, n, nn)
+        b2 = su.ah(b1)
+        bf1 = l.add_mul(bf1, b2, -0.25)
 
-    b1 = l.plaq(u0, xi, 0, 1, 1, -1, n)
-    b2 = su.ah(b1)
-    bf1 = l.add_mul(bf1, b2, +0.25)
+        b1 = l.plaq(u0, xi, 0, 1, 1, -1, n, nn)
+        b2 = su.ah(b1)
+        bf1 = l.add_mul(bf1, b2, +0.25)
 
-    b1 = l.plaq(u0, xi, 1, 0, 1, -1, n)
-    b2 = su.ah(b1)
-    bf1 = l.add_mul(bf1, b2, -0.25)
+        b1 = l.plaq(u0, xi, 1, 0, 1, -1, n, nn)
+        b2 = su.ah(b1)
+        bf1 = l.add_mul(bf1, b2, -0.25)
 
-    b1 = l.plaq(u0, xi, 1, 0, -1, -1, n)
-    b2 = su.ah(b1)
-    Bz = l.add_mul(bf1, b2, +0.25)
+        b1 = l.plaq(u0, xi, 1, 0, -1, -1, n, nn)
+        b2 = su.ah(b1)
+        Bz = l.add_mul(bf1, b2, +0.25)
 
     # 0-3: Diagonal components
     eEx = dot(Ex, Ex)
@@ -228,7 +244,7 @@ def landau(s, E0, downsample_step = 0, use_reduced_T=True):
     t_munu = EnergyMomentumTensor(s)
     t_munu.compute()
 
-    if use_cuda:
+    if s.backend.use_cuda:
         t_munu.copy_to_host()
 
     T = convert_to_matrix(t_munu.t_munu)
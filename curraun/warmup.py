@@ -0,0 +1,259 @@
+"""
+    Ahead-of-time compilation of all site kernels.
+
+    Usage:
+
+        python -m curraun.warmup [--groups su2 su3] [--precisions single double mixed]
+
+    Gauge group and precision are selected at import time (environment variables GAUGE_GROUP
+    and PRECISION). Therefore every combination is compiled in a separate sub-process. Each
+    sub-process runs small simulations which call every site kernel once, with all Simulation
+    options that have their own kernels (see run_all_kernels()). The compiled
+    parallel drivers are stored in numba's on-disk cache (see numba_target.my_parallel_loop),
+    so that later runs with the same settings start without JIT compilation.
+
+    The target device is taken from MY_NUMBA_TARGET as usual.
+"""
+import os
+import sys
+import subprocess
+import argparse
+import time
+
+GROUPS = ['su2', 'su3']
+PRECISIONS = ['single', 'double', 'mixed']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompile all curraun site kernels.')
+    parser.add_argument('--groups', nargs='+', choices=GROUPS, default=GROUPS, help="gauge groups")
+    parser.add_argument('--precisions', nargs='+', choices=PRECISIONS, default=PRECISIONS, help="precisions")
+    parser.add_argument('-N', type=int, default=8, help="lattice size of the warm-up simulation")
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        warmup(args.N)
+        return
+
+    failed = []
+    for group in args.groups:
+        for precision in args.precisions:
+            print("=======================================")
+            print("Warm-up: {} {}".format(group, precision))
+            print("=======================================", flush=True)
+            env = dict(os.environ, GAUGE_GROUP=group, PRECISION=precision)
+            cmd = [sys.executable, '-m', 'curraun.warmup', '--worker', '-N', str(args.N)]
+            if subprocess.call(cmd, env=env) != 0:
+                failed.append(group + '-' + precision)
+
+    if failed:
+        print("Warm-up failed for: {}".format(", ".join(failed)))
+        sys.exit(1)
+
+
+def warmup(n):
+    """Compile all site kernels for the gauge group and precision of the current process."""
+    import warnings
+    from numba.core import event
+    from numba.core.errors import NumbaPerformanceWarning
+    import curraun.numba_target as numba_target
+
+    # Several kernels are compiled with parallel=True without containing parallel loops
+    warnings.simplefilter('ignore', NumbaPerformanceWarning)
+
+    if numba_target.use_python:
+        print("Python target: nothing to compile.")
+        return
+
+    with event.install_recorder("numba:compile") as recorder:
+        total_time = time.time()
+        run_all_kernels(n)
+        total_time = time.time() - total_time
+
+    report(recorder.buffer, total_time)
+
+
+def short_simulation(n, batch=None, **options):
+    """Initialized Simulation (or BatchedSimulation of 'batch' events) with the given options, on the device."""
+    import curraun.core as core
+    import curraun.mv as mv
+    import curraun.initial as initial
+
+    if batch is None:
+        s = core.Simulation(n, 0.5, 2.0, **options)
+    else:
+        s = core.BatchedSimulation(batch, n, 0.5, 2.0, **options)
+    va = mv.wilson(s, mu=0.1, m=0.1, uv=10.0, num_sheets=1)
+    vb = mv.wilson(s, mu=0.1, m=0.1, uv=10.0, num_sheets=1)
+    initial.init(s, va, vb)
+    if s.backend.use_cuda:
+        s.copy_to_device()
+    return s
+
+
+def run_cached_observables(s):
+    """Time step which fills the buffers of s, followed by the observables which read them."""
+    import curraun.core as core
+    import curraun.energy as energy
+    import curraun.qhat as qhat
+    import curraun.tmunu as tmunu
+    import curraun.correlators as correlators
+
+    en = energy.Energy(s, fields=True)
+    qhat_tforce = qhat.TransportedForce(s)
+    if s.backend.use_cuda:
+        qhat_tforce.copy_to_device()
+
+    core.evolve_leapfrog(s)
+    en.compute()
+    qhat_tforce.compute()
+    if s.batch is None:
+        energy.Energy(s).compute()
+        tmunu.EnergyMomentumTensor(s).compute()
+        if s.backend.use_cuda:
+            corr = correlators.Correlators(s)
+            corr.compute('Ez')
+            corr.compute('Bz')
+
+
+def run_all_kernels(n):
+    """
+    Small simulations that call every site kernel and compiled evolution loop with production
+    argument types: the observables of a single event and of a batch, and the time steps of the
+    Simulation options with their own kernels.
+
+    Not covered are the kernels of the other gauge group (compiled in its own sub-process) and
+    the kernels which only run on CUDA devices when the target is numba (correlation kernels,
+    the cupy path of mv.wilson()).
+    """
+    import curraun.core as core
+    import curraun.mv as mv
+    import curraun.initial as initial
+    import curraun.energy as energy
+    import curraun.kappa as kappa
+    import curraun.qhat as qhat
+    import curraun.tmunu as tmunu
+    import curraun.correlators as correlators
+    import curraun.gauss as gauss
+    import curraun.diagnostics as diagnostics
+
+    s = core.Simulation(n, 0.5, 2.0)
+    use_cuda = s.backend.use_cuda
+    va = mv.wilson(s, mu=0.1, m=0.1, uv=10.0, num_sheets=1)
+    vb = mv.wilson(s, mu=0.1, m=0.1, uv=10.0, num_sheets=1)
+    initial.init(s, va, vb)
+
+    en = energy.Energy(s, fields=True)
+    kappa_tforce = kappa.TransportedForce(s)
+    qhat_tforce = qhat.TransportedForce(s)
+    t_munu = tmunu.EnergyMomentumTensor(s)
+    corr = correlators.Correlators(s)
+
+    if use_cuda:
+        s.copy_to_device()
+        kappa_tforce.copy_to_device()
+        qhat_tforce.copy_to_device()
+
+    # evolve up to tau = 2 so that all stages of the transported forces are computed
+    for t in range(4):
+        kappa_tforce.compute()
+        qhat_tforce.compute()
+        core.evolve_leapfrog(s)
+
+    en.compute()
+    t_munu.compute()
+    correlators.wilson_correlator(va, n, s.backend)
+    if use_cuda:
+        # the correlation kernels use atomic operations only available on CUDA devices
+        corr.compute('Ez')
+        corr.compute('Bz')
+
+    # kernels of a BatchedSimulation
+    bs = core.BatchedSimulation(2, n, 0.5, 2.0)
+    initial.init(bs, mv.wilson(bs, mu=0.1, m=0.1, uv=10.0, num_sheets=1),
+                 mv.wilson(bs, mu=0.1, m=0.1, uv=10.0, num_sheets=1))
+    batch_en = energy.Energy(bs)
+    batch_kappa_tforce = kappa.TransportedForce(bs)
+    batch_qhat_tforce = qhat.TransportedForce(bs)
+
+    if use_cuda:
+        bs.copy_to_device()
+        batch_kappa_tforce.copy_to_device()
+        batch_qhat_tforce.copy_to_device()
+
+    for t in range(4):
+        batch_kappa_tforce.compute()
+        batch_qhat_tforce.compute()
+        core.evolve_leapfrog(bs)
+    batch_en.compute()
+
+    # several steps in one compiled loop and the cache-blocked step (numba only)
+    if not use_cuda:
+        core.evolve_leapfrog_n(short_simulation(n), 2)
+        core.evolve_leapfrog(short_simulation(n, tile=n // 2))
+
+    # projection of the fields onto the group and algebra (see core.Simulation, normalize_every)
+    core.evolve_leapfrog(short_simulation(n, normalize_every=1))
+    core.evolve_leapfrog(short_simulation(n, batch=2, normalize_every=1))
+
+    # composed integrators and changes of the time step (see leapfrog.INTEGRATORS, core.Simulation.set_dt())
+    for integrator in ['omelyan', 'forest_ruth']:
+        core.evolve_leapfrog(short_simulation(n, integrator=integrator))
+    for batch in [None, 2]:
+        s_dt = short_simulation(n, batch=batch)
+        s_dt.set_dt(0.25)
+        core.evolve_leapfrog(s_dt)
+
+    # Gauss constraint on all sites, per site and on random sites (see gauss.Gauss)
+    for sim in [s, bs]:
+        gauss.Gauss(sim).compute()
+        gauss.Gauss(sim, fields=True).compute()
+    gauss.Gauss(s).compute(samples=n)
+
+    # plaquettes and transports stored by the time step and read by the observables
+    # (see core.Simulation.plaquettes(), transports())
+    for batch in [None, 2]:
+        run_cached_observables(short_simulation(n, batch=batch, plaquette_buffer=True))
+        run_cached_observables(short_simulation(n, batch=batch, transport_buffer=True))
+
+    # leapfrog step with diagnostics, also filling the buffers (see diagnostics.Diagnostics)
+    for buffers in [False, True]:
+        s_diag = short_simulation(n, plaquette_buffer=buffers, transport_buffer=buffers)
+        core.evolve_leapfrog(s_diag, diagnostics=diagnostics.Diagnostics(s_diag, gauss=True))
+
+
+def report(events, total_time):
+    import curraun.numba_target as numba_target
+
+    # parallel drivers are stored by (backend, kernel, number of reduced outputs)
+    drivers = {driver: key[1] for key, driver in numba_target._drivers.items()}
+    used_kernels = set(drivers.values())
+
+    # Duration of the outermost compilation of every parallel driver
+    compile_times = {}
+    starts = {}
+    for timestamp, ev in events:
+        dispatcher = ev.data.get('dispatcher') if ev.data else None
+        if dispatcher not in drivers:
+            continue
+        if ev.is_start:
+            starts[dispatcher] = timestamp
+        elif ev.is_end:
+            kernel = drivers[dispatcher]
+            compile_times[kernel] = compile_times.get(kernel, 0.0) + timestamp - starts.pop(dispatcher)
+
+    print("{:<55} {:>10}".format("Kernel", "Compile [s]"))
+    for name, kernel in sorted(numba_target.site_kernels.items()):
+        if kernel in compile_times:
+            status = "{:10.2f}".format(compile_times[kernel])
+        elif kernel in used_kernels:
+            status = "{:>10}".format("cached")
+        else:
+            status = "{:>10}".format("not used")
+        print("{:<55} {}".format(name, status))
+    print("Total warm-up time: {:.2f}s".format(total_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,19 @@
 import os
+import sys
 import time
 import datetime
-import importlib
+import subprocess
 import platform
+import shutil
+import tempfile
 
-from curraun.numba_target import use_cuda, use_numba
-if use_cuda:
-    from numba import cuda
-import curraun
-import curraun.core as core
-import curraun.su2
-import curraun.su3
 import numpy as np
 import numba
 
 FILENAME = "benchmark.dat"
 MAX_TIMEOUT = 10
 SU3_EXP_MIN_TERMS = 20   # Simulate more work (since our simulation only contains zero)
+TILE = 64                # tile size of the cache-blocked CPU evolution (see leapfrog.evolve_tiles())
 
 """
     Standard parameters (can be overwritten via passing arguments)
@@ -44,29 +41,25 @@ maxt = int(p['TMAX'] / a) * p['DTS']
 
 speedup_base = -1
 
-def time_simulation(target_string, spec_string):
-    # Reload libraries
-    importlib.reload(curraun.numba_target)
-    importlib.reload(curraun)
-    importlib.reload(curraun.core)
-    importlib.reload(curraun.su2)
-    importlib.reload(curraun.su3)
-    importlib.reload(curraun.su)
-    importlib.reload(curraun.leapfrog)
-    importlib.reload(curraun.lattice)
-
-    from curraun.numba_target import use_cuda, use_numba
-    if use_cuda:
-        from numba import cuda
+def time_simulation(target_string, spec_string, backend, tile=None):
+    import curraun.core
+    import curraun.numba_target
+    import curraun.su3
+    from numba import cuda
 
+    # Set before the first kernel is compiled. The tunable is part of the name of the cached drivers
+    # (see curraun.numba_target._config_tag()): the benchmark neither uses nor overwrites the drivers
+    # of production runs and of 'python -m curraun.warmup'.
     curraun.su3.EXP_MIN_TERMS = SU3_EXP_MIN_TERMS
 
     np.random.seed(1)
 
     # initialization
-    s = curraun.core.Simulation(p['N'], DT, p['G'])
+    s = curraun.core.Simulation(p['N'], DT, p['G'], backend=backend, tile=tile)
+    use_cuda = s.backend.use_cuda
 
     print("Memory of data: {} GB".format(s.get_ngb()))
+    print("Cache tag: {}".format(curraun.numba_target._config_tag()))
 
     if use_cuda:
         s.copy_to_device()
@@ -76,6 +69,7 @@ def time_simulation(target_string, spec_string):
 
     if True: # not use_numba:
         # Evolve once for Just-In-Time compilation
+        # (the benchmark runs with its own cache directory, see run_spec())
         curraun.core.evolve_leapfrog(s)
 
     init_time = time.time()
@@ -119,23 +113,37 @@ def time_simulation(target_string, spec_string):
         myfile.write('"{}"\n'.format(estimated_total_time_formatted))
 
 def time_python_numba_cuda(spec_string):
-    #os.environ["MY_NUMBA_TARGET"] = "python"
-    #time_simulation("Python", spec_string)
+    # All backends run in the same process, compiled kernels are kept
+    from curraun.numba_target import available_backends
+
+    #time_simulation("Python", spec_string, "python")
 
     print("Number of threads: 1")
-    os.environ["NUMBA_NUM_THREADS"] = "1"
-    os.environ["MY_NUMBA_TARGET"] = "numba"
-    time_simulation("Numba 1 CPU", spec_string)
+    numba.set_num_threads(1)
+    time_simulation("Numba 1 CPU", spec_string, "numba")
 
-    del os.environ["NUMBA_NUM_THREADS"]
     print("Number of threads: {}".format(numba.config.NUMBA_DEFAULT_NUM_THREADS))
-    os.environ["MY_NUMBA_TARGET"] = "numba"
-    time_simulation("Numba {} CPUs".format(numba.config.NUMBA_DEFAULT_NUM_THREADS), spec_string)
+    numba.set_num_threads(numba.config.NUMBA_DEFAULT_NUM_THREADS)
+    time_simulation("Numba {} CPUs".format(numba.config.NUMBA_DEFAULT_NUM_THREADS), spec_string, "numba")
+    time_simulation("Numba {} CPUs tiled".format(numba.config.NUMBA_DEFAULT_NUM_THREADS), spec_string, "numba",
+                    tile=TILE)
+
+    if "cuda" in available_backends():
+        time_simulation("CUDA", spec_string, "cuda")
 
-    global cuda_supported
-    if cuda_supported:
-        os.environ["MY_NUMBA_TARGET"] = "cuda"
-        time_simulation("CUDA", spec_string)
+
+def run_spec(group, precision, cache_dir):
+    # Gauge group and precision are fixed at import time: use a separate process for each.
+    # All processes of a benchmark run use an empty cache directory of their own, the timings
+    # do not depend on the drivers cached by earlier runs (warm-up, other scripts or tunables).
+    env = dict(os.environ, GAUGE_GROUP=group, PRECISION=precision, MY_NUMBA_TARGET="numba",
+               NUMBA_CACHE_DIR=cache_dir)
+    subprocess.call([sys.executable, __file__, "--worker", group + "-" + precision], env=env)
+
+
+if len(sys.argv) == 3 and sys.argv[1] == "--worker":
+    time_python_numba_cuda(sys.argv[2])
+    sys.exit(0)
 
 current_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 hostname = platform.node()
@@ -170,23 +178,24 @@ with open(FILENAME, "a") as myfile:
         myfile.write("No CUDA capable graphics card found\n")
     myfile.write("---------------------------------------\n")
 
-# SU(2) Double
-os.environ["GAUGE_GROUP"] = "su2"
-os.environ["PRECISION"] = "double"
-time_python_numba_cuda("su2-double")
+cache_dir = tempfile.mkdtemp(prefix="curraun_benchmark_")
+try:
+    # SU(2) Double
+    run_spec("su2", "double", cache_dir)
+
+    # SU(2) Single
+    run_spec("su2", "single", cache_dir)
 
-# SU(2) Single
-os.environ["PRECISION"] = "single"
-time_python_numba_cuda("su2-single")
+    # SU(3) Double
+    run_spec("su3", "double", cache_dir)
 
-# SU(3) Double
-os.environ["GAUGE_GROUP"] = "su3"
-os.environ["PRECISION"] = "double"
-time_python_numba_cuda("su3-double")
+    # SU(3) Single
+    run_spec("su3", "single", cache_dir)
 
-# SU(3) Single
-os.environ["PRECISION"] = "single"
-time_python_numba_cuda("su3-single")
+    # SU(3) Mixed
+    run_spec("su3", "mixed", cache_dir)
+finally:
+    shutil.rmtree(cache_dir, ignore_errors=True)
 
 # # For debugging types:
 # # Numba SU(3) Single
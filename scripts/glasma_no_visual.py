@@ -28,6 +28,7 @@ import numpy as np
 import curraun.core as core
 import curraun.initial as initial
 import curraun.energy as energy
+import curraun.profiling as profiling
 
 # simulation parameters
 L = 12.9
@@ -38,6 +39,7 @@ N = 1024 # 64 # 32 # 256
 DT = 0.125
 UV = 100.0
 NUMS = 1
+PROFILE = False  # print kernel timings and write a Chrome trace (profile.json)
 
 # initialization
 initial.DEBUG = True
@@ -63,6 +65,9 @@ timing_ignore = 3  # ignore first 3 steps when averaging
 
 energy_computation = energy.Energy(s)
 
+if PROFILE:
+    profiling.enable()
+
 for t in range(time_max):
     core.evolve_leapfrog(s)
 
@@ -83,3 +88,7 @@ for t in range(time_max):
 
 if use_cuda:
     s.copy_to_host()
+
+if PROFILE:
+    profiling.print_table()
+    profiling.export_chrome_trace("profile.json")
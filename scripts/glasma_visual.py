@@ -46,7 +46,7 @@ initial.init(s, va, vb)
 # evolution and visualization
 plt.ion()
 
-energy = Energy(s)
+energy = Energy(s, fields=True)
 
 # first step to initialize view
 core.evolve_leapfrog(s)
@@ -0,0 +1,88 @@
+"""
+    Convergence study of the time integrators (see leapfrog.INTEGRATORS): error versus cost.
+
+    Usage:
+
+        python -m scripts.integrator_convergence [-N 64] [--dts 1 2 4 8 16 32] [--integrators leapfrog forest_ruth]
+
+    All runs start from the same state at tau0 (MV initial conditions evolved with the leapfrog
+    scheme and DTS_START steps per lattice spacing) and evolve it to tau1 with DTS steps per
+    lattice spacing (core.Simulation.set_dt()). The error is the largest deviation of the links
+    and of A_eta at tau1 from a Forest-Ruth run with DTS_REF steps. The cost is the number of
+    kernel sweeps over the lattice (force evaluations) and the wall time.
+
+    Gauge group and precision are taken from the environment (GAUGE_GROUP, PRECISION) as usual.
+"""
+import time
+import argparse
+
+import numpy as np
+
+import curraun.core as core
+import curraun.mv as mv
+import curraun.initial as initial
+import curraun.leapfrog as leapfrog
+
+DTS_START = 64
+DTS_REF = 512
+
+
+def sweeps_per_step(integrator):
+    """Kernel sweeps over the lattice of one time step (including the final kick of the composed schemes)."""
+    if leapfrog.INTEGRATORS[integrator] is None:
+        return 1
+    kicks, drifts = leapfrog.INTEGRATORS[integrator]
+    return len(drifts) + (1 if kicks[-1] != 0.5 else 0)
+
+
+def evolve(start, args, integrator, dts):
+    """Evolve the start state from tau0 to tau1, return the fields at tau1 and the wall time."""
+    s = core.Simulation(args.N, 1.0 / DTS_START, args.G, integrator=integrator)
+    s.restore(start)
+    s.set_dt(1.0 / dts)
+    steps = int(round((args.tau1 - args.tau0) * dts))
+
+    start_time = time.time()
+    core.evolve_leapfrog_n(s, steps)
+    elapsed = time.time() - start_time
+
+    # u1, aeta1 at t + dt = tau1
+    return s.u1.copy(), s.aeta1.copy(), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Error versus cost of the time integrators.')
+    parser.add_argument('-N', type=int, default=64, help="lattice size")
+    parser.add_argument('-G', type=float, default=2.0, help="coupling constant")
+    parser.add_argument('--mu', type=float, default=0.05, help="MV model parameter (lattice units)")
+    parser.add_argument('--tau0', type=float, default=1.0, help="start time (lattice units)")
+    parser.add_argument('--tau1', type=float, default=5.0, help="end time (lattice units)")
+    parser.add_argument('--dts', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32], help="time steps per spacing")
+    parser.add_argument('--integrators', nargs='+', choices=sorted(leapfrog.INTEGRATORS),
+                        default=['leapfrog', 'omelyan', 'forest_ruth'], help="integrators")
+    args = parser.parse_args()
+
+    # common start state at tau0
+    mv.set_seed(1)
+    s = core.Simulation(args.N, 1.0 / DTS_START, args.G)
+    va = mv.wilson(s, mu=args.mu, m=0.1 * args.mu, uv=10.0, num_sheets=1)
+    vb = mv.wilson(s, mu=args.mu, m=0.1 * args.mu, uv=10.0, num_sheets=1)
+    initial.init(s, va, vb)
+    core.evolve_leapfrog_n(s, int(round(args.tau0 * DTS_START)) - 1)
+    start = s.snapshot()
+
+    ref_links, ref_aeta, _ = evolve(start, args, 'forest_ruth', DTS_REF)
+
+    print("{:<12} {:>5} {:>7} {:>8} {:>9} {:>12} {:>12}".format(
+        "Integrator", "DTS", "Steps", "Sweeps", "Time [s]", "Error U", "Error A_eta"))
+    for integrator in args.integrators:
+        for dts in args.dts:
+            links, aeta, elapsed = evolve(start, args, integrator, dts)
+            steps = int(round((args.tau1 - args.tau0) * dts))
+            print("{:<12} {:5d} {:7d} {:8d} {:9.3f} {:12.3e} {:12.3e}".format(
+                integrator, dts, steps, steps * sweeps_per_step(integrator), elapsed,
+                np.max(np.abs(links - ref_links)), np.max(np.abs(aeta - ref_aeta))))
+
+
+if __name__ == "__main__":
+    main()
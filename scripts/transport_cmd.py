@@ -57,6 +57,7 @@ p = {
     'NS':   1,             # number of color sheets
 
     'NE':   50,             # number of events
+    'NB':   1,              # number of events evolved together (BatchedSimulation)
 }
 
 """
@@ -78,6 +79,7 @@ parser.add_argument('-UV',   type=float, help="UV regulator [GeV]")
 parser.add_argument('-NS',   type=int,   help="Number of color sheets")
 
 parser.add_argument('-NE',   type=int,   help="Number of events")
+parser.add_argument('-NB',   type=int,   help="Number of events evolved together")
 
 # parse args and update parameters dict
 args = parser.parse_args()
@@ -154,10 +156,14 @@ eta_output = 0
 init_time = time.time()
 
 
-# event loop
-for e in range(p['NE']):
+# event loop (batches of NB events)
+for e0 in range(0, p['NE'], p['NB']):
     # initialization
-    s = curraun.core.Simulation(p['N'], DT, p['G'])
+    nb = min(p['NB'], p['NE'] - e0)
+    if p['NB'] > 1:
+        s = curraun.core.BatchedSimulation(nb, p['N'], DT, p['G'])
+    else:
+        s = curraun.core.Simulation(p['N'], DT, p['G'])
     va = curraun.mv.wilson(s, mu=p['MU'] / E0, m=p['M'] / E0, uv=p['UV'] / E0, num_sheets=p['NS'])
     vb = curraun.mv.wilson(s, mu=p['MU'] / E0, m=p['M'] / E0, uv=p['UV'] / E0, num_sheets=p['NS'])
     curraun.initial.init(s, va, vb)
@@ -185,7 +191,7 @@ for e in range(p['NE']):
 
             # tau in fm/c
             tau = s.t * a
-            progress = (tau/p['TMAX'] + float(e)) / p['NE']
+            progress = (tau/p['TMAX'] * nb + float(e0)) / p['NE']
             cur_time = time.time() - init_time
             progress_list.append([progress, cur_time])
 
@@ -200,7 +206,7 @@ for e in range(p['NE']):
             if len(progress_list) >= 100:
                 progress_list.popleft()
 
-            print("tau = {:.3}, tau_max = {:.3}, event = {} of {}, {}%, ETA: {}".format(tau, p['TMAX'], e+1, p['NE'], int(100 * tau / p['TMAX']), eta_output))
+            print("tau = {:.3}, tau_max = {:.3}, event = {} of {}, {}%, ETA: {}".format(tau, p['TMAX'], e0+nb, p['NE'], int(100 * tau / p['TMAX']), eta_output))
 
             # unit factors (GeV^2)
             units = E0 ** 2 / (s.g ** 2)
@@ -209,10 +215,14 @@ for e in range(p['NE']):
             Nc = curraun.core.su.NC
             f = 2 * s.g ** 2 / (2 * Nc)
 
-            # p_perp components for kappa
-            for d in range(3):
-                results_kappa[3 * e + d + 1, int(t / p['DTS'])] = kappa_tforce.p_perp_mean[d] * units * f
-                results_qhat[3 * e + d + 1, int(t / p['DTS'])] = qhat_tforce.p_perp_mean[d] * units * f
+            # p_perp components for kappa (one row of means per event)
+            kappa_mean = kappa_tforce.p_perp_mean.reshape(-1, 3)
+            qhat_mean = qhat_tforce.p_perp_mean.reshape(-1, 3)
+            for i in range(nb):
+                e = e0 + i
+                for d in range(3):
+                    results_kappa[3 * e + d + 1, int(t / p['DTS'])] = kappa_mean[i, d] * units * f
+                    results_qhat[3 * e + d + 1, int(t / p['DTS'])] = qhat_mean[i, d] * units * f
 
             if use_cuda:
                 # Copy data back to device
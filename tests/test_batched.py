@@ -0,0 +1,56 @@
+"""
+    The events of a core.BatchedSimulation evolve as the same events in separate simulations.
+"""
+import numpy as np
+
+import curraun.core as core
+import curraun.energy as energy
+import curraun.initial as initial
+import curraun.mv as mv
+import curraun.su as su
+
+N = 8
+BATCH = 3
+ATOL = 1e3 * np.finfo(su.GROUP_TYPE_REAL).eps
+FIELDS = ['u0', 'u1', 'pt1', 'pt0', 'aeta0', 'aeta1', 'peta1', 'peta0']
+
+
+def events():
+    mv.set_seed(1)
+    simulations = []
+    for i in range(BATCH):
+        s = core.Simulation(N, 0.5, 2.0)
+        va = mv.wilson(s, mu=0.1, m=0.1, uv=10.0, num_sheets=1)
+        vb = mv.wilson(s, mu=0.1, m=0.1, uv=10.0, num_sheets=1)
+        initial.init(s, va, vb)
+        simulations.append(s)
+    return simulations
+
+
+def test_batched_events():
+    simulations = events()
+    bs = core.BatchedSimulation(BATCH, N, 0.5, 2.0)
+    for i, s in enumerate(simulations):
+        event = bs.event(i)
+        for name in FIELDS:
+            getattr(event, name)[...] = getattr(s, name)
+
+    for step in range(3):
+        core.evolve_leapfrog(bs)
+        for s in simulations:
+            core.evolve_leapfrog(s)
+    core.evolve_leapfrog_n(bs, 2)
+    for s in simulations:
+        core.evolve_leapfrog_n(s, 2)
+
+    en = energy.Energy(bs)
+    en.compute()
+    for i, s in enumerate(simulations):
+        event = bs.event(i)
+        assert event.t == s.t
+        for name in FIELDS:
+            assert np.allclose(getattr(event, name), getattr(s, name), rtol=0, atol=ATOL)
+
+        en_event = energy.Energy(s)
+        en_event.compute()
+        assert np.isclose(en.energy_density[i], en_event.energy_density, rtol=1e-6)
@@ -0,0 +1,41 @@
+"""
+    The constants compiled into the kernels are part of the name of the cached drivers
+    (see numba_target._config_tag()).
+"""
+import sys
+
+import pytest
+
+import curraun.leapfrog as leapfrog
+import curraun.numba_target as numba_target
+import curraun.su as su
+import curraun.su3 as su3
+
+TUNABLES = {'EXP_MIN_TERMS': 20, 'EXP_MAX_TERMS': 1, 'EXP_ACCURACY_SQUARED': 1e-20}
+
+
+@pytest.mark.skipif(su.su_group != 'su3', reason="SU(3) tunables")
+@pytest.mark.parametrize('name', sorted(TUNABLES))
+def test_config_tag_su3_tunables(monkeypatch, name):
+    tag = numba_target._config_tag()
+    monkeypatch.setattr(su3, name, TUNABLES[name])
+    assert numba_target._config_tag() != tag
+
+    driver = numba_target._make_driver(numba_target._numba_prange_driver, leapfrog.evolve_kernel, '_numba_prange',
+                                       numba_target.get_backend('numba'))
+    assert driver.__qualname__.endswith('_' + numba_target._config_tag())
+
+
+def test_config_tag_group_constants(monkeypatch):
+    group = sys.modules['curraun.' + su.su_group]
+    tag = numba_target._config_tag()
+    assert numba_target._config_tag() == tag
+
+    # constants of the gauge group module, not of other modules
+    monkeypatch.setattr(group, 'GROUP_ELEMENTS', group.GROUP_ELEMENTS + 1)
+    assert numba_target._config_tag() != tag
+    monkeypatch.undo()
+    assert numba_target._config_tag() == tag
+    if su.su_group != 'su3':
+        monkeypatch.setattr(su3, 'EXP_MAX_TERMS', 1)
+        assert numba_target._config_tag() == tag
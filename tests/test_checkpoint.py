@@ -0,0 +1,78 @@
+"""
+    A simulation continued from a checkpoint (see checkpoint.save(), load()) gives the same
+    results as the uninterrupted simulation, damaged checkpoints are rejected.
+"""
+import numpy as np
+import pytest
+
+import curraun.checkpoint as checkpoint
+import curraun.core as core
+import curraun.initial as initial
+import curraun.kappa as kappa
+import curraun.mv as mv
+
+N = 8
+
+
+def simulation():
+    mv.set_seed(1)
+    s = core.Simulation(N, 0.5, 2.0)
+    va = mv.wilson(s, mu=0.1, m=0.1, uv=10.0, num_sheets=1)
+    vb = mv.wilson(s, mu=0.1, m=0.1, uv=10.0, num_sheets=1)
+    initial.init(s, va, vb)
+    return s
+
+
+def evolve(s, force, steps):
+    for step in range(steps):
+        core.evolve_leapfrog(s)
+        force.compute()
+
+
+def test_checkpoint_restart(tmp_path):
+    path = str(tmp_path / "run.ckpt")
+    s = simulation()
+    force = kappa.TransportedForce(s)
+    evolve(s, force, 3)
+    s.save_checkpoint(path, forces={'kappa': force})
+    evolve(s, force, 3)
+    random = mv.random_np.uniform(size=4)
+
+    restarted = core.Simulation(N, 0.5, 2.0)
+    restarted_force = kappa.TransportedForce(restarted)
+    restarted.load_checkpoint(path, forces={'kappa': restarted_force})
+    assert restarted.t == 3 * s.dt
+    evolve(restarted, restarted_force, 3)
+
+    assert restarted.t == s.t
+    assert np.array_equal(restarted.buffer, s.buffer)
+    assert restarted_force.t == force.t
+    for name in checkpoint.FORCE_ARRAYS:
+        if hasattr(force, name):
+            assert np.array_equal(getattr(restarted_force, name), getattr(force, name))
+    # the random numbers continue from the saved state
+    assert np.array_equal(mv.random_np.uniform(size=4), random)
+
+
+def test_checkpoint_corrupted(tmp_path):
+    path = str(tmp_path / "run.ckpt")
+    s = simulation()
+    core.evolve_leapfrog(s)
+    s.save_checkpoint(path)
+
+    # flip one bit in the middle of the fields
+    entry = [e for e in checkpoint.read_header(path)['sections'] if e['name'] == 'fields'][0]
+    position = entry['offset'] + s.buffer.nbytes // 2
+    with open(path, 'r+b') as file:
+        file.seek(position)
+        byte = file.read(1)
+        file.seek(position)
+        file.write(bytes([byte[0] ^ 1]))
+
+    restarted = core.Simulation(N, 0.5, 2.0)
+    with pytest.raises(ValueError, match='crc32'):
+        restarted.load_checkpoint(path)
+    checkpoint.load(restarted, path, verify=False)
+
+    with pytest.raises(ValueError):
+        core.Simulation(N, 0.25, 2.0).load_checkpoint(path)
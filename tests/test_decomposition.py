@@ -0,0 +1,50 @@
+"""
+    A decomposition.DecomposedSimulation gives the same fields and observables as the
+    serial simulation.
+"""
+import numpy as np
+
+import curraun.core as core
+import curraun.decomposition as decomposition
+import curraun.energy as energy
+import curraun.initial as initial
+import curraun.mv as mv
+import curraun.su as su
+import curraun.tmunu as tmunu
+
+N = 8
+ATOL = 1e3 * np.finfo(su.GROUP_TYPE_REAL).eps
+FIELDS = ['u0', 'u1', 'pt1', 'pt0', 'aeta0', 'aeta1', 'peta1', 'peta0']
+
+
+def init(s):
+    mv.set_seed(1)
+    va = mv.wilson(s, mu=0.1, m=0.1, uv=10.0, num_sheets=1)
+    vb = mv.wilson(s, mu=0.1, m=0.1, uv=10.0, num_sheets=1)
+    initial.init(s, va, vb)
+
+
+def test_decomposition():
+    reference = core.Simulation(N, 0.5, 2.0, normalize_every=2)
+    init(reference)
+    en_reference = energy.Energy(reference)
+    t_munu_reference = tmunu.EnergyMomentumTensor(reference)
+
+    with decomposition.DecomposedSimulation(N, 0.5, 2.0, workers=2, threads=1, normalize_every=2) as ds:
+        init(ds.s)
+        en = energy.Energy(ds.s)
+        t_munu = tmunu.EnergyMomentumTensor(ds.s)
+
+        ds.evolve(3)
+        core.evolve_leapfrog_n(reference, 3)
+        ds.compute_energy(en)
+        en_reference.compute()
+        ds.compute_tmunu(t_munu)
+        t_munu_reference.compute()
+
+        assert ds.s.t == reference.t
+        for name in FIELDS:
+            assert np.allclose(getattr(ds.s, name), getattr(reference, name), rtol=0, atol=ATOL)
+        for name in ['EL_mean', 'BL_mean', 'ET_mean', 'BT_mean']:
+            assert np.isclose(getattr(en, name), getattr(en_reference, name), rtol=1e-10, atol=0)
+        assert np.allclose(t_munu.t_munu, t_munu_reference.t_munu, rtol=0, atol=ATOL)
@@ -0,0 +1,107 @@
+"""
+    The diagnostics accumulated by the leapfrog step (see diagnostics.Diagnostics) agree with a
+    direct computation at the time t of the step and with energy.Energy at t + dt / 2.
+"""
+import numpy as np
+import pytest
+
+import curraun.core as core
+import curraun.diagnostics as diagnostics
+import curraun.energy as energy
+import curraun.gauss as gauss
+import curraun.initial as initial
+import curraun.lattice as l
+import curraun.mv as mv
+import curraun.su as su
+from curraun.numba_target import mynonparjit, my_parallel_reduce
+
+N = 16
+RTOL = 1e-10 if su.GROUP_TYPE_REAL == np.float64 else 1e-4
+
+
+@mynonparjit
+def single_time_kernel(xi, n, nn, u0, pt0, pt1, aeta0, peta0, peta1, t, dt):
+    # EL, BL, ET, BT at time t: magnetic fields of u0, aeta0 at t,
+    # squared momenta averaged over t - dt / 2 (pt0, peta0) and t + dt / 2 (pt1, peta1)
+    EL = (su.sq(su.load_algebra(peta0[xi])) * (t - dt / 2) + su.sq(su.load_algebra(peta1[xi])) * (t + dt / 2)) / 2
+    BL = su.sq(su.ah(l.plaq_pos(u0, xi, 0, 1, n, nn))) * t
+    ET = 0.0
+    BT = 0.0
+    for d in range(2):
+        ET += (su.sq(su.load_algebra(pt0[xi, d])) / (t - dt / 2) + su.sq(su.load_algebra(pt1[xi, d])) / (t + dt / 2)) / 2
+        buffer1 = l.add_mul(l.transport(aeta0, u0, xi, d, 1, n, nn), su.load_algebra(aeta0[xi]), -1)
+        BT += su.sq(buffer1) / t
+    return float(EL), float(BL), float(ET), float(BT)
+
+
+def simulation(**options):
+    mv.set_seed(1)
+    s = core.Simulation(N, 0.25, 2.0, **options)
+    va = mv.wilson(s, mu=0.1, m=0.05, uv=10.0, num_sheets=1)
+    vb = mv.wilson(s, mu=0.1, m=0.05, uv=10.0, num_sheets=1)
+    initial.init(s, va, vb)
+    core.evolve_leapfrog_n(s, 5)
+    return s
+
+
+@pytest.mark.parametrize('buffers', [False, True])
+def test_diagnostics_single_time(buffers):
+    s = simulation(plaquette_buffer=buffers, transport_buffer=buffers)
+    diag = diagnostics.Diagnostics(s)
+    core.evolve_leapfrog(s, diagnostics=diag)
+    assert diag.t == s.t
+
+    sums = my_parallel_reduce(single_time_kernel, N ** 2, N, s.nn, s.u0, s.pt0, s.pt1, s.aeta0, s.peta0, s.peta1,
+                              s.t, s.dt, n_outputs=4, backend=s.backend)
+    EL, BL, ET, BT = sums / N ** 2 / s.g ** 2
+    assert np.allclose([diag.EL_mean, diag.BL_mean, diag.ET_mean, diag.BT_mean], [EL, BL, ET, BT], rtol=RTOL, atol=0)
+    assert np.isclose(diag.energy_density, (EL + BL + ET + BT) / s.t, rtol=RTOL, atol=0)
+    assert np.isclose(diag.pL, (ET + BT - EL - BL) / s.t, rtol=RTOL, atol=0)
+    assert np.isclose(diag.pT, (EL + BL) / s.t, rtol=RTOL, atol=0)
+
+
+def test_diagnostics_energy():
+    # energy.Energy averages the magnetic fields over t and t + dt and uses the momenta at t + dt / 2
+    s = simulation()
+    en = energy.Energy(s)
+    diags, energies = [], []
+    for step in range(3):
+        diag = diagnostics.Diagnostics(s)
+        core.evolve_leapfrog(s, diagnostics=diag)
+        en.compute()
+        diags.append(diag)
+        energies.append([en.EL_mean, en.BL_mean, en.ET_mean, en.BT_mean])
+
+    for k in range(2):
+        d0, d1 = diags[k], diags[k + 1]
+        assert np.isclose((d0.BL_mean + d1.BL_mean) / 2, energies[k][1], rtol=RTOL, atol=0)
+        assert np.isclose((d0.BT_mean + d1.BT_mean) / 2, energies[k][3], rtol=RTOL, atol=0)
+        assert np.isclose(d1.EL_mean, (energies[k][0] + energies[k + 1][0]) / 2, rtol=RTOL, atol=0)
+        assert np.isclose(d1.ET_mean, (energies[k][2] + energies[k + 1][2]) / 2, rtol=RTOL, atol=0)
+
+
+def test_diagnostics_gauss_and_fields():
+    s = simulation()
+    reference = core.Simulation(N, s.dt, s.g)
+    reference.restore(s.snapshot())
+
+    # violation of pt1, peta1 before the step
+    s.pt1[3, 0, 1] += 1e-3
+    reference.pt1[3, 0, 1] += 1e-3
+    total, maximum = gauss.Gauss(reference).compute()
+
+    diag = diagnostics.Diagnostics(s, gauss=True)
+    core.evolve_leapfrog(s, diagnostics=diag)
+    core.evolve_leapfrog(reference)
+    assert np.isclose(diag.gauss_total, total, rtol=RTOL)
+    assert np.isclose(diag.gauss_max, maximum, rtol=RTOL)
+
+    # same step as without diagnostics
+    for a, b in zip(s.data, reference.data):
+        assert np.allclose(a, b, rtol=0, atol=1e3 * np.finfo(su.GROUP_TYPE_REAL).eps)
+
+
+def test_diagnostics_unsupported():
+    for s in [simulation(integrator='omelyan'), core.BatchedSimulation(2, N, 0.25, 2.0)]:
+        with pytest.raises(ValueError):
+            core.evolve_leapfrog(s, diagnostics=diagnostics.Diagnostics(s))
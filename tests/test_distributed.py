@@ -0,0 +1,81 @@
+"""
+    A distributed.DistributedSimulation on two MPI ranks gives the same fields and observables
+    as the serial simulation. The test runs this file with mpiexec.
+"""
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+N = 8
+RANKS = 2
+STEPS = 3
+FIELDS = ['u0', 'u1', 'pt1', 'pt0', 'aeta0', 'aeta1', 'peta1', 'peta0']
+
+
+def run_distributed():
+    import curraun.core as core
+    import curraun.distributed as distributed
+    import curraun.energy as energy
+    import curraun.initial as initial
+    import curraun.mv as mv
+    import curraun.su as su
+    import curraun.tmunu as tmunu
+
+    atol = 1e3 * np.finfo(su.GROUP_TYPE_REAL).eps
+
+    mv.set_seed(1)
+    s = distributed.DistributedSimulation(N, 0.5, 2.0, normalize_every=2)
+    va = distributed.wilson(s, mu=0.1, m=0.1, uv=10.0, num_sheets=1)
+    vb = distributed.wilson(s, mu=0.1, m=0.1, uv=10.0, num_sheets=1)
+    distributed.init(s, va, vb)
+    en = energy.Energy(s)
+    for step in range(STEPS):
+        distributed.evolve_leapfrog(s)
+    distributed.compute_energy(s, en)
+    t_munu, means = distributed.compute_tmunu(s)
+    fields = {name: distributed.gather(s, getattr(s, name)) for name in FIELDS}
+    if s.comm.rank != 0:
+        return
+
+    mv.set_seed(1)
+    reference = core.Simulation(N, 0.5, 2.0, normalize_every=2)
+    va = mv.wilson(reference, mu=0.1, m=0.1, uv=10.0, num_sheets=1)
+    vb = mv.wilson(reference, mu=0.1, m=0.1, uv=10.0, num_sheets=1)
+    initial.init(reference, va, vb)
+    en_reference = energy.Energy(reference)
+    t_munu_reference = tmunu.EnergyMomentumTensor(reference)
+    for step in range(STEPS):
+        core.evolve_leapfrog(reference)
+    en_reference.compute()
+    t_munu_reference.compute()
+
+    assert s.t == reference.t
+    for name in FIELDS:
+        assert np.allclose(fields[name], getattr(reference, name), rtol=0, atol=atol), name
+    for name in ['EL_mean', 'BL_mean', 'ET_mean', 'BT_mean']:
+        assert np.isclose(getattr(en, name), getattr(en_reference, name), rtol=1e-10, atol=0), name
+    assert np.allclose(means, np.mean(t_munu_reference.t_munu, axis=0), rtol=1e-10, atol=atol)
+
+
+def test_distributed():
+    pytest.importorskip('mpi4py')
+    mpiexec = shutil.which('mpiexec')
+    if mpiexec is None:
+        pytest.skip("mpiexec not found")
+
+    # Open MPI refuses to run as root and to start more ranks than cores without these settings
+    env = dict(os.environ, OMPI_ALLOW_RUN_AS_ROOT='1', OMPI_ALLOW_RUN_AS_ROOT_CONFIRM='1',
+               OMPI_MCA_rmaps_base_oversubscribe='1')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [root, env.get('PYTHONPATH')]))
+    result = subprocess.run([mpiexec, '-n', str(RANKS), sys.executable, os.path.abspath(__file__)], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=1200)
+    assert result.returncode == 0, result.stdout
+
+
+if __name__ == "__main__":
+    run_distributed()
@@ -0,0 +1,52 @@
+"""
+    core.evolve_leapfrog_n() is equivalent to repeated calls of core.evolve_leapfrog().
+"""
+import numpy as np
+import pytest
+
+import curraun.core as core
+import curraun.initial as initial
+import curraun.mv as mv
+import curraun.su as su
+
+N = 8
+ATOL = 1e3 * np.finfo(su.GROUP_TYPE_REAL).eps
+
+
+def simulation(**options):
+    mv.set_seed(1)
+    s = core.Simulation(N, 0.5, 2.0, **options)
+    va = mv.wilson(s, mu=0.1, m=0.1, uv=10.0, num_sheets=1)
+    vb = mv.wilson(s, mu=0.1, m=0.1, uv=10.0, num_sheets=1)
+    initial.init(s, va, vb)
+    return s
+
+
+def assert_same_state(s, reference):
+    assert s.t == reference.t
+    assert s.step == reference.step
+    for a, b in zip(s.data, reference.data):
+        assert np.allclose(a, b, rtol=0, atol=ATOL)
+
+
+@pytest.mark.parametrize('options', [{}, {'normalize_every': 2}, {'tile': N // 2}])
+def test_evolve_n(options):
+    s = simulation(**options)
+    reference = simulation(**options)
+
+    core.evolve_leapfrog_n(s, 5)
+    for step in range(5):
+        core.evolve_leapfrog(reference)
+    assert_same_state(s, reference)
+
+
+def test_evolve_n_callback():
+    s = simulation()
+    reference = simulation()
+
+    times = []
+    core.evolve_leapfrog_n(s, 7, callback=lambda s: times.append(s.t), every=3)
+    for step in range(7):
+        core.evolve_leapfrog(reference)
+    assert np.allclose(times, [3 * s.dt, 6 * s.dt, 7 * s.dt])
+    assert_same_state(s, reference)
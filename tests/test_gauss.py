@@ -0,0 +1,78 @@
+"""
+    The Gauss constraint is conserved up to round-off errors by the time steps of all
+    integrators, the batched step and changes of the time step (see gauss.Gauss).
+"""
+import numpy as np
+import pytest
+
+import curraun.core as core
+import curraun.gauss as gauss
+import curraun.initial as initial
+import curraun.lattice as l
+import curraun.leapfrog as leapfrog
+import curraun.mv as mv
+import curraun.su as su
+
+N = 16
+
+# |G(x)|^2 of the fields is of order one, round-off errors are of order eps ** 2
+TOLERANCE = (1000 * np.finfo(su.GROUP_TYPE_REAL).eps) ** 2
+
+
+def simulation(batch=None, **options):
+    mv.set_seed(1)
+    if batch is None:
+        s = core.Simulation(N, 0.5, 2.0, **options)
+    else:
+        s = core.BatchedSimulation(batch, N, 0.5, 2.0, **options)
+    va = mv.wilson(s, mu=0.1, m=0.1, uv=10.0, num_sheets=1)
+    vb = mv.wilson(s, mu=0.1, m=0.1, uv=10.0, num_sheets=1)
+    initial.init(s, va, vb)
+    return s
+
+
+@pytest.mark.parametrize('integrator', sorted(leapfrog.INTEGRATORS))
+def test_gauss_conserved(integrator):
+    s = simulation(integrator=integrator)
+    monitor = gauss.Gauss(s)
+    for step in range(6):
+        core.evolve_leapfrog(s)
+        total, maximum = monitor.compute()
+        assert maximum < TOLERANCE
+        assert total < N ** 2 * TOLERANCE
+
+    # the kick which changes the staggering of the momenta keeps the constraint
+    s.set_dt(0.25)
+    assert monitor.compute()[1] < TOLERANCE
+    core.evolve_leapfrog(s)
+    assert monitor.compute()[1] < TOLERANCE
+
+
+def test_gauss_detects_violation():
+    s = simulation()
+    core.evolve_leapfrog(s)
+    s.pt1[0, 0, 1] += 1e-3
+    assert gauss.Gauss(s).compute()[1] > 1e-7
+
+
+def test_gauss_fields_and_samples():
+    s = simulation()
+    core.evolve_leapfrog_n(s, 3)
+    s.pt1[5, 1, 1] += 1e-3
+    total, maximum = gauss.Gauss(s).compute()
+
+    monitor = gauss.Gauss(s, fields=True)
+    assert np.allclose(monitor.compute(), (total, maximum))
+    assert np.argmax(monitor.G) in (5, l.shift(5, 1, 1, N))
+
+    # the estimate from all sites is exact
+    assert np.isclose(gauss.Gauss(s, seed=1).compute(samples=N ** 2)[0], total)
+
+
+def test_gauss_batch():
+    s = simulation(batch=2)
+    for step in range(3):
+        core.evolve_leapfrog(s)
+    total, maximum = gauss.Gauss(s).compute()
+    assert maximum < TOLERANCE
+    assert np.isclose(gauss.Gauss(s, fields=True).compute()[0], total, rtol=1e-6, atol=2 * N ** 2 * TOLERANCE)